@@ -0,0 +1,246 @@
+"""圧縮と分割 (src/envelope.py の compression) の CPU コストと送信バイト数
+
+チャットらしい文章を長さ別 (short / medium / long / paste) に作り、圧縮の方式ごとに
+
+- 圧縮率 (圧縮後 / 圧縮前)
+- encode: ブロードキャスト1件あたりの圧縮・分割の時間 (サーバーは1件につき1回だけ行う)
+- decode: 受信者1人あたりの組み立て・展開の時間
+- ルーム人数ごとのブロードキャスト1件の送信バイト数 (UDP / IP ヘッダーの 28 バイトを含む)
+
+を測る。方式は none (圧縮しない) / zlib (辞書なし) / preset (プリセット辞書) で、
+preset は envelope.encode と Reassembler をそのまま使う。
+
+    python3 benchmarks/compression.py
+    python3 benchmarks/compression.py --rooms 10,100,1000,10000 --json result.json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from envelope import (  # noqa: E402
+    COMPRESS_THRESHOLD,
+    FRAGMENT_HEADER,
+    FRAGMENT_SIZE,
+    HEADER,
+    MSG_CHAT,
+    PRESET_DICTIONARY,
+    Reassembler,
+    encode,
+)
+
+UDP_IP_OVERHEAD = 28
+
+WORDS = [
+    "了解です。",
+    "よろしくお願いします。",
+    "ありがとうございます。",
+    "明日のミーティングは",
+    "10時からで大丈夫ですか？",
+    "サーバーのログを見てみます。",
+    "デプロイが終わりました。",
+    "I think that is fine.",
+    "can you check the error?",
+    "thanks!",
+    "https://www.github.com/example/project/pull/1234",
+    "レビューお願いします。",
+    "なるほど、そうですね。",
+]
+
+PASTE = """Traceback (most recent call last):
+  File "server.py", line {line}, in handle_udp_message
+    broadcast_message_to_room(room_name, message)
+  File "server.py", line {line2}, in broadcast_message_to_room
+    send_datagrams(payload, addresses)
+OSError: [Errno {errno}] Resource temporarily unavailable
+"""
+
+SIZES = {"short": 40, "medium": 200, "long": 1000, "paste": 8000}
+
+
+def make_corpus(size, count, rng):
+    """長さがおよそ size バイトのメッセージを count 件作る"""
+    messages = []
+    for _ in range(count):
+        parts = []
+        length = 0
+        while length < size:
+            if size >= 1000 and rng.random() < 0.3:
+                part = PASTE.format(
+                    line=rng.randint(1, 2000),
+                    line2=rng.randint(1, 2000),
+                    errno=rng.randint(1, 120),
+                )
+            else:
+                part = rng.choice(WORDS)
+            parts.append(part)
+            length += len(part.encode("utf-8"))
+        body = "alice: " + "".join(parts)
+        messages.append(body.encode("utf-8")[:size])
+    return messages
+
+
+def compress_with(body, level, zdict):
+    if zdict is None:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict
+        )
+    return compressor.compress(body) + compressor.flush()
+
+
+def wire_datagrams(body_size):
+    """本文が body_size バイトのメッセージを送るデータグラムの (数, 合計バイト数)"""
+    if body_size <= FRAGMENT_SIZE:
+        return 1, HEADER.size + body_size + UDP_IP_OVERHEAD
+    fragments = math.ceil(body_size / FRAGMENT_SIZE)
+    overhead = HEADER.size + FRAGMENT_HEADER.size + UDP_IP_OVERHEAD
+    return fragments, body_size + fragments * overhead
+
+
+def bench_variant(messages, level, zdict):
+    """envelope.encode と同じ規則 (閾値・縮まなければ圧縮しない) で他の方式を測る"""
+    packed_messages = []
+    start = time.perf_counter()
+    for body in messages:
+        packed = None
+        if len(body) > COMPRESS_THRESHOLD:
+            packed = compress_with(body, level, zdict)
+            if len(packed) >= len(body):
+                packed = None
+        packed_messages.append(packed)
+    encode_us = (time.perf_counter() - start) / len(messages) * 1e6
+
+    start = time.perf_counter()
+    for packed in packed_messages:
+        if packed is None:
+            continue
+        if zdict is None:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=zdict)
+        decompressor.decompress(packed)
+    decode_us = (time.perf_counter() - start) / len(messages) * 1e6
+
+    sizes = [
+        len(body if packed is None else packed)
+        for body, packed in zip(messages, packed_messages)
+    ]
+    return sizes, encode_us, decode_us
+
+
+def bench_envelope(messages):
+    """envelope.encode / Reassembler をそのまま使う (preset, レベル 6)"""
+    start = time.perf_counter()
+    encoded = [
+        encode(MSG_CHAT, body, 1, 1, message_id=i) for i, body in enumerate(messages)
+    ]
+    encode_us = (time.perf_counter() - start) / len(messages) * 1e6
+
+    reassembler = Reassembler(max_pending=len(messages))
+    start = time.perf_counter()
+    now = time.monotonic()
+    for datagrams in encoded:
+        for datagram in datagrams:
+            reassembler.receive(datagram, now)
+    decode_us = (time.perf_counter() - start) / len(messages) * 1e6
+
+    # 本文 (圧縮後) の大きさ。分割した場合は部分ごとのヘッダーを除く
+    sizes = [
+        sum(len(d) - HEADER.size for d in datagrams)
+        - (FRAGMENT_HEADER.size * len(datagrams) if len(datagrams) > 1 else 0)
+        for datagrams in encoded
+    ]
+    return sizes, encode_us, decode_us
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="圧縮と分割の CPU コストと送信バイト数"
+    )
+    parser.add_argument("--messages", type=int, default=2000, help="長さごとの件数")
+    parser.add_argument(
+        "--rooms", default="10,100,1000", help="ルーム人数 (カンマ区切り)"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    args = parser.parse_args()
+    room_sizes = [int(size) for size in args.rooms.split(",")]
+
+    rng = random.Random(args.seed)
+    variants = [
+        ("none", None, None),
+        ("zlib-1", 1, None),
+        ("zlib-6", 6, None),
+        ("preset-1", 1, PRESET_DICTIONARY),
+    ]
+    result = []
+    for label, size in SIZES.items():
+        messages = make_corpus(size, args.messages, rng)
+        original = sum(map(len, messages))
+        rows = []
+        for name, level, zdict in variants:
+            if level is None:
+                sizes, encode_us, decode_us = list(map(len, messages)), 0.0, 0.0
+            else:
+                sizes, encode_us, decode_us = bench_variant(messages, level, zdict)
+            wire = [wire_datagrams(s) for s in sizes]
+            rows.append(
+                (
+                    name,
+                    sum(sizes) / original,
+                    encode_us,
+                    decode_us,
+                    sum(count for count, _ in wire) / len(messages),
+                    sum(total for _, total in wire) / len(messages),
+                )
+            )
+        sizes, encode_us, decode_us = bench_envelope(messages)
+        wire = [wire_datagrams(s) for s in sizes]
+        rows.append(
+            (
+                "preset-6",
+                sum(sizes) / original,
+                encode_us,
+                decode_us,
+                sum(count for count, _ in wire) / len(messages),
+                sum(total for _, total in wire) / len(messages),
+            )
+        )
+
+        print(f"--- {label} (平均 {original / len(messages):.0f} バイト) ---")
+        header = f"{'mode':<10} {'ratio':>6} {'enc_us':>8} {'dec_us':>8} {'dgrams':>6}"
+        print(header + "".join(f" {f'bytes@{n}':>13}" for n in room_sizes))
+        for name, ratio, enc, dec, dgrams, wire_bytes in rows:
+            line = f"{name:<10} {ratio:>6.3f} {enc:>8.1f} {dec:>8.1f} {dgrams:>6.1f}"
+            print(line + "".join(f" {wire_bytes * n:>13.0f}" for n in room_sizes))
+            result.append(
+                {
+                    "size": label,
+                    "mode": name,
+                    "ratio": ratio,
+                    "encode_us": enc,
+                    "decode_us": dec,
+                    "datagrams": dgrams,
+                    "bytes_per_member": wire_bytes,
+                    "bytes_per_room": {n: wire_bytes * n for n in room_sizes},
+                }
+            )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
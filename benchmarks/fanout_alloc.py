@@ -0,0 +1,173 @@
+"""ブロードキャスト1件あたりのメモリ割り当て計測
+
+参加者ごとに (token, address) のリストを作り、f-string と encode でメッセージを
+組み立てていた従来方式と、ルームのアドレスタプルと OutboundBuffer を使い回す
+方式を比較する。
+
+- peak_bytes: 送信を含めた1件の処理中に一時的に増えたメモリ量 (tracemalloc)
+- bytes_per_member: peak_bytes を人数で割った値。参加者ごとの割り当てがあると
+  人数に関係なく一定以上の値になり、無ければ人数が増えるほど 0 に近づく
+
+CPython には呼び出しごとの割り当て回数を数える API が無いため、
+tracemalloc の一時的なメモリ増加量で比較する。
+
+    python3 benchmarks/fanout_alloc.py
+    python3 benchmarks/fanout_alloc.py --members 10 100 1000 --json result.json
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from batch_io import BatchSender  # noqa: E402
+from fanout import OutboundBuffer  # noqa: E402
+from room_registry import Member, Room  # noqa: E402
+
+MESSAGE = "こんにちは、今日の打ち合わせは15時からです".encode("utf-8")
+
+
+def make_room(addrs):
+    room = Room(1, "bench", "host", "")
+    for i, addr in enumerate(addrs):
+        room.add_member(Member(f"token-{i}", f"user{i}", addr))
+    return room
+
+
+def legacy_prepare(room, sender):
+    """従来方式: 参加者ごとのタプルと、メッセージの decode / format / encode"""
+    message = MESSAGE.decode("utf-8")
+    with room.lock:
+        recipients = []
+        for member in room.members.values():
+            if member.token != sender.token:
+                recipients.append((member.token, member.address))
+    message_bytes = f"{sender.username}: {message}".encode("utf-8")
+    return message_bytes, [ip for token, ip in recipients]
+
+
+def legacy_send(sock, prepared):
+    message_bytes, addrs = prepared
+    for addr in addrs:
+        sock.sendto(message_bytes, addr)
+
+
+def encode_once_prepare(room, sender, buffer):
+    """新方式: アドレスタプルをそのまま使い、送信用バッファに1回だけ書き込む"""
+    message = memoryview(MESSAGE)
+    with room.lock:
+        addresses = room.recipient_addresses()
+    return buffer.compose(sender.prefix, message), addresses, sender.address
+
+
+def encode_once_send(batch_sender, prepared):
+    payload, addresses, exclude = prepared
+    batch_sender.send(payload, addresses, exclude)
+
+
+def measure(prepare, send, repeat):
+    # 1回目はキャッシュの作成などを含むので計測しない
+    send(prepare())
+
+    tracemalloc.start()
+    peaks = []
+    for _ in range(repeat):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        send(prepare())
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        send(prepare())
+    elapsed = time.perf_counter() - start
+
+    return {
+        "peak_bytes": min(peaks),
+        "usec_per_message": elapsed / repeat * 1e6,
+    }
+
+
+def bench(members, repeat):
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    receivers = []
+    for _ in range(members):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        receivers.append(sock)
+
+    room = make_room([sock.getsockname() for sock in receivers])
+    sender = next(iter(room.members.values()))
+    buffer = OutboundBuffer()
+    batch_sender = BatchSender(server)
+
+    methods = [
+        (
+            "legacy",
+            lambda: legacy_prepare(room, sender),
+            lambda prepared: legacy_send(server, prepared),
+        ),
+        (
+            "encode_once",
+            lambda: encode_once_prepare(room, sender, buffer),
+            lambda prepared: encode_once_send(batch_sender, prepared),
+        ),
+    ]
+
+    results = []
+    for name, prepare, send in methods:
+        result = measure(prepare, send, repeat)
+        result.update(
+            {
+                "method": name,
+                "members": members,
+                "bytes_per_member": result["peak_bytes"] / members,
+            }
+        )
+        results.append(result)
+
+    for sock in receivers:
+        sock.close()
+    server.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="ブロードキャスト1件あたりのメモリ割り当て計測"
+    )
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    args = parser.parse_args()
+
+    results = []
+    for members in args.members:
+        results.extend(bench(members, args.repeat))
+
+    print(
+        f"{'method':<13}{'members':>8}{'peak_bytes':>12}"
+        f"{'B/member':>10}{'usec/msg':>10}"
+    )
+    for r in results:
+        print(
+            f"{r['method']:<13}{r['members']:>8}{r['peak_bytes']:>12}"
+            f"{r['bytes_per_member']:>10.1f}{r['usec_per_message']:>10.1f}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""TCP フレームデコーダーのファジングとスループット計測
+
+ファジング (--fuzz 回):
+- ランダムなフレーム列をランダムな位置で分割して FrameDecoder / FrameReader /
+  AsyncFrameReader に渡し、元のフレーム列と同じ順序・内容で取り出せるか確認する
+- ランダムなバイト列を渡し、FrameError 以外の例外が起きないことと、
+  上限を超えるサイズのフレームを読もうとしないことを確認する
+
+スループット:
+- legacy: 従来の recv(32) + recv(ボディ) でフレームごとに2回受信する方式
+- reader: FrameReader で届いている分をまとめて受信し、バッファから取り出す方式
+
+どちらもパイプライン化した (まとめて送った) リクエストを socketpair で読む。
+
+    python3 benchmarks/frame_decoder.py
+    python3 benchmarks/frame_decoder.py --fuzz 10000 --frames 100000 --json result.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from framing import (  # noqa: E402
+    HEADER_SIZE,
+    AsyncFrameReader,
+    Frame,
+    FrameDecoder,
+    FrameError,
+    FrameReader,
+)
+
+FUZZ_MAX_FRAME_SIZE = 2048
+ROOM_NAME_CHARS = "abcxyz0123-_ルーム部屋🙂"
+
+
+def random_frame(rng):
+    room_name = "".join(rng.choice(ROOM_NAME_CHARS) for _ in range(rng.randint(0, 20)))
+    payload = rng.randbytes(rng.randint(0, FUZZ_MAX_FRAME_SIZE // 2))
+    return Frame(room_name, rng.randint(0, 255), rng.randint(0, 255), payload)
+
+
+def split_randomly(rng, data):
+    """data をランダムな長さ (0 バイトを含む) の断片に分ける"""
+    chunks = []
+    index = 0
+    while index < len(data):
+        size = rng.choice((0, 1, 2, 31, 32, 33, rng.randint(1, 4096)))
+        chunks.append(data[index : index + size])
+        index += size
+    return chunks
+
+
+def fuzz_decoder(rng, frames, chunks):
+    decoder = FrameDecoder(FUZZ_MAX_FRAME_SIZE)
+    decoded = []
+    for chunk in chunks:
+        decoded.extend(decoder.feed(chunk))
+    assert decoded == frames, "FrameDecoder の結果が一致しません"
+    assert len(decoder) == 0
+
+
+def fuzz_reader(rng, frames, chunks):
+    reader_socket, writer_socket = socket.socketpair()
+
+    def write():
+        for chunk in chunks:
+            writer_socket.sendall(chunk)
+        writer_socket.close()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    reader = FrameReader(reader_socket, FUZZ_MAX_FRAME_SIZE)
+    decoded = []
+    while (frame := reader.read()) is not None:
+        decoded.append(frame)
+    writer.join()
+    reader_socket.close()
+    assert decoded == frames, "FrameReader の結果が一致しません"
+
+
+def fuzz_async_reader(rng, frames, chunks):
+    async def run():
+        stream = asyncio.StreamReader()
+        # 他のワーカーから渡された受信済みデータを想定して先頭の断片を initial にする
+        initial = chunks[0] if chunks else b""
+        reader = AsyncFrameReader(stream, FUZZ_MAX_FRAME_SIZE, initial)
+        for chunk in chunks[1:]:
+            stream.feed_data(chunk)
+        stream.feed_eof()
+        decoded = []
+        while (frame := await reader.read()) is not None:
+            decoded.append(frame)
+        return decoded
+
+    assert asyncio.run(run()) == frames, "AsyncFrameReader の結果が一致しません"
+
+
+def fuzz_garbage(rng):
+    """ランダムなバイト列で FrameError 以外の例外が起きないこと"""
+    decoder = FrameDecoder(FUZZ_MAX_FRAME_SIZE)
+    data = rng.randbytes(rng.randint(0, 4096))
+    if rng.random() < 0.5:
+        # 巨大な payload_size のヘッダー
+        data = bytes([rng.randint(0, 255), 1, 0]) + rng.randbytes(29) + data
+    try:
+        for chunk in split_randomly(rng, data):
+            for frame in decoder.feed(chunk):
+                assert len(frame.room_name.encode()) + len(frame.payload) <= (
+                    FUZZ_MAX_FRAME_SIZE
+                )
+    except FrameError:
+        pass
+
+
+def fuzz(iterations, seed):
+    rng = random.Random(seed)
+    for i in range(iterations):
+        frames = [random_frame(rng) for _ in range(rng.randint(0, 8))]
+        data = b"".join(frame.encode() for frame in frames)
+        chunks = split_randomly(rng, data)
+        fuzz_decoder(rng, frames, chunks)
+        if i % 10 == 0:
+            # ソケットと asyncio を使う確認は時間がかかるので間引く
+            fuzz_reader(rng, frames, chunks)
+            fuzz_async_reader(rng, frames, chunks)
+        fuzz_garbage(rng)
+
+
+def legacy_read(sock):
+    """従来方式: ヘッダーとボディをそれぞれ1回の recv で読む"""
+    header = sock.recv(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        return None
+    room_name_size = header[0]
+    payload_size = int.from_bytes(header[3:32], byteorder="big")
+    body = sock.recv(room_name_size + payload_size)
+    return body[:room_name_size].decode("utf-8"), body[room_name_size:]
+
+
+def bench(method, frame_count, payload_size):
+    request = Frame("bench-room", 4, 0, b"x" * payload_size).encode()
+    reader_socket, writer_socket = socket.socketpair()
+
+    def write():
+        # パイプライン化したリクエストをまとめて送る
+        batch = request * 256
+        for _ in range(frame_count // 256):
+            writer_socket.sendall(batch)
+        writer_socket.close()
+
+    writer = threading.Thread(target=write)
+    start = time.perf_counter()
+    writer.start()
+    count = 0
+    if method == "legacy":
+        while legacy_read(reader_socket) is not None:
+            count += 1
+    else:
+        reader = FrameReader(reader_socket)
+        while reader.read() is not None:
+            count += 1
+    elapsed = time.perf_counter() - start
+    writer.join()
+    reader_socket.close()
+    return {
+        "method": method,
+        "payload_size": payload_size,
+        "frames": count,
+        "frames_per_sec": count / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="TCP フレームデコーダーのファジングとスループット計測"
+    )
+    parser.add_argument("--fuzz", type=int, default=2000, help="ファジングの回数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--frames", type=int, default=50000)
+    parser.add_argument("--payload-sizes", type=int, nargs="+", default=[64, 1024])
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    args = parser.parse_args()
+
+    fuzz(args.fuzz, args.seed)
+    print(f"fuzz: {args.fuzz} 回 OK")
+
+    results = []
+    for payload_size in args.payload_sizes:
+        for method in ("legacy", "reader"):
+            results.append(bench(method, args.frames, payload_size))
+
+    print(f"{'method':<8}{'payload':>8}{'frames':>9}{'frames/s':>12}")
+    for r in results:
+        print(
+            f"{r['method']:<8}{r['payload_size']:>8}{r['frames']:>9}"
+            f"{r['frames_per_sec']:>12.0f}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
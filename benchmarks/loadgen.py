@@ -0,0 +1,392 @@
+"""TCP ハンドシェイクと UDP チャット配信の負荷試験
+
+client.py と同じワイヤーフォーマットで多数の仮想クライアントを asyncio 上に作り、
+複数のルームでルーム作成・参加とメッセージ送信を行って次を計測する。
+
+- ハンドシェイク: 1秒あたりの完了数、レイテンシ分布、失敗数 (ステータス別)
+- チャット: 送信数、配信数、損失率、送信から受信までのレイテンシ分布
+
+結果は --json で指定したファイルに書き出すので、ビルド間で比較できる。
+
+    python3 src/server.py --bcrypt-rounds 4 &
+    python3 benchmarks/loadgen.py --rooms 50 --members 20 --json result.json
+
+    # サーバーを起動して計測し、サーバー側の統計も結果に含める
+    python3 benchmarks/loadgen.py --spawn-server "--bcrypt-rounds 4" --json result.json
+"""
+
+import argparse
+import asyncio
+import bisect
+import json
+import os
+import platform
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+import client  # noqa: E402
+from framing import AsyncFrameReader  # noqa: E402
+
+MARKER = b"#lg "  # 負荷試験のメッセージの目印
+HISTOGRAM_BOUNDS_MS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+
+
+def summarize(samples_ms):
+    """レイテンシ (ミリ秒) の分位点とヒストグラム"""
+    if not samples_ms:
+        return {"count": 0}
+
+    samples = sorted(samples_ms)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+    counts = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+    for sample in samples:
+        counts[bisect.bisect_left(HISTOGRAM_BOUNDS_MS, sample)] += 1
+
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": percentile(0.50),
+        "p90": percentile(0.90),
+        "p99": percentile(0.99),
+        "p999": percentile(0.999),
+        "max": samples[-1],
+        "histogram": [
+            {"le": bound, "count": count}
+            for bound, count in zip(HISTOGRAM_BOUNDS_MS + ["inf"], counts)
+        ],
+    }
+
+
+class VirtualClient(asyncio.DatagramProtocol):
+    """1人分のクライアント (UDP で受信したメッセージのレイテンシを記録する)"""
+
+    def __init__(self, room_name, username, stats):
+        self.room_name = room_name
+        self.username = username
+        self.stats = stats
+        self.token = None
+        self.transport = None
+        self.received = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        # "ユーザー名: #lg <送信時刻>" 以外 (参加通知など) は数えない
+        index = data.find(MARKER)
+        if index < 0:
+            return
+        sent_at = int(data[index + len(MARKER) :])
+        self.stats["latencies"].append((time.perf_counter_ns() - sent_at) / 1e6)
+        self.received += 1
+
+    def error_received(self, exc):
+        self.stats["udp_errors"] += 1
+
+
+async def handshake(args, operation, vclient, features):
+    """ルーム作成・参加を行い、成功すれば True を返す"""
+    udp_port = vclient.transport.get_extra_info("sockname")[1]
+    reader, writer = await asyncio.open_connection(args.host, args.tcp_port)
+    frames = AsyncFrameReader(reader)
+    try:
+        writer.write(
+            client.build_room_request(
+                operation,
+                vclient.room_name,
+                vclient.username,
+                args.password,
+                features,
+            )
+        )
+        status = (await frames.read()).payload[0]
+        if status != client.SUCCESS:
+            return status
+
+        # udp_endpoint は要求しないので、COMPLETE の末尾に送信先は付かない
+        vclient.token = client.parse_token(
+            (await frames.read()).payload, udp_endpoint=False
+        )
+        writer.write(udp_port.to_bytes(2, "big"))
+        await writer.drain()
+
+        # サーバーが UDP ポートを登録すると接続が閉じられる
+        await reader.read()
+        return client.SUCCESS
+    finally:
+        writer.close()
+
+
+async def connect(args, operation, vclient, features, semaphore, stats):
+    loop = asyncio.get_running_loop()
+    await loop.create_datagram_endpoint(lambda: vclient, local_addr=(args.host, 0))
+
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            status = await asyncio.wait_for(
+                handshake(args, operation, vclient, features), args.timeout
+            )
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            status = type(e).__name__
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+    if status == client.SUCCESS:
+        stats["handshake_latencies"].append(elapsed_ms)
+        return True
+
+    key = str(status)
+    stats["handshake_failures"][key] = stats["handshake_failures"].get(key, 0) + 1
+    return False
+
+
+async def chat(args, vclient, server_addr, stats):
+    """args.messages 件のメッセージを args.interval 秒おきに送信"""
+    for _ in range(args.messages):
+        message = MARKER + str(time.perf_counter_ns()).encode()
+        packet = client.build_message_packet(vclient.room_name, vclient.token, message)
+        vclient.transport.sendto(packet, server_addr)
+        stats["sent"] += 1
+        await asyncio.sleep(args.interval)
+
+
+async def run(args):
+    run_id = uuid.uuid4().hex[:8]
+    client.compact_session = not args.text_token
+    features = [] if args.text_token else [client.FEATURE_COMPACT_SESSION]
+    server_addr = (args.host, args.udp_port)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    stats = {
+        "handshake_latencies": [],
+        "handshake_failures": {},
+        "latencies": [],
+        "sent": 0,
+        "udp_errors": 0,
+    }
+
+    rooms = []
+    for r in range(args.rooms):
+        room_name = f"lg-{run_id}-{r}"
+        members = [
+            VirtualClient(room_name, f"u{r}-{m}", stats) for m in range(args.members)
+        ]
+        rooms.append(members)
+
+    # ホストがルームを作成してから、残りの参加者が参加する
+    started = time.perf_counter()
+    created = await asyncio.gather(
+        *(
+            connect(args, client.CREATE_ROOM, members[0], features, semaphore, stats)
+            for members in rooms
+        )
+    )
+    rooms = [members for members, ok in zip(rooms, created) if ok]
+    joined = await asyncio.gather(
+        *(
+            connect(args, client.JOIN_ROOM, vclient, features, semaphore, stats)
+            for members in rooms
+            for vclient in members[1:]
+        )
+    )
+    handshake_elapsed = time.perf_counter() - started
+
+    joined = iter(joined)
+    rooms = [
+        [members[0]] + [v for v in members[1:] if next(joined)] for members in rooms
+    ]
+    senders = [vclient for members in rooms for vclient in members]
+    # 各メッセージは送信者以外の全員に届く
+    expected = sum(len(m) * (len(m) - 1) for m in rooms) * args.messages
+
+    # チャット
+    started = time.perf_counter()
+    await asyncio.gather(*(chat(args, v, server_addr, stats) for v in senders))
+    send_elapsed = time.perf_counter() - started
+
+    # 遅れて届く分を待つ
+    deadline = time.perf_counter() + args.timeout
+    while len(stats["latencies"]) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+    # ホストの退出でルームを閉じる
+    for members in rooms:
+        host = members[0]
+        packet = client.build_message_packet(host.room_name, host.token, b"/exit")
+        host.transport.sendto(packet, server_addr)
+    await asyncio.sleep(0.2)
+    for members in rooms:
+        for vclient in members:
+            vclient.transport.close()
+
+    handshakes = len(stats["handshake_latencies"])
+    delivered = len(stats["latencies"])
+    return {
+        "handshake": {
+            "attempted": args.rooms * args.members,
+            "completed": handshakes,
+            "failures": stats["handshake_failures"],
+            "per_sec": handshakes / handshake_elapsed if handshake_elapsed else 0,
+            "latency_ms": summarize(stats["handshake_latencies"]),
+        },
+        "chat": {
+            "sent": stats["sent"],
+            "expected_deliveries": expected,
+            "delivered": delivered,
+            "loss_rate": 1 - delivered / expected if expected else 0,
+            "send_per_sec": stats["sent"] / send_elapsed if send_elapsed else 0,
+            "deliveries_per_sec": delivered / send_elapsed if send_elapsed else 0,
+            "udp_errors": stats["udp_errors"],
+            "latency_ms": summarize(stats["latencies"]),
+        },
+    }
+
+
+def build_info():
+    """結果を比較するためのビルド情報"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=SRC_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+    }
+
+
+def spawn_server(args, metrics_file):
+    """サーバーを起動して TCP ポートが開くまで待つ"""
+    command = [sys.executable, os.path.join(SRC_DIR, "server.py")]
+    command += shlex.split(args.spawn_server)
+    command += ["--metrics-file", metrics_file]
+    process = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection((args.host, args.tcp_port), 0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("サーバーが起動しませんでした")
+
+
+def stop_server(process, metrics_file):
+    """サーバーを停止して、停止時に書き出された統計を返す"""
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        return None
+    try:
+        with open(metrics_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def print_summary(result):
+    handshake = result["handshake"]
+    chat = result["chat"]
+    latency = handshake["latency_ms"]
+    print(
+        f"handshake: {handshake['completed']}/{handshake['attempted']} 完了, "
+        f"{handshake['per_sec']:.0f}/s, 失敗 {handshake['failures']}"
+    )
+    if latency["count"]:
+        print(
+            f"  latency ms p50={latency['p50']:.2f} p99={latency['p99']:.2f} "
+            f"max={latency['max']:.2f}"
+        )
+    latency = chat["latency_ms"]
+    print(
+        f"chat: 送信 {chat['sent']}, 配信 {chat['delivered']}/"
+        f"{chat['expected_deliveries']}, 損失率 {chat['loss_rate']:.4f}, "
+        f"{chat['deliveries_per_sec']:.0f} 配信/s"
+    )
+    if latency["count"]:
+        print(
+            f"  latency ms p50={latency['p50']:.2f} p99={latency['p99']:.2f} "
+            f"max={latency['max']:.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="チャットサーバーの負荷試験")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--tcp-port", type=int, default=client.DEFAULT_TCP_PORT)
+    parser.add_argument("--udp-port", type=int, default=client.DEFAULT_UDP_PORT)
+    parser.add_argument("--rooms", type=int, default=50, help="ルーム数")
+    parser.add_argument(
+        "--members", type=int, default=20, help="1ルームあたりの人数 (ホストを含む)"
+    )
+    parser.add_argument(
+        "--messages", type=int, default=20, help="1人あたりの送信メッセージ数"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=0.05, help="1人あたりの送信間隔 (秒)"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=200, help="同時に行うハンドシェイク数"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=10, help="ハンドシェイクと配信待ちの上限 (秒)"
+    )
+    parser.add_argument("--password", default="loadgen")
+    parser.add_argument(
+        "--text-token", action="store_true", help="旧形式の文字列トークンを使う"
+    )
+    parser.add_argument(
+        "--spawn-server",
+        metavar="SERVER_ARGS",
+        help='サーバーを起動して計測する (例: "--engine thread --bcrypt-rounds 4")',
+    )
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    args = parser.parse_args()
+
+    process = None
+    metrics_file = os.path.join(tempfile.mkdtemp(), "metrics.json")
+    if args.spawn_server is not None:
+        process = spawn_server(args, metrics_file)
+
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        server_metrics = stop_server(process, metrics_file) if process else None
+
+    result["config"] = {
+        key: value for key, value in vars(args).items() if key != "json"
+    }
+    result["build"] = build_info()
+    if server_metrics is not None:
+        result["server_metrics"] = server_metrics
+
+    print_summary(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
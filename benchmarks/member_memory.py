@@ -0,0 +1,195 @@
+"""参加者1人あたりのメモリ使用量 (src/room_registry.py)
+
+同じ人数・同じルーム数の参加者を次の4つの持ち方で登録し、tracemalloc で
+増えたメモリ量を人数で割って比べる。どれも UUID のトークン・ユーザー名・
+UDP アドレス・最終発言時刻を持つ。
+
+- dicts: 最初の実装の持ち方。chat_rooms[ルーム名]["tokens"][トークン] = アドレス、
+  tokens[トークン] = {"room_name", "username"}、client_timestamp[トークン] = 時刻
+- previous: 参加者IDで引く前の RoomRegistry の持ち方。members のキーはトークンで、
+  参加者ごとに送信者名・token_key・セッションIDを持ち、索引 (セッションID・
+  token_key・UDP アドレス) は (Room, Member) のタプルを値にする
+- objects: RoomRegistry に、__slots__ の無い (属性を dict で持つ) Member を登録
+- slots: RoomRegistry に、現在の Member (__slots__) を登録
+
+previous・objects・slots は索引を含む (objects と slots はトークン・UDP アドレス)。
+
+    python3 benchmarks/member_memory.py
+    python3 benchmarks/member_memory.py --members 500000 --json result.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import secrets
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from room_registry import MEMBER_ID_BITS, Member, Room, RoomRegistry  # noqa: E402
+
+
+class DictMember:
+    """比較用: __slots__ の無い Member"""
+
+    __init__ = Member.__init__
+
+
+class PreviousMember:
+    """比較用: 参加者IDで引く前の Member"""
+
+    __slots__ = (
+        "token",
+        "username",
+        "address",
+        "prefix",
+        "last_active",
+        "heartbeat",
+        "session_id",
+        "token_key",
+        "reliable",
+        "envelope",
+        "compression",
+        "reassembler",
+        "joined_seq",
+    )
+
+    def __init__(self, token, username, address):
+        self.token = token
+        self.username = username
+        self.address = address
+        self.prefix = f"{username}: ".encode("utf-8")
+        self.last_active = time.time()
+        self.heartbeat = False
+        self.session_id = None
+        self.token_key = None
+        self.reliable = None
+        self.envelope = False
+        self.compression = False
+        self.reassembler = None
+        self.joined_seq = None
+
+
+def address(i):
+    return (f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", 40000 + i % 20000)
+
+
+def build_dicts(members, room_size):
+    chat_rooms = {}
+    tokens = {}
+    client_timestamp = {}
+    for i in range(members):
+        room_name = f"room-{i // room_size}"
+        token = str(uuid.uuid4())
+        room = chat_rooms.get(room_name)
+        if room is None:
+            room = chat_rooms[room_name] = {
+                "host_token": token,
+                "password": "",
+                "tokens": {},
+            }
+        tokens[token] = {"room_name": room_name, "username": f"user{i}"}
+        client_timestamp[token] = time.time()
+        room["tokens"][token] = address(i)
+    return chat_rooms, tokens, client_timestamp
+
+
+def build_previous(members, room_size):
+    """参加者IDで引く前の RoomRegistry と同じ索引を組み立てる"""
+    sessions = {}
+    tokens = {}
+    by_address = {}
+    room = None
+    for i in range(members):
+        token = str(uuid.uuid4())
+        member = PreviousMember(token, f"user{i}", ("127.0.0.1", 50000))
+        if i % room_size == 0:
+            room = Room(i // room_size, f"room-{i // room_size}", token, "")
+        entry = (room, member)
+        member.session_id = room.room_id << MEMBER_ID_BITS | secrets.randbits(
+            MEMBER_ID_BITS
+        )
+        room_name_bytes = room.name.encode("utf-8")
+        token_bytes = token.encode("utf-8")
+        member.token_key = (
+            bytes((len(room_name_bytes), len(token_bytes)))
+            + room_name_bytes
+            + token_bytes
+        )
+        sessions[member.session_id] = entry
+        tokens[member.token_key] = entry
+        room.members[token] = member
+        member.address = address(i)
+        by_address[member.address] = entry
+    return sessions, tokens, by_address
+
+
+def build_registry(member_class):
+    def build(members, room_size):
+        # 履歴はルームごとの固定費なので比較から外す
+        registry = RoomRegistry(history_limits=(0, 0))
+        room = None
+        for i in range(members):
+            token = str(uuid.uuid4())
+            member = member_class(token, f"user{i}", ("127.0.0.1", 50000))
+            if i % room_size == 0:
+                room = registry.create(f"room-{i // room_size}", token, "", member)
+            else:
+                registry.add_member(room, member)
+            with room.lock:
+                registry.set_address(room, member, address(i))
+        return registry
+
+    return build
+
+
+def measure(build, members, room_size):
+    gc.collect()
+    tracemalloc.start()
+    state = build(members, room_size)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del state
+    return size / members
+
+
+def main():
+    parser = argparse.ArgumentParser(description="参加者1人あたりのメモリ使用量")
+    parser.add_argument("--members", type=int, default=100_000)
+    parser.add_argument("--room-size", type=int, default=100, help="1ルームの人数")
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    args = parser.parse_args()
+
+    layouts = {
+        "dicts": build_dicts,
+        "previous": build_previous,
+        "objects": build_registry(DictMember),
+        "slots": build_registry(Member),
+    }
+    result = {
+        "members": args.members,
+        "room_size": args.room_size,
+        "bytes_per_member": {
+            name: measure(build, args.members, args.room_size)
+            for name, build in layouts.items()
+        },
+    }
+
+    print(f"members={args.members} room_size={args.room_size}")
+    for name, value in result["bytes_per_member"].items():
+        print(f"{name:<8} {value:>8.0f} bytes/member")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""流量制限 (src/rate_limit.py) の判定コスト・精度・メモリ
+
+- hot: 同じ送信元から続けて届く場合の allow 1回あたりの時間
+- churn: 毎回違う送信元から届く場合 (新しいバケットの割り当てと上書きを含む)
+- accuracy: 制限の 10 倍の速さで送り続けたときに通した件数の毎秒の値
+- memory: バケットの表が使うバイト数と、同じ件数を dict + オブジェクトで持った場合の比較
+
+    python3 benchmarks/rate_limit.py
+    python3 benchmarks/rate_limit.py --entries 1048576 --keys 2000000 --json result.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from rate_limit import RateLimiter  # noqa: E402
+
+
+class ObjectBucket:
+    """比較用: 素朴なトークンバケット"""
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+def bench_hot(calls):
+    limiter = RateLimiter(1e9, 1e9)
+    key = hash(("127.0.0.1", 50000))
+    start = time.perf_counter()
+    now = time.monotonic()
+    for _ in range(calls):
+        limiter.allow(key, now)
+    return (time.perf_counter() - start) / calls * 1e9
+
+
+def bench_churn(entries, keys):
+    evictions = 0
+
+    def count():
+        nonlocal evictions
+        evictions += 1
+
+    limiter = RateLimiter(50, 100, entries, on_evict=count)
+    start = time.perf_counter()
+    now = time.monotonic()
+    for key in range(1, keys + 1):
+        limiter.allow(key * 0x9E3779B97F4A7C15, now)
+    elapsed = time.perf_counter() - start
+    return elapsed / keys * 1e9, evictions, limiter.active(now)
+
+
+def bench_accuracy(rate, burst, seconds):
+    limiter = RateLimiter(rate, burst)
+    allowed = 0
+    steps = int(rate * 10 * seconds)
+    for i in range(steps):
+        if limiter.allow(1, i / (rate * 10)):
+            allowed += 1
+    return (allowed - burst) / seconds
+
+
+def object_table_memory(entries):
+    tracemalloc.start()
+    table = {key: ObjectBucket(100.0, 0.0) for key in range(entries)}
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del table
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="流量制限の判定コスト・精度・メモリ")
+    parser.add_argument("--calls", type=int, default=1_000_000)
+    parser.add_argument("--entries", type=int, default=1 << 18, help="表のバケット数")
+    parser.add_argument("--keys", type=int, default=500_000, help="churn の送信元の数")
+    parser.add_argument("--rate", type=float, default=50)
+    parser.add_argument("--burst", type=int, default=100)
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    args = parser.parse_args()
+
+    churn_ns, evictions, active = bench_churn(args.entries, args.keys)
+    limiter = RateLimiter(args.rate, args.burst, args.entries)
+    result = {
+        "hot_ns_per_call": bench_hot(args.calls),
+        "churn_ns_per_call": churn_ns,
+        "churn_keys": args.keys,
+        "churn_evictions": evictions,
+        "active_buckets": active,
+        "configured_rate": args.rate,
+        "measured_rate": bench_accuracy(args.rate, args.burst, 10),
+        "table_entries": limiter.capacity,
+        "table_bytes": limiter.memory(),
+        "object_table_bytes": object_table_memory(limiter.capacity),
+    }
+
+    for key, value in result.items():
+        if isinstance(value, float):
+            value = f"{value:.1f}"
+        print(f"{key:<20} {value}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
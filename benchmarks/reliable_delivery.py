@@ -0,0 +1,147 @@
+"""信頼性レイヤー (src/reliable.py) の損失率ごとの配信率と再送率
+
+ネットワークを使わず、仮想時刻の上で ReliableChannel 同士を損失・遅延の揺らぎ
+(順序の入れ替わり)・重複のある経路でつないで、次を計測する。
+
+- delivered: 順番どおりに取り出せたメッセージの割合
+- in_order: 取り出した順序が送信順と一致したか
+- retransmits_per_message: 1メッセージあたりの再送回数
+- giveups / gaps: 送信側が諦めた数と、受信側が飛ばした連番の数
+- max_unacked / max_buffered: 送信側・受信側が同時に保持した最大件数 (window 以下)
+
+    python3 benchmarks/reliable_delivery.py
+    python3 benchmarks/reliable_delivery.py --loss 0 0.1 0.3 0.5 --json result.json
+"""
+
+import argparse
+import heapq
+import json
+import os
+import random
+import sys
+from collections import Counter
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from reliable import RETRANSMIT_INTERVAL, ReliableChannel  # noqa: E402
+
+
+def simulate(loss, messages, send_interval, latency, jitter, duplicate, seed):
+    rng = random.Random(seed)
+    stats = Counter()
+
+    def count(name, value=1):
+        stats[name] += value
+
+    sender = ReliableChannel(count=count)
+    receiver = ReliableChannel(count=count)
+    events = []  # (到着時刻, 連番, 宛先, パケット)
+    sequence = 0
+
+    def transmit(now, destination, packet):
+        nonlocal sequence
+        copies = 2 if rng.random() < duplicate else 1
+        for _ in range(copies):
+            if rng.random() < loss:
+                continue
+            sequence += 1
+            arrival = now + latency + rng.random() * jitter
+            heapq.heappush(events, (arrival, sequence, destination, packet))
+
+    delivered = []
+    max_unacked = max_buffered = 0
+    now = 0.0
+    next_send = 0.0
+    next_retransmit = RETRANSMIT_INTERVAL
+    sent = 0
+    while sent < messages or events or sender.pending():
+        now = min(
+            next_send if sent < messages else float("inf"),
+            next_retransmit,
+            events[0][0] if events else float("inf"),
+        )
+        if sent < messages and now == next_send:
+            transmit(now, receiver, sender.wrap(f"m{sent}".encode(), now))
+            sent += 1
+            next_send += send_interval
+        elif now == next_retransmit:
+            for packet in sender.due(now):
+                transmit(now, receiver, packet)
+            next_retransmit += RETRANSMIT_INTERVAL
+        else:
+            _, _, destination, packet = heapq.heappop(events)
+            messages_out, ack = destination.receive(packet)
+            delivered.extend(bytes(m).decode() for m in messages_out)
+            if ack is not None:
+                transmit(now, sender, ack)
+
+        max_unacked = max(max_unacked, len(sender.sender.unacked))
+        max_buffered = max(max_buffered, len(receiver.receiver.buffer))
+
+    expected = [f"m{i}" for i in range(messages)]
+    return {
+        "loss": loss,
+        "messages": messages,
+        "delivered": len(delivered) / messages,
+        "in_order": delivered == [m for m in expected if m in set(delivered)],
+        "retransmits_per_message": stats["retransmits"] / messages,
+        "giveups": stats["retransmit_giveups"],
+        "gaps": stats["sequence_gaps"],
+        "duplicates": stats["duplicate_datagrams"],
+        "max_unacked": max_unacked,
+        "max_buffered": max_buffered,
+        "seconds": now,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="信頼性レイヤーの損失率ごとの配信率と再送率"
+    )
+    parser.add_argument("--loss", type=float, nargs="+", default=[0.0, 0.05, 0.2, 0.5])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument(
+        "--send-interval", type=float, default=0.01, help="送信間隔 (秒)"
+    )
+    parser.add_argument("--latency", type=float, default=0.02, help="片道の遅延 (秒)")
+    parser.add_argument(
+        "--jitter", type=float, default=0.03, help="遅延の揺らぎ (順序が入れ替わる)"
+    )
+    parser.add_argument("--duplicate", type=float, default=0.01, help="重複する確率")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    args = parser.parse_args()
+
+    results = [
+        simulate(
+            loss,
+            args.messages,
+            args.send_interval,
+            args.latency,
+            args.jitter,
+            args.duplicate,
+            args.seed,
+        )
+        for loss in args.loss
+    ]
+
+    print(
+        f"{'loss':>6}{'delivered':>10}{'in_order':>9}{'retx/msg':>9}"
+        f"{'giveups':>8}{'gaps':>6}{'dups':>6}{'unacked':>8}{'buffered':>9}"
+    )
+    for r in results:
+        print(
+            f"{r['loss']:>6.2f}{r['delivered']:>10.4f}{str(r['in_order']):>9}"
+            f"{r['retransmits_per_message']:>9.2f}{r['giveups']:>8}{r['gaps']:>6}"
+            f"{r['duplicates']:>6}{r['max_unacked']:>8}{r['max_buffered']:>9}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""状態ログ (src/state_log.py) の記録コストと復元時間
+
+- join: RoomRegistry へのルーム作成・参加 1 件あたりの時間を、状態ログなし /
+  ありで比べる (ありの場合も書き込みと fsync は別スレッドで行われる)
+- restore: 記録したセグメントとスナップショットからの復元にかかる時間
+
+    python3 benchmarks/state_restore.py
+    python3 benchmarks/state_restore.py --rooms 10000 --members 10 --json result.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from room_registry import Member, RoomRegistry  # noqa: E402
+from state_log import StateLog  # noqa: E402
+
+PASSWORD_HASH = "$2b$12$" + "x" * 53  # bcrypt のハッシュと同じ長さ
+
+
+def populate(registry, rooms, members):
+    """ルームと参加者を登録し、1件あたりの秒数を返す"""
+    start = time.perf_counter()
+    for i in range(rooms):
+        host = Member(f"host-{i}", f"host{i}", ("127.0.0.1", 10000))
+        room = registry.create(f"room-{i}", host.token, PASSWORD_HASH, host)
+        for j in range(members):
+            member = Member(f"member-{i}-{j}", f"user{j}", ("127.0.0.1", 20000))
+            registry.add_member(room, member)
+            with room.lock:
+                room.set_address(member, ("127.0.0.1", 30000 + j))
+                registry.address_changed(room, member)
+    return (time.perf_counter() - start) / (rooms * (members + 1))
+
+
+def bench(rooms, members):
+    directory = tempfile.mkdtemp()
+    try:
+        baseline = populate(RoomRegistry(), rooms, members)
+
+        stats = Counter()
+
+        def count(name, value=1):
+            stats[name] += value
+
+        registry = RoomRegistry()
+        state_log = StateLog(directory, count=count)
+        state_log.restore(registry, None)
+        state_log.start(registry)
+        registry.journal = state_log
+        journaled = populate(registry, rooms, members)
+        state_log.close()
+        log_size = sum(
+            os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory)
+        )
+
+        # セグメントからの復元 (再生した後にスナップショットを作る)
+        start = time.perf_counter()
+        restored = StateLog(directory).restore(RoomRegistry(), None)
+        replay_seconds = time.perf_counter() - start
+
+        # スナップショットからの復元
+        registry = RoomRegistry()
+        compacted = StateLog(directory)
+        compacted.restore(registry, None)
+        compacted.start(registry)
+        compacted.close()
+        start = time.perf_counter()
+        StateLog(directory).restore(RoomRegistry(), None)
+        snapshot_seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory)
+
+    return {
+        "rooms": rooms,
+        "members_per_room": members,
+        "join_us": baseline * 1e6,
+        "join_us_with_log": journaled * 1e6,
+        "records": stats["state_log_records"],
+        "commits": stats["state_log_commits"],
+        "log_bytes": log_size,
+        "restored": restored,
+        "replay_seconds": replay_seconds,
+        "snapshot_restore_seconds": snapshot_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="状態ログの記録コストと復元時間")
+    parser.add_argument("--rooms", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--members", type=int, default=5, help="1ルームの参加者数")
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    args = parser.parse_args()
+
+    results = [bench(rooms, args.members) for rooms in args.rooms]
+
+    print(
+        f"{'rooms':>7}{'join(us)':>10}{'+log(us)':>10}{'records':>9}{'commits':>9}"
+        f"{'bytes':>10}{'replay(s)':>11}{'snapshot(s)':>12}"
+    )
+    for r in results:
+        print(
+            f"{r['rooms']:>7}{r['join_us']:>10.2f}{r['join_us_with_log']:>10.2f}"
+            f"{r['records']:>9}{r['commits']:>9}{r['log_bytes']:>10}"
+            f"{r['replay_seconds']:>11.3f}{r['snapshot_restore_seconds']:>12.3f}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""UDP ブロードキャストのスループット計測
+
+sendto を宛先ごとに呼ぶ従来方式と batch_io.BatchSender (sendmmsg / フォールバック)
+で、ルーム人数ごとに1秒あたり何件のチャットメッセージを配信できるかを比較する。
+
+    python3 benchmarks/udp_fanout.py
+    python3 benchmarks/udp_fanout.py --members 10 100 1000 --datagrams 200000
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from batch_io import HAVE_MMSG, BatchReceiver, BatchSender  # noqa: E402
+
+MESSAGE = "alice: こんにちは、今日の打ち合わせは15時からです".encode("utf-8")
+
+
+def open_receivers(count):
+    receivers = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        receivers.append(sock)
+    return receivers
+
+
+def send_loop(sock, addrs, lines):
+    for _ in range(lines):
+        for addr in addrs:
+            sock.sendto(MESSAGE, addr)
+
+
+def send_batch(sender, addrs, lines):
+    for _ in range(lines):
+        sender.send(MESSAGE, addrs)
+
+
+def bench_fanout(members, datagrams):
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    receivers = open_receivers(members)
+    addrs = [sock.getsockname() for sock in receivers]
+    lines = max(1, datagrams // members)
+
+    methods = [("sendto", lambda: send_loop(server, addrs, lines))]
+    if HAVE_MMSG:
+        sender = BatchSender(server)
+        methods.append(("sendmmsg", lambda: send_batch(sender, addrs, lines)))
+    fallback = BatchSender(server, use_mmsg=False)
+    methods.append(("fallback", lambda: send_batch(fallback, addrs, lines)))
+
+    results = []
+    for name, run in methods:
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "benchmark": "fanout",
+                "method": name,
+                "members": members,
+                "messages_per_sec": lines / elapsed,
+                "datagrams_per_sec": lines * members / elapsed,
+            }
+        )
+
+    for sock in receivers:
+        sock.close()
+    server.close()
+    return results
+
+
+def bench_receive(datagrams):
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    server.bind(("127.0.0.1", 0))
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    addr = server.getsockname()
+
+    def fill():
+        for _ in range(datagrams):
+            client.sendto(MESSAGE, addr)
+
+    def drain(receive):
+        server.settimeout(0.2)
+        count = 0
+        start = time.perf_counter()
+        try:
+            while count < datagrams:
+                received = receive()
+                if received == 0:
+                    break
+                count += received
+        except socket.timeout:
+            pass
+        return count, time.perf_counter() - start
+
+    fallback = BatchReceiver(server, use_mmsg=False)
+    methods = [
+        ("recvfrom", lambda: len([server.recvfrom(4096)])),
+        ("recvfrom_into", lambda: len(fallback.receive(block=False))),
+    ]
+    if HAVE_MMSG:
+        receiver = BatchReceiver(server)
+        methods.append(("recvmmsg", lambda: len(receiver.receive(block=False))))
+
+    results = []
+    for name, receive in methods:
+        fill()
+        count, elapsed = drain(receive)
+        results.append(
+            {
+                "benchmark": "receive",
+                "method": name,
+                "datagrams": count,
+                "datagrams_per_sec": count / elapsed,
+            }
+        )
+
+    client.close()
+    server.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="UDP ブロードキャストのスループット計測"
+    )
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument(
+        "--datagrams", type=int, default=200000, help="1計測あたりの送信データグラム数"
+    )
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    args = parser.parse_args()
+
+    results = []
+    for members in args.members:
+        results.extend(bench_fanout(members, args.datagrams))
+    results.extend(bench_receive(min(args.datagrams, 20000)))
+
+    print(f"{'benchmark':<10}{'method':<15}{'members':>8}{'msg/s':>12}{'dgram/s':>12}")
+    for r in results:
+        print(
+            f"{r['benchmark']:<10}{r['method']:<15}{r.get('members', '-'):>8}"
+            f"{r.get('messages_per_sec', 0):>12.0f}{r['datagrams_per_sec']:>12.0f}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
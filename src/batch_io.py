@@ -0,0 +1,282 @@
+import ctypes
+import errno
+import os
+import socket
+import sys
+import threading
+
+# バッチ設定
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_BUFFER_SIZE = 4096
+MAX_CACHED_ADDRESSES = 65536  # 変換済み sockaddr を保持する宛先数
+
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+_MSG_WAITFORONE = 0x10000  # linux/socket.h
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IoVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_ubyte * 2),  # network byte order
+        ("sin_addr", ctypes.c_ubyte * 4),
+        ("sin_zero", ctypes.c_ubyte * 8),
+    ]
+
+
+def _load_mmsg():
+    """recvmmsg / sendmmsg を libc から取得 (Linux 以外では None)"""
+    if not sys.platform.startswith("linux"):
+        return None, None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None, None
+
+    recvmmsg.argtypes = [
+        ctypes.c_int,
+        ctypes.POINTER(_MMsgHdr),
+        ctypes.c_uint,
+        ctypes.c_int,
+        ctypes.c_void_p,
+    ]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [
+        ctypes.c_int,
+        ctypes.POINTER(_MMsgHdr),
+        ctypes.c_uint,
+        ctypes.c_int,
+    ]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+
+_recvmmsg, _sendmmsg = _load_mmsg()
+HAVE_MMSG = _recvmmsg is not None
+
+
+def _to_sockaddr(addr):
+    ip, port = addr
+    sockaddr = _SockAddrIn()
+    sockaddr.sin_family = socket.AF_INET
+    sockaddr.sin_port[:] = port.to_bytes(2, "big")
+    sockaddr.sin_addr[:] = socket.inet_aton(ip)
+    return sockaddr
+
+
+def _from_sockaddr(sockaddr):
+    ip = socket.inet_ntoa(bytes(sockaddr.sin_addr))
+    return ip, int.from_bytes(bytes(sockaddr.sin_port), "big")
+
+
+class BatchReceiver:
+    """1回のシステムコールで複数のデータグラムを受信する
+
+    recvmmsg が使えない環境では recvfrom_into をノンブロッキングで繰り返して
+    溜まっている分をまとめて読み出す。
+    受信バッファは最初に batch_size 個確保して使い回し、データグラムは
+    コピーせずにその memoryview で返す。次に receive を呼ぶと上書きされるので、
+    それより後まで残す場合は呼び出し側でコピーする。
+    """
+
+    def __init__(
+        self,
+        sock,
+        batch_size=DEFAULT_BATCH_SIZE,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        use_mmsg=HAVE_MMSG,
+    ):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.use_mmsg = use_mmsg and sock.family == socket.AF_INET
+        self._buffers = [bytearray(buffer_size) for _ in range(batch_size)]
+        self._views = [memoryview(buffer) for buffer in self._buffers]
+        if self.use_mmsg:
+            self._names = (_SockAddrIn * batch_size)()
+            self._iovecs = (_IoVec * batch_size)()
+            self._msgs = (_MMsgHdr * batch_size)()
+            for i in range(batch_size):
+                buffer = (ctypes.c_char * buffer_size).from_buffer(self._buffers[i])
+                self._iovecs[i].iov_base = ctypes.addressof(buffer)
+                self._iovecs[i].iov_len = buffer_size
+                hdr = self._msgs[i].msg_hdr
+                hdr.msg_name = ctypes.addressof(self._names[i])
+                hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+                hdr.msg_iovlen = 1
+
+    def receive(self, block=True):
+        """受信したデータグラムを [(data, addr), ...] で返す
+
+        block=True の場合は少なくとも1件届くまで待つ。
+        """
+        if self.use_mmsg:
+            return self._receive_mmsg(block)
+        return self._receive_fallback(block)
+
+    def _receive_mmsg(self, block):
+        for i in range(self.batch_size):
+            self._msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+        flags = _MSG_WAITFORONE if block else _MSG_DONTWAIT
+        count = _recvmmsg(self.sock.fileno(), self._msgs, self.batch_size, flags, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, os.strerror(err))
+
+        return [
+            (
+                self._views[i][: self._msgs[i].msg_len],
+                _from_sockaddr(self._names[i]),
+            )
+            for i in range(count)
+        ]
+
+    def _receive_fallback(self, block):
+        datagrams = []
+        try:
+            if block:
+                datagrams.append(self._receive_into(0, 0))
+            if _MSG_DONTWAIT:
+                while len(datagrams) < self.batch_size:
+                    datagrams.append(self._receive_into(len(datagrams), _MSG_DONTWAIT))
+        except (BlockingIOError, InterruptedError):
+            pass
+        return datagrams
+
+    def _receive_into(self, index, flags):
+        view = self._views[index]
+        size, addr = self.sock.recvfrom_into(view, self.buffer_size, flags)
+        return view[:size], addr
+
+
+class BatchSender:
+    """同じデータグラムを複数の宛先へまとめて送信する
+
+    sendmmsg が使えない環境では sendto を宛先ごとに呼び出す。
+    送信用の構造体を使い回すので、複数スレッドからの呼び出しは lock で直列化する。
+    """
+
+    def __init__(self, sock, batch_size=DEFAULT_BATCH_SIZE, use_mmsg=HAVE_MMSG):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.use_mmsg = use_mmsg and sock.family == socket.AF_INET
+        if self.use_mmsg:
+            self._iovec = _IoVec()
+            self._msgs = (_MMsgHdr * batch_size)()
+            self._hdrs = [msg.msg_hdr for msg in self._msgs]
+            for hdr in self._hdrs:
+                hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+                hdr.msg_iov = ctypes.pointer(self._iovec)
+                hdr.msg_iovlen = 1
+            self._sockaddrs = {}
+            """{addr: (sockaddr_in, そのアドレス)}  宛先ごとの変換を1回で済ませる"""
+
+    def send(self, data, addrs, exclude=None):
+        """data を addrs の全員 (exclude のアドレスを除く) に送信し、
+        送れなかった宛先のリストを返す
+
+        送信バッファが一杯 (EAGAIN) になった時点で残りの宛先を返すので、
+        呼び出し側で別の経路から送り直せる。宛先ごとのエラーは読み飛ばす。
+        data は bytes のほか、書き込み可能なバッファ (bytearray の memoryview) でもよい。
+        """
+        if self.use_mmsg:
+            with self.lock:
+                return self._send_mmsg(data, addrs, exclude)
+        return self._send_fallback(data, addrs, exclude)
+
+    def _send_mmsg(self, data, addrs, exclude):
+        if isinstance(data, bytes):
+            buffer = ctypes.c_char_p(data)
+        else:
+            buffer = (ctypes.c_char * len(data)).from_buffer(data)
+        self._iovec.iov_base = ctypes.cast(buffer, ctypes.c_void_p)
+        self._iovec.iov_len = len(data)
+        fd = self.sock.fileno()
+
+        # 送信中の構造体を解放しないよう、キャッシュの破棄は送信前に行う
+        if len(self._sockaddrs) >= MAX_CACHED_ADDRESSES:
+            self._sockaddrs.clear()
+
+        start = 0
+        while start < len(addrs):
+            # 除外する宛先を飛ばしながらヘッダーを埋める
+            count = 0
+            end = start
+            while end < len(addrs) and count < self.batch_size:
+                addr = addrs[end]
+                end += 1
+                if addr == exclude:
+                    continue
+                self._hdrs[count].msg_name = self._sockaddr(addr)
+                count += 1
+            if count == 0:
+                break
+
+            sent = _sendmmsg(fd, self._msgs, count, _MSG_DONTWAIT)
+            if sent == count:
+                start = end
+                continue
+
+            if sent < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return [addr for addr in addrs[start:] if addr != exclude]
+                if err == errno.EINTR:
+                    continue
+                # 先頭の宛先への送信に失敗したので飛ばして続ける
+                sent = 1
+            start = self._skip(addrs, start, sent, exclude)
+        return []
+
+    @staticmethod
+    def _skip(addrs, start, count, exclude):
+        """addrs[start:] のうち exclude 以外の count 件を読み進めた位置"""
+        while count > 0:
+            if addrs[start] != exclude:
+                count -= 1
+            start += 1
+        return start
+
+    def _sockaddr(self, addr):
+        entry = self._sockaddrs.get(addr)
+        if entry is None:
+            sockaddr = _to_sockaddr(addr)
+            entry = (sockaddr, ctypes.addressof(sockaddr))
+            self._sockaddrs[addr] = entry
+        return entry[1]
+
+    def _send_fallback(self, data, addrs, exclude):
+        for i, addr in enumerate(addrs):
+            if addr == exclude:
+                continue
+            try:
+                self.sock.sendto(data, _MSG_DONTWAIT, addr)
+            except BlockingIOError:
+                return [addr for addr in addrs[i:] if addr != exclude]
+            except OSError:
+                continue
+        return []
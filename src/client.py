@@ -3,8 +3,23 @@ import threading
 import json
 import argparse
 import getpass
-
+import itertools
+import time
+from collections import Counter
+
+from envelope import (
+    MAX_MESSAGE_SIZE,
+    MSG_CHAT,
+    MSG_EVICTED,
+    MSG_LEAVE,
+    MSG_ROOM_CLOSED,
+    Reassembler,
+    decompress,
+    encode,
+)
+from framing import FrameReader, encode_frame
 from models.room_operation_code import RoomOperationCode
+from reliable import RETRANSMIT_INTERVAL, ReliableChannel
 
 # サーバー設定（デフォルト値）
 DEFAULT_SERVER_HOST = "localhost"
@@ -14,17 +29,41 @@ DEFAULT_UDP_PORT = 8001
 # 操作コード
 CREATE_ROOM = 1
 JOIN_ROOM = 2
+LEAVE_ROOM = 3  # 以下は制御セッションでのみ使う
+HEARTBEAT = 4
+LIST_ROOMS = 5
+HISTORY = 6
 
 # 状態コード
 REQUEST = 0
 ACKNOWLEDGE = 1
 COMPLETE = 2
+COMPLETE_COMPRESSED = 3  # ペイロードを圧縮した COMPLETE
 
 # ステータスコード
 SUCCESS = 0
 ROOM_EXISTS = 1
 ROOM_NOT_FOUND = 2
 INVALID_PASSWORD = 3
+SERVER_BUSY = 4
+INVALID_REQUEST = 5
+
+# 拡張機能
+FEATURE_COMPACT_SESSION = "compact_session"
+FEATURE_CONTROL_SESSION = "control_session"
+FEATURE_RELIABLE_DELIVERY = "reliable_delivery"
+FEATURE_UDP_ENDPOINT = "udp_endpoint"
+FEATURE_BINARY_ENVELOPE = "binary_envelope"
+FEATURE_COMPRESSION = "compression"
+SESSION_ID_SIZE = 12  # 4バイトのルームID + 8バイトの参加者ID
+ENDPOINT_SIZE = 6  # COMPLETE の末尾の UDP の送信先 (IPv4 アドレス + ポート)
+
+# 制御セッション
+HEARTBEAT_INTERVAL = 30  # サーバーの SESSION_IDLE_TIMEOUT より短くする
+DEFAULT_HISTORY_LINES = 20  # 参加時に表示する参加前のメッセージの件数
+
+# UDP のハートビート (本文が空のデータグラム)
+DEFAULT_UDP_HEARTBEAT_INTERVAL = 5  # サーバーの HEARTBEAT_TIMEOUT の 1/3 程度にする
 
 # クライアント状態
 client_token = None
@@ -32,20 +71,51 @@ client_room = None
 client_username = None
 running = True
 udp_socket = None
-
-
-def send_udp_port(tcp_socket, server_host):
+compact_session = True  # トークンの代わりにバイナリのセッションIDを使う
+use_control_session = True  # 参加後も TCP 接続を制御セッションとして残す
+control_socket = None
+control_frames = None  # control_socket の FrameReader
+request_ids = itertools.count(1)
+use_reliable_delivery = False  # UDP に連番・ACK・再送を付ける
+reliable_channel = None  # ReliableChannel (参加後に作成する)
+reliable_stats = Counter()  # 再送・重複などの件数
+history_lines = DEFAULT_HISTORY_LINES
+udp_endpoint = None  # サーバーが指定した UDP の送信先 (ルームを担当するサーバー)
+udp_heartbeat_interval = DEFAULT_UDP_HEARTBEAT_INTERVAL
+reassembler = Reassembler()  # 分割・圧縮されたメッセージを元に戻す
+message_ids = itertools.count(1)  # 分割して送るメッセージのID
+
+
+def open_udp_socket(server_host):
+    """メッセージ送受信用の UDP ソケットを作成してポート番号を返す"""
     global udp_socket
     udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     udp_socket.bind((server_host, 0))
-    client_udp_port = udp_socket.getsockname()[1]
+    return udp_socket.getsockname()[1]
+
+
+def send_udp_port(tcp_socket, server_host):
+    client_udp_port = open_udp_socket(server_host)
     client_udp_port_bytes = client_udp_port.to_bytes(2, "big")
     tcp_socket.send(client_udp_port_bytes)
 
 
+def room_request_options(server_host):
+    """ルーム作成・参加リクエストに付ける (features, 追加の項目)"""
+    features = [FEATURE_COMPACT_SESSION] if compact_session else []
+    features += [FEATURE_UDP_ENDPOINT, FEATURE_BINARY_ENVELOPE, FEATURE_COMPRESSION]
+    if use_reliable_delivery:
+        features.append(FEATURE_RELIABLE_DELIVERY)
+    if not use_control_session:
+        return features, None
+    # UDP ポートはリクエストに含めて送る
+    features.append(FEATURE_CONTROL_SESSION)
+    return features, {"udp_port": open_udp_socket(server_host)}
+
+
 def create_room(server_host, tcp_port, room_name, username, password=None):
     """新しいチャットルームを作成する"""
-    global client_token, client_room, client_username
+    global client_token, client_room, client_username, control_socket, control_frames
 
     # TCP ソケット作成
     tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -53,77 +123,57 @@ def create_room(server_host, tcp_port, room_name, username, password=None):
     try:
         tcp_socket.connect((server_host, tcp_port))
 
-        # リクエストデータ準備
-        room_name_bytes = room_name.encode("utf-8")
-        room_name_size = len(room_name_bytes)
-
-        # ペイロードとしてJSONを使用
-        payload_data = {"username": username, "password": password if password else ""}
-        payload_bytes = json.dumps(payload_data).encode("utf-8")
-        payload_size = len(payload_bytes)
-
-        # ヘッダー作成
-        header = bytes([room_name_size, CREATE_ROOM, REQUEST]) + payload_size.to_bytes(
-            29, byteorder="big"
-        )
-
         # リクエスト送信
-        tcp_socket.sendall(header + room_name_bytes + payload_bytes)
+        features, extra = room_request_options(server_host)
+        tcp_socket.sendall(
+            build_room_request(
+                CREATE_ROOM, room_name, username, password, features, extra
+            )
+        )
 
         # 応答受信
-        response_header = tcp_socket.recv(32)
-        if not response_header or len(response_header) < 32:
+        frames = FrameReader(tcp_socket)
+        response = frames.read()
+        if response is None or not response.payload:
             print("サーバーからの応答がありません")
             return False
 
-        response_room_name_size = response_header[0]
-        # response_operation = response_header[1]
-        # response_state = response_header[2]
-        response_payload_size = int.from_bytes(response_header[3:32], byteorder="big")
-
-        response_body = tcp_socket.recv(response_room_name_size + response_payload_size)
-        response_size = response_room_name_size + response_payload_size
-        if not response_body or len(response_body) < response_size:
-            print("サーバーからの応答が不完全です")
-            return False
-
-        # response_room_name = response_body[:response_room_name_size].decode("utf-8")
-        status_code = response_body[response_room_name_size]
+        status_code = response.payload[0]
 
         if status_code != SUCCESS:
             if status_code == ROOM_EXISTS:
                 print(f"ルーム '{room_name}' は既に存在します")
+            elif status_code == SERVER_BUSY:
+                print("サーバーが混雑しています。しばらくしてから再試行してください")
+            elif status_code == INVALID_REQUEST and use_control_session:
+                print(
+                    "サーバーが制御セッションを無効にしています (--no-session で参加してください)"
+                )
             else:
                 print(f"ルーム作成エラー: コード {status_code}")
             return False
 
         # 完了応答の受信
-        complete_header = tcp_socket.recv(32)
-        if not complete_header or len(complete_header) < 32:
+        complete = frames.read()
+        if complete is None:
             print("サーバーからの完了応答がありません")
             return False
 
-        complete_room_name_size = complete_header[0]
-        # complete_operation = complete_header[1]
-        # complete_state = complete_header[2]
-        complete_payload_size = int.from_bytes(complete_header[3:32], byteorder="big")
-
-        complete_body = tcp_socket.recv(complete_room_name_size + complete_payload_size)
-        complete_size = complete_room_name_size + complete_payload_size
-        if not complete_body or len(complete_body) < complete_size:
-            print("サーバーからの完了応答が不完全です")
-            return False
-
-        # complete_room_name = complete_body[:complete_room_name_size].decode("utf-8")
-        token = complete_body[complete_room_name_size:].decode("utf-8")
+        token = parse_token(complete.payload, udp_endpoint=True)
 
         # クライアント状態を更新
         client_token = token
         client_room = room_name
         client_username = username
+        start_reliable_delivery()
 
-        # udp port を送信
-        send_udp_port(tcp_socket, server_host)
+        if use_control_session:
+            # 接続は閉じずに制御セッションとして使う
+            control_socket = tcp_socket
+            control_frames = frames
+        else:
+            # udp port を送信
+            send_udp_port(tcp_socket, server_host)
 
         print(f"チャットルーム '{room_name}' を作成しました！")
         print(
@@ -135,12 +185,13 @@ def create_room(server_host, tcp_port, room_name, username, password=None):
         print(f"ルーム作成中にエラーが発生しました: {e}")
         return False
     finally:
-        tcp_socket.close()
+        if tcp_socket is not control_socket:
+            tcp_socket.close()
 
 
 def join_room(server_host, tcp_port, room_name, username, password=None):
     """既存のチャットルームに参加する"""
-    global client_token, client_room, client_username
+    global client_token, client_room, client_username, control_socket, control_frames
 
     # TCP ソケット作成
     tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -148,81 +199,62 @@ def join_room(server_host, tcp_port, room_name, username, password=None):
     try:
         tcp_socket.connect((server_host, tcp_port))
 
-        # リクエストデータ準備
-        room_name_bytes = room_name.encode("utf-8")
-        room_name_size = len(room_name_bytes)
-
-        # ペイロードとしてJSONを使用
-        payload_data = {"username": username, "password": password if password else ""}
-        payload_bytes = json.dumps(payload_data).encode("utf-8")
-        payload_size = len(payload_bytes)
-
-        # ヘッダー作成
-        header = bytes([room_name_size, JOIN_ROOM, REQUEST]) + payload_size.to_bytes(
-            29, byteorder="big"
-        )
-
         # リクエスト送信
-        tcp_socket.sendall(header + room_name_bytes + payload_bytes)
+        features, extra = room_request_options(server_host)
+        tcp_socket.sendall(
+            build_room_request(
+                JOIN_ROOM, room_name, username, password, features, extra
+            )
+        )
 
         # 応答受信
-        response_header = tcp_socket.recv(32)
-        if not response_header or len(response_header) < 32:
+        frames = FrameReader(tcp_socket)
+        response = frames.read()
+        if response is None or not response.payload:
             print("サーバーからの応答がありません")
             return False
 
-        response_room_name_size = response_header[0]
-        # response_operation = response_header[1]
-        # response_state = response_header[2]
-        response_payload_size = int.from_bytes(response_header[3:32], byteorder="big")
-
-        response_body = tcp_socket.recv(response_room_name_size + response_payload_size)
-        response_size = response_room_name_size + response_payload_size
-        if not response_body or len(response_body) < response_size:
-            print("サーバーからの応答が不完全です")
-            return False
-
-        # response_room_name = response_body[:response_room_name_size].decode("utf-8")
-        status_code = response_body[response_room_name_size]
+        status_code = response.payload[0]
 
         if status_code != SUCCESS:
             if status_code == ROOM_NOT_FOUND:
                 print(f"ルーム '{room_name}' は存在しません")
             elif status_code == INVALID_PASSWORD:
                 print("パスワードが正しくありません")
+            elif status_code == SERVER_BUSY:
+                print("サーバーが混雑しています。しばらくしてから再試行してください")
+            elif status_code == INVALID_REQUEST and use_control_session:
+                print(
+                    "サーバーが制御セッションを無効にしています (--no-session で参加してください)"
+                )
             else:
                 print(f"ルーム参加エラー: コード {status_code}")
             return False
 
         # 完了応答の受信
-        complete_header = tcp_socket.recv(32)
-        if not complete_header or len(complete_header) < 32:
+        complete = frames.read()
+        if complete is None:
             print("サーバーからの完了応答がありません")
             return False
 
-        complete_room_name_size = complete_header[0]
-        # complete_operation = complete_header[1]
-        # complete_state = complete_header[2]
-        complete_payload_size = int.from_bytes(complete_header[3:32], byteorder="big")
-
-        complete_body = tcp_socket.recv(complete_room_name_size + complete_payload_size)
-        complete_size = complete_room_name_size + complete_payload_size
-        if not complete_body or len(complete_body) < complete_size:
-            print("サーバーからの完了応答が不完全です")
-            return False
-
-        # complete_room_name = complete_body[:complete_room_name_size].decode("utf-8")
-        token = complete_body[complete_room_name_size:].decode("utf-8")
+        token = parse_token(complete.payload, udp_endpoint=True)
 
         # クライアント状態を更新
         client_token = token
         client_room = room_name
         client_username = username
+        start_reliable_delivery()
 
-        # udp port を送信
-        send_udp_port(tcp_socket, server_host)
+        if use_control_session:
+            # 接続は閉じずに制御セッションとして使う
+            control_socket = tcp_socket
+            control_frames = frames
+        else:
+            # udp port を送信
+            send_udp_port(tcp_socket, server_host)
 
         print(f"チャットルーム '{room_name}' に参加しました！")
+        show_history(room_name)
         print("退出するには '/exit' と入力してください。")
         return True
 
@@ -230,7 +262,229 @@ def join_room(server_host, tcp_port, room_name, username, password=None):
         print(f"ルーム参加中にエラーが発生しました: {e}")
         return False
     finally:
-        tcp_socket.close()
+        if tcp_socket is not control_socket:
+            tcp_socket.close()
+
+
+def build_room_request(
+    operation, room_name, username, password=None, features=(), extra=None
+):
+    """ルーム作成・参加リクエスト (ヘッダー + ルーム名 + JSON ペイロード) を作成"""
+    # ペイロードとしてJSONを使用
+    payload_data = {"username": username, "password": password if password else ""}
+    if features:
+        payload_data["features"] = list(features)
+    if extra:
+        payload_data.update(extra)
+    return build_request(operation, room_name, payload_data)
+
+
+def build_request(operation, room_name, payload_data):
+    """リクエスト (ヘッダー + ルーム名 + JSON ペイロード) を作成"""
+    payload_bytes = json.dumps(payload_data).encode("utf-8")
+    return encode_frame(room_name, operation, REQUEST, payload_bytes)
+
+
+def receive_control_response(frames):
+    """制御セッションの応答を1件受信して JSON を返す (切断されたら None)"""
+    response = frames.read()
+    if response is None:
+        return None
+    payload = response.payload
+    if response.state == COMPLETE_COMPRESSED:
+        payload = decompress(payload)
+        if payload is None:
+            raise ValueError("圧縮された応答を展開できません")
+    return json.loads(payload.decode("utf-8"))
+
+
+def send_control_request(operation, room_name="", payload_data=None):
+    """制御セッションでリクエストを送信してリクエストIDを返す"""
+    request_id = next(request_ids)
+    payload_data = dict(payload_data or {}, request_id=request_id)
+    control_socket.sendall(build_request(operation, room_name, payload_data))
+    return request_id
+
+
+def list_rooms(server_host, tcp_port):
+    """ルーム一覧 [{"name": ..., "members": ...}] を取得する"""
+    with socket.create_connection((server_host, tcp_port)) as tcp_socket:
+        payload_data = {"request_id": 0, "features": [FEATURE_CONTROL_SESSION]}
+        tcp_socket.sendall(build_request(LIST_ROOMS, "", payload_data))
+        response = receive_control_response(FrameReader(tcp_socket))
+    if response is None or response.get("status") != SUCCESS:
+        return None
+    return response.get("rooms", [])
+
+
+def fetch_history(room_name, limit):
+    """参加する前のメッセージを最大 limit 件取得する (応答受信スレッドの起動前に呼ぶ)
+
+    サーバーは履歴を複数のフレームに分けて送るので、"more" が無くなるまで読む。
+    """
+    request_id = send_control_request(
+        HISTORY, room_name, {"limit": limit, "compress": True}
+    )
+    messages = []
+    while True:
+        response = receive_control_response(control_frames)
+        if response is None:
+            return None
+        if response.get("request_id") != request_id:
+            continue
+        if response.get("status") != SUCCESS:
+            return None
+        messages.extend(response.get("messages", []))
+        if not response.get("more"):
+            return messages
+
+
+def show_history(room_name):
+    """参加する前のメッセージを表示する"""
+    if control_socket is None or history_lines <= 0:
+        return
+    try:
+        messages = fetch_history(room_name, history_lines)
+    except (OSError, ValueError):
+        messages = None
+    if not messages:
+        return
+    print(f"--- 参加前のメッセージ ({len(messages)}件) ---")
+    for _, message in messages:
+        print(message)
+    print("---")
+
+
+def send_heartbeats():
+    """制御セッションで定期的にハートビートを送る"""
+    while running:
+        time.sleep(HEARTBEAT_INTERVAL)
+        try:
+            send_control_request(HEARTBEAT, client_room)
+        except OSError:
+            break
+
+
+def receive_control_responses():
+    """制御セッションの応答を読み続ける (切断されてもメッセージの送受信は続ける)"""
+    while running:
+        try:
+            response = receive_control_response(control_frames)
+        except (OSError, ValueError):
+            response = None
+        if response is None:
+            if running:
+                # サーバーが再起動した場合はトークンが復元されるので送受信を続ける
+                print("サーバーとの制御セッションが切れました")
+            break
+
+
+def start_control_session():
+    """制御セッションのハートビートと応答受信のスレッドを起動"""
+    if control_socket is None:
+        return
+    threading.Thread(target=send_heartbeats, daemon=True).start()
+    threading.Thread(target=receive_control_responses, daemon=True).start()
+
+
+def start_reliable_delivery():
+    """reliable_delivery を使う場合は参加したルーム用の ReliableChannel を作る"""
+    global reliable_channel
+    if use_reliable_delivery:
+        reliable_channel = ReliableChannel(count=count_reliable_event)
+
+
+def count_reliable_event(name, value=1):
+    reliable_stats[name] += value
+
+
+def retransmit_messages(server_host, udp_port):
+    """ACK の届いていないメッセージを再送する"""
+    while running:
+        time.sleep(RETRANSMIT_INTERVAL)
+        try:
+            for packet in reliable_channel.due(time.time()):
+                udp_socket.sendto(
+                    build_message_packet(client_room, client_token, packet),
+                    udp_endpoint or (server_host, udp_port),
+                )
+        except OSError:
+            break
+
+
+def wait_for_acks(timeout=1.0):
+    """終了する前に、送ったメッセージの ACK を少しだけ待つ"""
+    deadline = time.time() + timeout
+    while reliable_channel.pending() and time.time() < deadline:
+        time.sleep(RETRANSMIT_INTERVAL)
+
+
+def build_message_packet(room_name, token, message_bytes):
+    """UDP で送るチャットメッセージのパケットを作成
+
+    token がバイト列 (セッションID) ならルーム名を省略する。
+    """
+    if isinstance(token, bytes):
+        # セッションIDだけでルームと参加者が特定できるのでルーム名は省略
+        room_name_bytes = b""
+        token_bytes = token
+    else:
+        room_name_bytes = room_name.encode("utf-8")
+        token_bytes = token.encode("utf-8")
+
+    return (
+        bytes([len(room_name_bytes), len(token_bytes)])
+        + room_name_bytes
+        + token_bytes
+        + message_bytes
+    )
+
+
+def parse_token(token_bytes, udp_endpoint=False):
+    """COMPLETE のペイロードからトークン (またはセッションID) を取り出す
+
+    udp_endpoint 機能を要求した場合は、末尾の UDP の送信先を
+    グローバル変数の udp_endpoint に設定する。
+    """
+    if udp_endpoint:
+        set_udp_endpoint(token_bytes[-ENDPOINT_SIZE:])
+        token_bytes = token_bytes[:-ENDPOINT_SIZE]
+    if compact_session and len(token_bytes) == SESSION_ID_SIZE:
+        # セッションIDはバイト列のまま保持する
+        return token_bytes
+    return token_bytes.decode("utf-8")
+
+
+def set_udp_endpoint(endpoint):
+    """COMPLETE の末尾の UDP の送信先 (IPv4 アドレス + ポート) を設定する"""
+    global udp_endpoint
+    udp_endpoint = (
+        socket.inet_ntoa(endpoint[:4]),
+        int.from_bytes(endpoint[4:], "big"),
+    )
+
+
+def send_udp_heartbeats(server_host, udp_port):
+    """受信している間、UDP のハートビートを定期的に送る
+
+    発言しなくても退出させられないようにし、終了したことをサーバーがすぐ検出できるようにする。
+    """
+    packet = build_message_packet(client_room, client_token, b"")
+    while running:
+        try:
+            udp_socket.sendto(packet, udp_endpoint or (server_host, udp_port))
+        except OSError:
+            break
+        time.sleep(udp_heartbeat_interval)
+
+
+def start_udp_heartbeats(server_host, udp_port):
+    """UDP のハートビートのスレッドを起動 (間隔が 0 なら送らない)"""
+    if udp_heartbeat_interval <= 0:
+        return
+    threading.Thread(
+        target=send_udp_heartbeats, args=(server_host, udp_port), daemon=True
+    ).start()
 
 
 def receive_messages():
@@ -240,32 +494,54 @@ def receive_messages():
     while running:
         try:
             # メッセージ受信
-            data, _ = udp_socket.recvfrom(4094)  # 最大4094バイト
-            if data:
-                message = data.decode("utf-8")
-                print(message)
-
-                # ルーム閉鎖メッセージを検出
-                if message == "チャットルームが閉じられました":
-                    print("チャットルームが閉じられました。プログラムを終了します。")
-                    running = False
-                    break
-
-                if (
-                    message
-                    == "しばらく発言しなかったので、チャットルームから退出させました"
-                ):
-                    print("プログラムを終了します。")
+            data, server_address = udp_socket.recvfrom(4094)  # 最大4094バイト
+            if not data:
+                continue
+            if reliable_channel is None:
+                messages = [data]
+            else:
+                # 信頼性レイヤー: ACK を返し、連番の順に揃ったメッセージを表示する
+                messages, ack = reliable_channel.receive(data)
+                if ack is not None:
+                    udp_socket.sendto(
+                        build_message_packet(client_room, client_token, ack),
+                        server_address,
+                    )
+
+            for message_bytes in messages:
+                if not show_message(message_bytes):
                     running = False
-                    break
+                    return
         except Exception as e:
             if running:  # 正常終了でない場合のみエラー表示
                 print(f"メッセージ受信中にエラーが発生しました: {e}")
             break
 
 
-def send_message(server_host, udp_port, message):
-    """UDPでメッセージを送信する"""
+def show_message(data):
+    """受信したメッセージを表示する (終了する場合は False を返す)
+
+    メッセージの種別はヘッダーで判別する。扱えない形式のものや、
+    分割されたメッセージの揃っていない部分は読み飛ばす。
+    """
+    envelope = reassembler.receive(data, time.time())
+    if envelope is None:
+        return True
+    kind, _, _, _, body = envelope
+    print(str(body, "utf-8"))
+
+    if kind == MSG_ROOM_CLOSED:
+        print("チャットルームが閉じられました。プログラムを終了します。")
+        return False
+
+    if kind == MSG_EVICTED:
+        print("プログラムを終了します。")
+        return False
+    return True
+
+
+def send_message(server_host, udp_port, message, kind=MSG_CHAT):
+    """UDPでメッセージを送信する (kind は MSG_CHAT または MSG_LEAVE)"""
     global client_token, client_room
 
     if not client_token or not client_room:
@@ -273,25 +549,22 @@ def send_message(server_host, udp_port, message):
         return False
 
     try:
-        # メッセージデータ準備
-        room_name_bytes = client_room.encode("utf-8")
-        room_name_size = len(room_name_bytes)
-
-        token_bytes = client_token.encode("utf-8")
-        token_size = len(token_bytes)
-
-        message_bytes = message.encode("utf-8")
-
-        # パケット作成
-        packet = (
-            bytes([room_name_size, token_size])
-            + room_name_bytes
-            + token_bytes
-            + message_bytes
-        )
+        body = message.encode("utf-8")
+        if len(body) > MAX_MESSAGE_SIZE:
+            print(f"メッセージが長すぎます (最大{MAX_MESSAGE_SIZE}バイト)")
+            return False
 
-        # 送信
-        udp_socket.sendto(packet, (server_host, udp_port))
+        # 長いメッセージは圧縮し、それでも長ければ分割して送る
+        now = time.time()
+        for message_bytes in encode(
+            kind, body, message_id=next(message_ids) & 0xFFFFFFFF
+        ):
+            if reliable_channel is not None:
+                message_bytes = reliable_channel.wrap(message_bytes, now)
+            packet = build_message_packet(client_room, client_token, message_bytes)
+
+            # 送信 (サーバーが送信先を指定していればそちらへ)
+            udp_socket.sendto(packet, udp_endpoint or (server_host, udp_port))
         return True
 
     except Exception as e:
@@ -299,8 +572,25 @@ def send_message(server_host, udp_port, message):
         return False
 
 
+def start_retransmit_thread(server_host, udp_port):
+    """reliable_delivery を使う場合は再送スレッドを起動"""
+    if reliable_channel is None:
+        return
+    threading.Thread(
+        target=retransmit_messages, args=(server_host, udp_port), daemon=True
+    ).start()
+
+
+def print_reliable_stats():
+    """信頼性レイヤーの再送・重複などの件数を表示"""
+    if reliable_channel is not None and reliable_stats:
+        summary = ", ".join(f"{name}={count}" for name, count in reliable_stats.items())
+        print(f"信頼性レイヤー: {summary}")
+
+
 def start_client():
-    global running
+    global running, compact_session, use_control_session, use_reliable_delivery
+    global history_lines, udp_heartbeat_interval
 
     parser = argparse.ArgumentParser(description="チャットメッセンジャークライアント")
     parser.add_argument("--host", default=DEFAULT_SERVER_HOST, help="サーバーホスト")
@@ -310,12 +600,53 @@ def start_client():
     parser.add_argument(
         "--udp-port", type=int, default=DEFAULT_UDP_PORT, help="UDPポート"
     )
+    parser.add_argument(
+        "--text-token",
+        action="store_true",
+        help="セッションIDではなく文字列のトークンで認証する (旧形式)",
+    )
+    parser.add_argument(
+        "--no-session",
+        action="store_true",
+        help="参加後に TCP 接続を閉じる (制御セッションを使わない旧形式)",
+    )
+    parser.add_argument(
+        "--reliable",
+        action="store_true",
+        help="UDP のメッセージに連番・ACK・再送を付けて、欠落と順序の入れ替わりを防ぐ",
+    )
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=DEFAULT_HISTORY_LINES,
+        help="参加時に表示する参加前のメッセージの件数 (0 で表示しない)",
+    )
+    parser.add_argument(
+        "--heartbeat-interval",
+        type=float,
+        default=DEFAULT_UDP_HEARTBEAT_INTERVAL,
+        help="UDP のハートビートを送る間隔 (秒。0 で送らない)",
+    )
     args = parser.parse_args()
+    history_lines = args.history
+    udp_heartbeat_interval = args.heartbeat_interval
+    compact_session = not args.text_token
+    use_control_session = not args.no_session
+    use_reliable_delivery = args.reliable
 
     print("=== チャットメッセンジャークライアント ===")
     print("1. 新しいチャットルームを作成")
     print("2. 既存のチャットルームに参加")
-    input_room_ope_code = input("選択してください (1/2): ")
+    print("3. チャットルームの一覧を表示")
+    input_room_ope_code = input("選択してください (1/2/3): ")
+
+    if input_room_ope_code == "3":
+        rooms = list_rooms(args.host, args.tcp_port)
+        if rooms is None:
+            print("ルーム一覧を取得できませんでした")
+        for room in rooms or []:
+            print(f"{room['name']} ({room['members']}人)")
+        return
 
     match RoomOperationCode(int(input_room_ope_code)):
         case RoomOperationCode.CREATE_ROOM:
@@ -328,13 +659,18 @@ def start_client():
                 # メッセージ受信スレッド起動
                 receive_thread = threading.Thread(target=receive_messages, daemon=True)
                 receive_thread.start()
+                start_udp_heartbeats(args.host, args.udp_port)
+                start_control_session()
+                start_retransmit_thread(args.host, args.udp_port)
 
                 # メッセージ送信ループ
                 try:
                     while running:
                         message = input()
                         if message.strip().lower() == "/exit":
-                            send_message(args.host, args.udp_port, "/exit")
+                            send_message(args.host, args.udp_port, "", MSG_LEAVE)
+                            if reliable_channel is not None:
+                                wait_for_acks()
                             running = False
                             break
                         elif message:
@@ -345,6 +681,9 @@ def start_client():
                 finally:
                     if udp_socket:
                         udp_socket.close()
+                    if control_socket:
+                        control_socket.close()
+                    print_reliable_stats()
 
         case RoomOperationCode.JOIN_ROOM:
             room_name = input("参加するルーム名: ")
@@ -356,13 +695,18 @@ def start_client():
                 # メッセージ受信スレッド起動
                 receive_thread = threading.Thread(target=receive_messages, daemon=True)
                 receive_thread.start()
+                start_udp_heartbeats(args.host, args.udp_port)
+                start_control_session()
+                start_retransmit_thread(args.host, args.udp_port)
 
                 # メッセージ送信ループ
                 try:
                     while running:
                         message = input()
                         if message.strip().lower() == "/exit":
-                            send_message(args.host, args.udp_port, "/exit")
+                            send_message(args.host, args.udp_port, "", MSG_LEAVE)
+                            if reliable_channel is not None:
+                                wait_for_acks()
                             running = False
                             break
                         elif message:
@@ -373,6 +717,9 @@ def start_client():
                 finally:
                     if udp_socket:
                         udp_socket.close()
+                    if control_socket:
+                        control_socket.close()
+                    print_reliable_stats()
 
         case _:
             print("無効な選択です。プログラムを終了します。")
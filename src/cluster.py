@@ -0,0 +1,221 @@
+import asyncio
+import hmac
+import socket
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from framing import encode_frame
+from workers import ADDRESS_SIZE, pack_address, unpack_address
+
+# 中継したノードが元のクライアントのアドレスを伝えるフレームの操作コード
+# (クライアントは使わない。クラスタのノードから届いた場合だけ受け付ける)
+FORWARDED = 0
+
+# ノード間の通信に付ける HMAC-SHA256 の長さ (先頭だけ使う)
+MAC_SIZE = 16
+# FORWARDED フレームを受け付ける作成時刻からの秒数 (盗聴したフレームの再送を防ぐ)
+FORWARDED_MAX_AGE = 30
+TIMESTAMP = struct.Struct("!Q")
+
+MAX_BROKER_MESSAGE_SIZE = 65507
+PROXY_BUFFER_SIZE = 65536
+
+
+class Node(namedtuple("Node", "host tcp_port udp_port broker_port")):
+    """クラスタを構成するサーバー (host は IPv4 アドレス)"""
+
+    __slots__ = ()
+
+
+def parse_nodes(spec):
+    """ノードの指定 (host:tcp_port:udp_port:broker_port をカンマ区切り) をリストにする
+
+    全ノードに同じ並びを指定する。ルームの担当はこの並びの番号で決まる。
+    """
+    nodes = []
+    for entry in spec.split(","):
+        host, tcp_port, udp_port, broker_port = entry.strip().rsplit(":", 3)
+        nodes.append(
+            Node(
+                socket.gethostbyname(host),
+                int(tcp_port),
+                int(udp_port),
+                int(broker_port),
+            )
+        )
+    return nodes
+
+
+class LoopbackBroker:
+    """ノード間のメッセージを UDP で相手のノードへ直接届けるブローカー
+
+    1台で複数ノードを動かして試すための最小の実装 (別のホストのノードにも届く)。
+    ブローカーは publish(node, message) / receive(flags) / fileno() / close() を
+    持てばよいので、外部の pub/sub に置き換える場合は同じメソッドを実装して
+    BROKERS に登録する。メッセージはデータグラムと同じく届かないことがある。
+    """
+
+    def __init__(self, nodes, node_index):
+        self.nodes = nodes
+        node = nodes[node_index]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((node.host, node.broker_port))
+
+    def publish(self, node, message):
+        """message をノード node に届ける"""
+        target = self.nodes[node]
+        self.sock.sendto(message, (target.host, target.broker_port))
+
+    def receive(self, flags=0):
+        """このノード宛てのメッセージを1件受信する"""
+        return self.sock.recv(MAX_BROKER_MESSAGE_SIZE, flags)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+
+BROKERS = {"loopback": LoopbackBroker}
+DEFAULT_BROKER = "loopback"
+
+
+def _ignore(name, value=1):
+    pass
+
+
+def sign(secret, *parts):
+    """共有鍵 secret で parts をつなげたものの MAC を作る"""
+    mac = hmac.new(secret, digestmod="sha256")
+    for part in parts:
+        mac.update(part)
+    return mac.digest()[:MAC_SIZE]
+
+
+class ClusterChannels:
+    """複数のサーバーノードの間で、担当外のルーム宛ての通信を担当ノードへ届ける
+
+    WorkerChannels と同じ使い方ができる (ワーカー番号の代わりにノード番号)。
+    UDP データグラムは送信元アドレスを付けてブローカーで転送し、担当ノードは
+    そのアドレスに直接返信する。TCP 接続は fd を別のホストへ渡せないので、
+    担当ノードに接続し直して、どちらかが切断するまで中継する。中継の最初には
+    FORWARDED フレームを送って元のクライアントのアドレスを伝える。
+
+    ノード間の FORWARDED フレームと転送データグラムには全ノード共通の secret
+    で MAC を付け、MAC が合わないものは捨てる (送信元の IP アドレスは偽れるので
+    信用しない)。count(name, value) には捨てた件数が通知される。
+    """
+
+    def __init__(self, nodes, node_index, broker, secret, count=_ignore):
+        self.nodes = nodes
+        self.worker_count = len(nodes)
+        self.worker_index = node_index
+        self.broker = broker
+        self.secret = secret
+        self.count = count
+
+    @property
+    def receiver(self):
+        return self.broker
+
+    def forwarded_frame(self, client_address, now=None):
+        """中継先に元のクライアントのアドレスを伝えるフレーム (アドレス + 作成時刻 + MAC)"""
+        signed = pack_address(client_address) + TIMESTAMP.pack(
+            int(time.time() if now is None else now)
+        )
+        return encode_frame("", FORWARDED, 0, signed + sign(self.secret, signed))
+
+    def forwarded_address(self, payload, now=None):
+        """FORWARDED フレームのペイロードを確かめて元のクライアントのアドレスを返す
+
+        MAC が合わない・古すぎるものは None。
+        """
+        signed, mac = payload[:-MAC_SIZE], payload[-MAC_SIZE:]
+        if len(signed) != ADDRESS_SIZE + TIMESTAMP.size or not hmac.compare_digest(
+            mac, sign(self.secret, signed)
+        ):
+            self.count("cluster_auth_failures")
+            return None
+        (created,) = TIMESTAMP.unpack_from(signed, ADDRESS_SIZE)
+        if abs((time.time() if now is None else now) - created) > FORWARDED_MAX_AGE:
+            self.count("cluster_auth_failures")
+            return None
+        return unpack_address(signed[:ADDRESS_SIZE])
+
+    def forward_datagram(self, node, data, addr):
+        """UDP データグラムを担当ノードへ転送 (送信元アドレス + MAC + データ)"""
+        address = pack_address(addr)
+        self.broker.publish(node, address + sign(self.secret, address, data) + data)
+
+    def forward_connection(self, node, client_socket, client_address, frame):
+        """受信済みのリクエストと TCP 接続を担当ノードへ中継 (切断されるまで戻らない)"""
+        target = self.nodes[node]
+        with socket.create_connection((target.host, target.tcp_port)) as upstream:
+            upstream.sendall(self.forwarded_frame(client_address) + frame)
+            replies = threading.Thread(
+                target=_pump, args=(upstream, client_socket), daemon=True
+            )
+            replies.start()
+            _pump(client_socket, upstream)
+            replies.join()
+
+    async def forward_stream(self, node, reader, writer, client_address, frame):
+        """受信済みのリクエストと asyncio の接続を担当ノードへ中継"""
+        target = self.nodes[node]
+        upstream_reader, upstream_writer = await asyncio.open_connection(
+            target.host, target.tcp_port
+        )
+        try:
+            upstream_writer.write(self.forwarded_frame(client_address) + frame)
+            await asyncio.gather(
+                _pump_stream(reader, upstream_writer),
+                _pump_stream(upstream_reader, writer),
+            )
+        finally:
+            upstream_writer.close()
+
+    def receive(self, flags=0):
+        """転送されてきたデータグラムを1件受信して ("datagram", data, addr, None) を返す
+
+        MAC が合わないメッセージは捨てて次を待つ。
+        """
+        while True:
+            message = self.broker.receive(flags)
+            address = message[:ADDRESS_SIZE]
+            mac = message[ADDRESS_SIZE : ADDRESS_SIZE + MAC_SIZE]
+            data = message[ADDRESS_SIZE + MAC_SIZE :]
+            if len(mac) == MAC_SIZE and hmac.compare_digest(
+                mac, sign(self.secret, address, data)
+            ):
+                return "datagram", data, unpack_address(address), None
+            self.count("cluster_auth_failures")
+
+
+def _pump(source, destination):
+    """source から読んだものを destination に書き続け、終わったら書き込み側を閉じる"""
+    try:
+        while data := source.recv(PROXY_BUFFER_SIZE):
+            destination.sendall(data)
+        destination.shutdown(socket.SHUT_WR)
+    except OSError:
+        # どちらかが切断されたので反対側も止める
+        for sock in (source, destination):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+async def _pump_stream(reader, writer):
+    """_pump の asyncio 版"""
+    try:
+        while data := await reader.read(PROXY_BUFFER_SIZE):
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except OSError:
+        writer.close()
@@ -0,0 +1,34 @@
+import itertools
+
+
+class ControlSession:
+    """接続し続ける TCP 制御セッション
+
+    1本の接続で複数の操作 (参加・退出・ハートビート・ルーム一覧) を受け付ける。
+    このセッションで参加したルームを覚えておき、接続が切れたら全て退出させる。
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, client_address, features=()):
+        self.session_number = next(self._ids)
+        self.client_address = client_address
+        self.features = list(features)
+        self.memberships = {}
+        """{room_name: (Room, Member)}"""
+
+    def add(self, room, member):
+        self.memberships[room.name] = (room, member)
+
+    def remove(self, room_name):
+        """退出したルームの (Room, Member) を返す (参加していなければ None)"""
+        return self.memberships.pop(room_name, None)
+
+    def get(self, room_name):
+        return self.memberships.get(room_name)
+
+    def close(self):
+        """全ての参加情報を取り出して空にする"""
+        memberships = list(self.memberships.values())
+        self.memberships.clear()
+        return memberships
@@ -0,0 +1,89 @@
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+# キャッシュ設定
+DEFAULT_CACHE_SIZE = 4096
+DEFAULT_CACHE_TTL = 300
+
+
+class CredentialCache:
+    """検証に成功した (ルーム, パスワード) の組を一定時間覚えておく
+
+    平文のパスワードは保持せず、プロセスごとの秘密鍵で HMAC をとった
+    ダイジェストだけを保存する。ダイジェストにはルームのハッシュ値も
+    含めるため、同名のルームが作り直された場合はヒットしない。
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.secret = secrets.token_bytes(32)
+        self.entries = OrderedDict()
+        """{(room_name, digest): 有効期限}  古い順に並ぶ"""
+        self.room_keys = {}
+        """{room_name: {(room_name, digest), ...}}"""
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, room_name, hashed_password, password):
+        """キャッシュにあれば True を返す"""
+        key = (room_name, self._digest(hashed_password, password))
+        now = time.monotonic()
+        with self.lock:
+            expires_at = self.entries.get(key)
+            if expires_at is None:
+                self.misses += 1
+                return False
+            if expires_at < now:
+                self._remove(key)
+                self.misses += 1
+                return False
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(self, room_name, hashed_password, password):
+        """検証に成功した組を登録"""
+        if self.max_entries <= 0:
+            return
+
+        key = (room_name, self._digest(hashed_password, password))
+        with self.lock:
+            self.entries[key] = time.monotonic() + self.ttl
+            self.entries.move_to_end(key)
+            self.room_keys.setdefault(room_name, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                oldest_key = next(iter(self.entries))
+                self._remove(oldest_key)
+
+    def invalidate_room(self, room_name):
+        """ルームに関するエントリを全て削除"""
+        with self.lock:
+            for key in self.room_keys.pop(room_name, ()):
+                self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+            }
+
+    def _digest(self, hashed_password, password):
+        message = hashed_password.encode("utf-8") + b"\0" + password.encode("utf-8")
+        return hmac.new(self.secret, message, hashlib.sha256).digest()
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+        keys = self.room_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.room_keys[key[0]]
@@ -0,0 +1,217 @@
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+# UDP のメッセージ本文に付ける型付きのヘッダー (binary_envelope を要求した参加者との間で使う)
+ENVELOPE_VERSION = 1
+
+# 種別
+MSG_CHAT = 1  # 発言 (サーバーからは本文が "ユーザー名: メッセージ")
+MSG_NOTICE = 2  # その他のサーバーからのお知らせ
+MSG_JOINED = 3  # 参加の通知 (送信者IDは参加した参加者)
+MSG_LEFT = 4  # 退出の通知 (送信者IDは退出した参加者)
+MSG_ROOM_CLOSED = 5  # ルームが閉じられた
+MSG_EVICTED = 6  # 無発言・無応答のため退出させられた
+MSG_LEAVE = 7  # クライアントからの退出要求 (ホストならルームを閉じる)
+
+# フラグ (受信側は知らないビットを無視する)
+FLAG_HISTORY = 1  # 連番が履歴の連番 (HISTORY の since / before に使える)
+FLAG_COMPRESSED = 2  # 本文 (分割されていれば組み立てた後) を compress で圧縮した
+FLAG_FRAGMENT = 4  # 分割したメッセージの一部 (本文の先頭に FRAGMENT_HEADER がある)
+
+# バージョン, 種別, フラグ, 連番, 送信者ID, 本文の長さ
+HEADER = struct.Struct("!BBHIQH")
+# メッセージID, 何番目か (0 から), 分割数
+FRAGMENT_HEADER = struct.Struct("!IHH")
+
+# 圧縮と分割 (compression を要求した参加者との間で使う)
+COMPRESS_THRESHOLD = 256  # これより長い本文を圧縮する
+COMPRESS_LEVEL = 6
+FRAGMENT_SIZE = 1024  # 1データグラムに載せる本文の上限 (IP の分割が起きない大きさ)
+MAX_MESSAGE_SIZE = 60 * 1024  # 組み立て・展開した本文の上限
+MAX_FRAGMENTS = -(-MAX_MESSAGE_SIZE // FRAGMENT_SIZE)
+DEFAULT_MAX_PENDING = 8  # 組み立て中のメッセージ数の上限
+REASSEMBLY_TIMEOUT = 5.0  # この間に揃わなければ捨てる
+
+# 圧縮・展開の両方で使うプリセット辞書 (チャットによく出る文字列。よく出るものほど後ろに置く)
+PRESET_DICTIONARY = "".join(
+    (
+        "https://www.github.com/ http:// .com .jp .html ?id= #L ",
+        "import from def return class self. None True False const let function ",
+        "=> {\n    }\n    if (for (while (    \n\n```\n",
+        'Traceback (most recent call last):\n  File "error: Error: exception ',
+        "I think that is the this is what do you have a it's I'm don't can you ",
+        "please thanks thank you and the for the with the of the to the in the ",
+        "了解です。承知しました。わかりました。なるほど。そうですね。いいですね。",
+        "よろしくお願いします。お疲れ様です。ありがとうございます。すみません。",
+        "ということです。だと思います。でしょうか？ですか？ください。しました。",
+        "しています。していました。できます。できません。ありません。あります。",
+        "今日は明日は昨日は、これは、それは、あれは、ですが、ので、けど、から、",
+        "しばらく発言しなかったので、応答が無かったので、チャットルームから退出させました",
+        "チャットルームが閉じられました",
+        " がチャットルームから退出しました",
+        " がチャットルームに参加しました",
+        "です。ます。でした。ました。",
+    )
+).encode("utf-8")
+
+
+def _ignore(name, value=1):
+    pass
+
+
+def wrap(kind, body, seq=0, sender=0, flags=0):
+    """body (bytes または memoryview) にヘッダーを付けたデータグラムを返す"""
+    return HEADER.pack(ENVELOPE_VERSION, kind, flags, seq, sender, len(body)) + body
+
+
+def compress(body, level=COMPRESS_LEVEL):
+    """PRESET_DICTIONARY を使って raw deflate で圧縮する"""
+    compressor = zlib.compressobj(
+        level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=PRESET_DICTIONARY
+    )
+    return compressor.compress(body) + compressor.flush()
+
+
+def decompress(data, max_size=MAX_MESSAGE_SIZE):
+    """compress の逆 (壊れている場合や展開後が max_size を超える場合は None)"""
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=PRESET_DICTIONARY)
+    try:
+        body = decompressor.decompress(data, max_size)
+    except zlib.error:
+        return None
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        return None
+    return body
+
+
+def encode(
+    kind,
+    body,
+    seq=0,
+    sender=0,
+    flags=0,
+    message_id=0,
+    threshold=COMPRESS_THRESHOLD,
+    count=_ignore,
+):
+    """body を圧縮・分割してヘッダー付きのデータグラムのリストにする
+
+    threshold より長い本文は、縮む場合だけ圧縮する。それでも FRAGMENT_SIZE に
+    収まらなければ message_id を付けて分割する。count(name) には
+    "compressed_messages" / "fragmented_messages" が通知される。
+    """
+    if len(body) > threshold:
+        packed = compress(body)
+        if len(packed) < len(body):
+            body = packed
+            flags |= FLAG_COMPRESSED
+            count("compressed_messages")
+    if len(body) <= FRAGMENT_SIZE:
+        return [wrap(kind, body, seq, sender, flags)]
+
+    count("fragmented_messages")
+    view = memoryview(body)
+    fragments = -(-len(body) // FRAGMENT_SIZE)
+    return [
+        wrap(
+            kind,
+            FRAGMENT_HEADER.pack(message_id, index, fragments)
+            + view[index * FRAGMENT_SIZE : (index + 1) * FRAGMENT_SIZE],
+            seq,
+            sender,
+            flags | FLAG_FRAGMENT,
+        )
+        for index in range(fragments)
+    ]
+
+
+def unwrap(data):
+    """データグラムを (種別, フラグ, 連番, 送信者ID, 本文) に分解する
+
+    バージョンが違うものや短すぎるものは None。本文はコピーしない memoryview で、
+    本文より後ろのバイト列は後のバージョンで項目を足すための領域として読み捨てる。
+    """
+    if len(data) < HEADER.size:
+        return None
+    version, kind, flags, seq, sender, size = HEADER.unpack_from(data)
+    end = HEADER.size + size
+    if version != ENVELOPE_VERSION or end > len(data):
+        return None
+    return kind, flags, seq, sender, memoryview(data)[HEADER.size : end]
+
+
+class Reassembler:
+    """encode で作ったデータグラムを受け取り、分割されたものは組み立て、圧縮は戻す
+
+    組み立て中のメッセージは max_pending 件までで、溢れたら古いものから捨てる。
+    timeout 秒経っても揃わないもの (一部が届かなかった) も捨てる。
+    捨てた件数は count("reassembly_drops") で通知される。
+    """
+
+    def __init__(
+        self, max_pending=DEFAULT_MAX_PENDING, timeout=REASSEMBLY_TIMEOUT, count=_ignore
+    ):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.count = count
+        self.pending = OrderedDict()
+        """{メッセージID: [期限, [各部分], 残りの部分の数]}"""
+        self.lock = threading.Lock()
+
+    def receive(self, data, now):
+        """揃ったメッセージを unwrap と同じ形で返す (揃っていない・扱えない場合は None)"""
+        envelope = unwrap(data)
+        if envelope is None:
+            return None
+        kind, flags, seq, sender, body = envelope
+        if flags & FLAG_FRAGMENT:
+            body = self._add_fragment(body, now)
+            if body is None:
+                return None
+        if flags & FLAG_COMPRESSED:
+            body = decompress(body)
+            if body is None:
+                self.count("reassembly_drops")
+                return None
+        return kind, flags & ~(FLAG_FRAGMENT | FLAG_COMPRESSED), seq, sender, body
+
+    def _add_fragment(self, body, now):
+        """分割されたメッセージの一部を加え、揃ったら連結した本文を返す"""
+        if not FRAGMENT_HEADER.size < len(body) <= FRAGMENT_HEADER.size + FRAGMENT_SIZE:
+            return None
+        message_id, index, fragments = FRAGMENT_HEADER.unpack_from(body)
+        if index >= fragments or fragments > MAX_FRAGMENTS:
+            return None
+
+        with self.lock:
+            self._expire(now)
+            entry = self.pending.get(message_id)
+            if entry is None:
+                if len(self.pending) >= self.max_pending:
+                    self.pending.popitem(last=False)
+                    self.count("reassembly_drops")
+                entry = [now + self.timeout, [None] * fragments, fragments]
+                self.pending[message_id] = entry
+            parts = entry[1]
+            if len(parts) != fragments or parts[index] is not None:
+                # 重複、または同じメッセージIDの別のメッセージ
+                return None
+            # 受信バッファは使い回されるのでコピーして保持する
+            parts[index] = bytes(body[FRAGMENT_HEADER.size :])
+            entry[2] -= 1
+            if entry[2]:
+                return None
+            del self.pending[message_id]
+        return b"".join(parts)
+
+    def _expire(self, now):
+        """期限を過ぎた組み立て中のメッセージを捨てる (期限は追加した順に並んでいる)"""
+        pending = self.pending
+        while pending:
+            message_id, entry = next(iter(pending.items()))
+            if entry[0] > now:
+                return
+            del pending[message_id]
+            self.count("reassembly_drops")
@@ -0,0 +1,44 @@
+import heapq
+import itertools
+import threading
+
+
+class ExpiryQueue:
+    """期限の早い順に取り出せる遅延評価の min-heap
+
+    発言のたびに期限を更新するとヒープ操作が増えるので、登録時の期限だけを
+    積んでおき、取り出したときに呼び出し側が最新の期限を確認する。まだ期限前
+    なら新しい期限で積み直す (schedule) ことで、1回の掃除で触れるのは期限が
+    来た可能性のある項目だけになる。
+    退出済みの項目も取り除かずに残し、取り出したときに読み捨てる。
+    """
+
+    def __init__(self):
+        self.heap = []
+        """[(期限, 登録順, 項目)]"""
+        self.counter = itertools.count()  # 同じ期限の項目同士を比較しないための連番
+        self.lock = threading.Lock()
+
+    def schedule(self, deadline, item):
+        """item を deadline (time.time() の値) に取り出されるよう登録"""
+        with self.lock:
+            heapq.heappush(self.heap, (deadline, next(self.counter), item))
+
+    def pop_due(self, now):
+        """期限が now 以前の項目を全て取り出して [(期限, 項目)] で返す"""
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, _, item = heapq.heappop(self.heap)
+                due.append((deadline, item))
+        return due
+
+    def delay(self, now, max_delay):
+        """次の期限までの秒数 (max_delay を上限とする)"""
+        with self.lock:
+            if not self.heap:
+                return max_delay
+            return min(max(self.heap[0][0] - now, 0), max_delay)
+
+    def __len__(self):
+        return len(self.heap)
@@ -0,0 +1,40 @@
+import threading
+
+# 送信用バッファ設定
+MAX_DATAGRAM_SIZE = 65507  # IPv4 UDP ペイロードの上限
+
+
+class OutboundBuffer:
+    """送信するデータグラムを組み立てる使い回しのバッファ
+
+    ブロードキャストのたびに f-string と encode で新しいバイト列を作る代わりに、
+    固定長の bytearray に各部分を書き込み、その範囲の memoryview を返す。
+    バッファの大きさは変えないので、返した memoryview が残っていても
+    次の組み立てで BufferError にはならない (内容は上書きされる)。
+    """
+
+    def __init__(self, capacity=MAX_DATAGRAM_SIZE):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+
+    def compose(self, *parts):
+        """parts を連結したデータグラムを返す (次の compose までに送信すること)"""
+        end = 0
+        for part in parts:
+            start = end
+            end += len(part)
+            if end > len(self.buffer):
+                return b"".join(parts)
+            self.view[start:end] = part
+        return self.view[:end]
+
+
+_local = threading.local()
+
+
+def outbound_buffer():
+    """呼び出したスレッド専用の OutboundBuffer"""
+    buffer = getattr(_local, "buffer", None)
+    if buffer is None:
+        buffer = _local.buffer = OutboundBuffer()
+    return buffer
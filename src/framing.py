@@ -0,0 +1,269 @@
+import asyncio
+from collections import namedtuple
+
+# TCP フレーム: ヘッダー (32バイト) + ルーム名 + ペイロード
+HEADER_SIZE = 32
+PAYLOAD_SIZE_BYTES = 29
+DEFAULT_MAX_FRAME_SIZE = 16 * 1024  # ボディ (ルーム名 + ペイロード) の上限
+
+
+class FrameError(ValueError):
+    """不正なフレーム (途中で切断された・上限を超えるサイズ・ルーム名が不正)"""
+
+
+class Frame(namedtuple("Frame", "room_name operation state payload")):
+    """受信したフレーム (room_name は str、payload は bytes)"""
+
+    __slots__ = ()
+
+    def encode(self):
+        return encode_frame(self.room_name, self.operation, self.state, self.payload)
+
+
+def encode_frame(room_name, operation, state, payload):
+    """フレームのバイト列を作成"""
+    room_name_bytes = room_name.encode("utf-8")
+    if len(room_name_bytes) > 255:
+        raise FrameError("ルーム名が長すぎます")
+
+    # ヘッダー作成
+    header = bytes([len(room_name_bytes), operation, state]) + len(payload).to_bytes(
+        PAYLOAD_SIZE_BYTES, byteorder="big"
+    )
+    return header + room_name_bytes + payload
+
+
+def parse_header(header, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+    """ヘッダーから (room_name_size, operation, state, payload_size) を取り出す
+
+    payload_size は 29 バイトあるので、そのまま信用せず max_frame_size で制限する。
+    """
+    room_name_size = header[0]
+    operation = header[1]
+    state = header[2]
+    payload_size = int.from_bytes(header[3:HEADER_SIZE], byteorder="big")
+    if room_name_size + payload_size > max_frame_size:
+        raise FrameError(f"フレームが大きすぎます: {room_name_size + payload_size}")
+    return room_name_size, operation, state, payload_size
+
+
+def decode_frame(header, body, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+    """ヘッダーとボディから Frame を作成"""
+    room_name_size, operation, state, _ = parse_header(header, max_frame_size)
+    return _make_frame(room_name_size, operation, state, body)
+
+
+def _make_frame(room_name_size, operation, state, body):
+    try:
+        room_name = str(body[:room_name_size], "utf-8")
+    except UnicodeDecodeError:
+        raise FrameError("ルーム名が UTF-8 ではありません") from None
+    return Frame(room_name, operation, state, bytes(body[room_name_size:]))
+
+
+class FrameDecoder:
+    """受信したバイト列を順に渡すと完成したフレームを取り出す
+
+    ヘッダー1個分と max_frame_size のボディが入るバッファを最初に確保し、
+    受信したデータはその中に書き込む。1回の受信に複数のフレーム
+    (パイプライン化されたリクエスト) が含まれていても、途中で分割されて
+    いても、同じ順序で取り出せる。
+    initial (他のワーカーが受信済みのデータ) がバッファに収まらなければ、
+    残りは backlog に置いて、フレームを取り出して空いた所に移す。
+    """
+
+    def __init__(self, max_frame_size=DEFAULT_MAX_FRAME_SIZE, initial=b""):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray(HEADER_SIZE + max_frame_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # 未処理のデータの先頭
+        self.end = 0  # 未処理のデータの末尾
+        self.backlog = memoryview(
+            bytes(initial)
+        )  # バッファに入りきらない受信済みのデータ
+        self._refill()
+
+    def feed(self, data):
+        """受信したデータを追加し、完成したフレームを全て取り出す
+
+        バッファに収まらない分は、フレームを取り出して空いた所に書き込む。
+        """
+        frames = []
+        data = memoryview(data)
+        while True:
+            self._compact()
+            size = min(len(data), len(self.buffer) - self.end)
+            self._write(data[:size])
+            data = data[size:]
+            frames.extend(self.frames())
+            if not data:
+                return frames
+
+    def _refill(self):
+        """backlog をバッファの空いている所に移す"""
+        self._compact()
+        size = min(len(self.backlog), len(self.buffer) - self.end)
+        self._write(self.backlog[:size])
+        self.backlog = self.backlog[size:]
+
+    def _write(self, data):
+        self.view[self.end : self.end + len(data)] = data
+        self.end += len(data)
+
+    def writable(self):
+        """recv_into で直接書き込める領域 (書いた後で advance を呼ぶ)"""
+        if self.backlog:
+            # 受信済みのデータより後に新しいデータを書く
+            self._refill()
+        if self.end == len(self.buffer):
+            self._compact()
+        return self.view[self.end :]
+
+    def advance(self, size):
+        self.end += size
+
+    def next_frame(self):
+        """完成したフレームを1つ取り出す (まだ揃っていなければ None)"""
+        frame = self._next_frame()
+        while frame is None and self.backlog:
+            self._refill()
+            frame = self._next_frame()
+        return frame
+
+    def _next_frame(self):
+        start = self.start
+        available = self.end - start
+        if available < HEADER_SIZE:
+            return None
+        room_name_size, operation, state, payload_size = parse_header(
+            self.buffer[start : start + HEADER_SIZE], self.max_frame_size
+        )
+        frame_size = HEADER_SIZE + room_name_size + payload_size
+        if available < frame_size:
+            return None
+
+        name_start = start + HEADER_SIZE
+        payload_start = name_start + room_name_size
+        try:
+            room_name = self.buffer[name_start:payload_start].decode("utf-8")
+        except UnicodeDecodeError:
+            raise FrameError("ルーム名が UTF-8 ではありません") from None
+        payload = bytes(self.view[payload_start : start + frame_size])
+        self.start = start + frame_size
+        return Frame(room_name, operation, state, payload)
+
+    def frames(self):
+        """完成しているフレームを全て取り出す"""
+        frames = []
+        while (frame := self.next_frame()) is not None:
+            frames.append(frame)
+        return frames
+
+    def take(self, size):
+        """フレーム以外のデータ (UDP ポートの2バイトなど) を size バイト取り出す"""
+        if self.end - self.start < size and self.backlog:
+            self._refill()
+        if self.end - self.start < size:
+            return None
+        data = bytes(self.view[self.start : self.start + size])
+        self.start += size
+        return data
+
+    def pending(self):
+        """まだフレームとして取り出していないデータ"""
+        return bytes(self.view[self.start : self.end]) + self.backlog
+
+    def __len__(self):
+        return self.end - self.start + len(self.backlog)
+
+    def _compact(self):
+        """未処理のデータをバッファの先頭に移す"""
+        size = self.end - self.start
+        if self.start:
+            self.view[:size] = self.view[self.start : self.end]
+        self.start = 0
+        self.end = size
+
+
+class FrameReader:
+    """ブロッキングソケットからフレームを読む
+
+    1回の recv_into で届いている分をまとめて FrameDecoder のバッファに読み込み、
+    フレームが揃うまで読み足す。ソケットのタイムアウトはそのまま例外になる。
+    """
+
+    def __init__(self, sock, max_frame_size=DEFAULT_MAX_FRAME_SIZE, initial=b""):
+        self.sock = sock
+        self.decoder = FrameDecoder(max_frame_size, initial)
+
+    def read(self):
+        """次のフレームを返す (フレームの境目で切断されたら None)"""
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is not None:
+                return frame
+            if not self._fill():
+                if len(self.decoder):
+                    raise FrameError("フレームの途中で切断されました")
+                return None
+
+    def read_exact(self, size):
+        """フレーム以外のデータを size バイト読む (途中で切断されたら None)"""
+        while True:
+            data = self.decoder.take(size)
+            if data is not None:
+                return data
+            if not self._fill():
+                return None
+
+    def pending(self):
+        """読み込み済みでまだ取り出していないデータ (接続を引き渡すときに添える)"""
+        return self.decoder.pending()
+
+    def _fill(self):
+        received = self.sock.recv_into(self.decoder.writable())
+        self.decoder.advance(received)
+        return received > 0
+
+
+class AsyncFrameReader:
+    """asyncio.StreamReader からフレームを読む
+
+    FrameReader と同じく、届いている分をまとめて FrameDecoder に読み込む。
+    initial は他のワーカーが受信済みのデータで、StreamReader より先に読む。
+    """
+
+    def __init__(self, reader, max_frame_size=DEFAULT_MAX_FRAME_SIZE, initial=b""):
+        self.reader = reader
+        self.decoder = FrameDecoder(max_frame_size, initial)
+
+    async def read(self):
+        """次のフレームを返す (フレームの境目で切断されたら None)"""
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is not None:
+                return frame
+            if not await self._fill():
+                if len(self.decoder):
+                    raise FrameError("フレームの途中で切断されました")
+                return None
+
+    async def read_exact(self, size):
+        """フレーム以外のデータを size バイト読む (途中で切断されたら IncompleteReadError)"""
+        while True:
+            data = self.decoder.take(size)
+            if data is not None:
+                return data
+            if not await self._fill():
+                raise asyncio.IncompleteReadError(self.decoder.pending(), size)
+
+    def pending(self):
+        """読み込み済みでまだ取り出していないデータ (接続を引き渡すときに添える)"""
+        return self.decoder.pending()
+
+    async def _fill(self):
+        writable = self.decoder.writable()
+        data = await self.reader.read(len(writable))
+        writable[: len(data)] = data
+        self.decoder.advance(len(data))
+        return len(data) > 0
@@ -0,0 +1,98 @@
+import threading
+
+from framing import DEFAULT_MAX_FRAME_SIZE
+
+# 既定値 (1ルームあたり)
+DEFAULT_HISTORY_MESSAGES = 200
+DEFAULT_HISTORY_BYTES = 64 * 1024
+# 1件の上限 (HISTORY の応答の1フレームにルーム名や他の項目と一緒に収まる大きさ)
+MAX_ENTRY_BYTES = DEFAULT_MAX_FRAME_SIZE - 1024
+TRUNCATED_MARK = "…".encode("utf-8")
+
+
+class MessageHistory:
+    """ルームの最近のメッセージを保持する固定長のリングバッファ
+
+    最初に max_messages 個の枠を確保し、古いものから上書きする。合計が
+    max_bytes を超える場合も古いものから捨てる。メッセージには 1 から始まる
+    連番を付けるので、参加し直したクライアントは「最後に見た連番の次から」を
+    要求できる。
+    max_entry_bytes を超えるメッセージは、その長さに切り詰めて末尾に TRUNCATED_MARK を付ける。
+    """
+
+    def __init__(
+        self,
+        max_messages=DEFAULT_HISTORY_MESSAGES,
+        max_bytes=DEFAULT_HISTORY_BYTES,
+        max_entry_bytes=MAX_ENTRY_BYTES,
+    ):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.slots = [None] * max_messages
+        self.start = 0  # 最も古いメッセージの枠
+        self.count = 0
+        self.size = 0  # 保持しているメッセージの合計バイト数
+        self.first_seq = 1  # 最も古いメッセージの連番
+        self.lock = threading.Lock()
+
+    @property
+    def next_seq(self):
+        """次に追加されるメッセージの連番"""
+        return self.first_seq + self.count
+
+    def append(self, message):
+        """メッセージ (受信バッファを使い回すこともあるのでコピーする) を追加して連番を返す"""
+        message = bytes(message)
+        if len(message) > self.max_entry_bytes:
+            message = truncate(message, self.max_entry_bytes)
+        with self.lock:
+            seq = self.next_seq
+            if len(message) > self.max_bytes:
+                # 1件で上限を超えるものは保持しない (連番だけ進める)
+                self._clear(seq + 1)
+                return seq
+            while self.count and (
+                self.count == self.max_messages
+                or self.size + len(message) > self.max_bytes
+            ):
+                self._drop_oldest()
+            self.slots[(self.start + self.count) % self.max_messages] = message
+            self.count += 1
+            self.size += len(message)
+        return seq
+
+    def query(self, since=None, before=None, limit=None):
+        """連番が since 以上 before 未満のメッセージを、新しい方から最大 limit 件返す
+
+        戻り値は (最も古い連番, 次の連番, [(連番, メッセージ)]) で、メッセージは古い順。
+        """
+        with self.lock:
+            first_seq, next_seq = self.first_seq, self.next_seq
+            low = first_seq if since is None else max(since, first_seq)
+            high = next_seq if before is None else min(before, next_seq)
+            if limit is not None:
+                low = max(low, high - limit)
+            messages = [
+                (seq, self.slots[(self.start + seq - first_seq) % self.max_messages])
+                for seq in range(low, high)
+            ]
+        return first_seq, next_seq, messages
+
+    def _drop_oldest(self):
+        self.size -= len(self.slots[self.start])
+        self.slots[self.start] = None
+        self.start = (self.start + 1) % self.max_messages
+        self.count -= 1
+        self.first_seq += 1
+
+    def _clear(self, first_seq):
+        self.slots = [None] * self.max_messages
+        self.start = self.count = self.size = 0
+        self.first_seq = first_seq
+
+
+def truncate(message, size):
+    """UTF-8 のメッセージを size バイト以下に (文字の途中で切らずに) 切り詰める"""
+    body = message[: size - len(TRUNCATED_MARK)]
+    return body.decode("utf-8", "ignore").encode("utf-8") + TRUNCATED_MARK
@@ -0,0 +1,118 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+# ログ設定
+DEFAULT_LOG_LEVEL = "INFO"
+DEFAULT_LOG_QUEUE_SIZE = 10000
+DEFAULT_LOG_SAMPLE_RATE = 100  # メッセージ単位のログは N 件に1件だけ出力する
+
+# LogRecord が標準で持つ属性 (これ以外は extra で渡された項目として出力する)
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_listener = None
+
+
+class StructuredFormatter(logging.Formatter):
+    """extra で渡された項目を key=value または JSON で出力する"""
+
+    def __init__(self, json_output=False):
+        super().__init__("%(asctime)s %(levelname)s %(message)s")
+        self.json_output = json_output
+
+    def format(self, record):
+        fields = {
+            key: value
+            for key, value in vars(record).items()
+            if key not in _RECORD_ATTRIBUTES
+        }
+        if self.json_output:
+            entry = {
+                "time": record.created,
+                "level": record.levelname,
+                "pid": record.process,
+                "message": record.getMessage(),
+                **fields,
+            }
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+
+        line = super().format(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """キューが一杯なら待たずにレコードを捨てる QueueHandler"""
+
+    def __init__(self, log_queue, on_drop=None):
+        super().__init__(log_queue)
+        self.on_drop = on_drop
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.on_drop is not None:
+                self.on_drop()
+
+
+class Sampler:
+    """N 回に1回だけ True を返す (メッセージ単位のログの間引き用)"""
+
+    def __init__(self, rate=DEFAULT_LOG_SAMPLE_RATE):
+        self.rate = max(1, rate)
+        self.count = self.rate - 1  # 最初の1件は必ず出力する
+
+    def hit(self):
+        self.count += 1
+        if self.count >= self.rate:
+            self.count = 0
+            return True
+        return False
+
+
+def configure_logging(
+    level=DEFAULT_LOG_LEVEL,
+    json_output=False,
+    queue_size=DEFAULT_LOG_QUEUE_SIZE,
+    on_drop=None,
+    stream=None,
+):
+    """ルートロガーにキュー経由のハンドラーを設定する
+
+    ログの整形と書き込みは QueueListener のスレッドで行うので、標準出力が
+    遅いパイプでも呼び出し元はキューに積むだけで戻る。
+    fork した子プロセスでは QueueListener のスレッドが引き継がれないため、
+    子プロセス側で作り直す。
+    """
+    stream_handler = logging.StreamHandler(stream or sys.stdout)
+    stream_handler.setFormatter(StructuredFormatter(json_output))
+
+    def start_listener():
+        global _listener
+        log_queue = queue.Queue(queue_size)
+        handler = DroppingQueueHandler(log_queue, on_drop)
+        root = logging.getLogger()
+        for old_handler in list(root.handlers):
+            root.removeHandler(old_handler)
+        root.addHandler(handler)
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        _listener.start()
+
+    logging.getLogger().setLevel(level)
+    start_listener()
+    os.register_at_fork(after_in_child=start_listener)
+
+
+def shutdown_logging():
+    """キューに残ったログを書き出してからスレッドを止める"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
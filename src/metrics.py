@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+import time
+
+# サーバーが数えるカウンター
+COUNTERS = (
+    "messages_in",  # 受信したデータグラム数
+    "bytes_in",
+    "messages_out",  # 送信したデータグラム数 (宛先ごとに1件)
+    "bytes_out",
+    "dropped_datagrams",  # 形式不正・未登録のセッションなどで捨てたデータグラム数
+    "address_index_misses",  # 送信元アドレスから送信者を引けなかったデータグラム数
+    "heartbeats",  # 受け付けた UDP のハートビート数
+    "heartbeat_timeouts",  # ハートビートが途絶えて退出させた参加者数
+    "send_errors",
+    "send_queue_drops",  # 宛先ごとの送信待ちキューが一杯で捨てたデータグラム数
+    "send_queue_coalesced",  # 送信待ちの ACK・再送を新しいもので置き換えた数
+    "compressed_messages",  # 圧縮して送ったメッセージ数 (ブロードキャストごとに1件)
+    "fragmented_messages",  # 1データグラムに収まらず分割して送ったメッセージ数
+    "reassembly_drops",  # 揃わなかった・展開できなかった分割メッセージ数
+    "auth_failures",
+    "server_busy",
+    "rooms_created",
+    "members_joined",
+    "retransmits",  # 信頼性レイヤーで再送したデータグラム数
+    "retransmit_giveups",  # 再送回数・保持数の上限を超えて諦めたメッセージ数
+    "duplicate_datagrams",  # 信頼性レイヤーで捨てた重複データグラム数
+    "sequence_gaps",  # 送信側が諦めたため飛ばした連番の数
+    "rate_limited_address",  # 送信元アドレスの流量制限で捨てたデータグラム数
+    "rate_limited_member",  # 参加者の流量制限で捨てたデータグラム数
+    "rate_limit_evictions",  # 流量制限の表が一杯で使用中のバケットを上書きした数
+    "state_log_records",  # 状態ログに書き込んだ記録数
+    "state_log_commits",  # 状態ログの書き込み (fsync) 回数
+    "log_records_dropped",  # ログのキューが一杯で捨てた件数
+)
+
+
+class Metrics:
+    """スレッドごとに分けて数えるカウンター
+
+    increment はスレッド専用の dict を更新するだけなのでロックを取らない。
+    snapshot で全スレッドの値を合計する。終了したスレッドの値は retired に
+    まとめるので、接続ごとにスレッドを作っても dict は増え続けない。
+    """
+
+    def __init__(self, names=COUNTERS):
+        self.names = names
+        self.local = threading.local()
+        self.shards = []
+        """[(Thread, {name: value})]"""
+        self.retired = dict.fromkeys(names, 0)
+        self.lock = threading.Lock()
+        self.gauges = {}
+        """{name: 現在値を返す関数}"""
+        self.started_at = time.time()
+
+    def increment(self, name, value=1):
+        try:
+            counters = self.local.counters
+        except AttributeError:
+            counters = self._new_shard()
+        counters[name] += value
+
+    def add_gauge(self, name, read):
+        """snapshot のたびに read() の値を出力する"""
+        self.gauges[name] = read
+
+    def snapshot(self):
+        """全カウンターとゲージの現在値"""
+        with self.lock:
+            self._retire_finished()
+            totals = dict(self.retired)
+            shards = [counters for _, counters in self.shards]
+        for counters in shards:
+            for name, value in counters.items():
+                totals[name] += value
+
+        for name, read in self.gauges.items():
+            try:
+                totals[name] = read()
+            except Exception:
+                totals[name] = None
+
+        totals["pid"] = os.getpid()
+        totals["uptime"] = time.time() - self.started_at
+        return totals
+
+    def write(self, path):
+        """snapshot を JSON でファイルに書き出す (書き終えてから置き換える)"""
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False)
+        os.replace(temporary_path, path)
+
+    def start_exporter(self, path, interval):
+        """interval 秒ごとに path へ書き出すデーモンスレッドを起動"""
+
+        def export():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write(path)
+                except OSError:
+                    pass
+
+        thread = threading.Thread(target=export, daemon=True)
+        thread.start()
+        return thread
+
+    def _new_shard(self):
+        counters = self.local.counters = dict.fromkeys(self.names, 0)
+        with self.lock:
+            self._retire_finished()
+            self.shards.append((threading.current_thread(), counters))
+        return counters
+
+    def _retire_finished(self):
+        """終了したスレッドの値を retired に移す (lock を取得した状態で呼び出す)"""
+        alive = []
+        for thread, counters in self.shards:
+            if thread.is_alive():
+                alive.append((thread, counters))
+                continue
+            for name, value in counters.items():
+                self.retired[name] += value
+        self.shards = alive
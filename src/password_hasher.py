@@ -0,0 +1,86 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import bcrypt
+
+# bcrypt 設定
+DEFAULT_BCRYPT_ROUNDS = 12
+DEFAULT_HASH_WORKERS = 4
+DEFAULT_ROOM_ADMISSION_LIMIT = 8  # 1ルームあたりの同時ハッシュ処理数
+
+
+class AdmissionError(Exception):
+    """ルームごとの同時ハッシュ処理数の上限を超えた"""
+
+
+def hash_password(password, rounds=DEFAULT_BCRYPT_ROUNDS):
+    """パスワードをハッシュ化する"""
+    password_bytes = password.encode("utf-8")
+    hashed = bcrypt.hashpw(password_bytes, bcrypt.gensalt(rounds)).decode("utf-8")
+    return hashed
+
+
+def verify_password(plain_password, hashed_password):
+    """ハッシュ化されたパスワードを検証する"""
+    password_bytes = plain_password.encode("utf-8")
+    if isinstance(hashed_password, str):
+        hashed_password = hashed_password.encode("utf-8")
+    result = bcrypt.checkpw(password_bytes, hashed_password)
+    return result
+
+
+class PasswordHasher:
+    """bcrypt の処理をワーカープールで実行する
+
+    hash / verify は concurrent.futures.Future を返すので、スレッドからは
+    result() で、asyncio からは asyncio.wrap_future() で待機できる。
+    """
+
+    def __init__(
+        self,
+        workers=DEFAULT_HASH_WORKERS,
+        use_processes=False,
+        rounds=DEFAULT_BCRYPT_ROUNDS,
+        room_admission_limit=DEFAULT_ROOM_ADMISSION_LIMIT,
+    ):
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self.executor = executor_class(max_workers=workers)
+        self.rounds = rounds
+        self.room_admission_limit = room_admission_limit
+        self.pending = {}
+        """{room_name: 処理中の件数}"""
+        self.pending_lock = threading.Lock()
+
+    def hash(self, room_name, password):
+        """パスワードのハッシュ化を投入"""
+        return self._submit(room_name, hash_password, password, self.rounds)
+
+    def verify(self, room_name, plain_password, hashed_password):
+        """パスワードの検証を投入"""
+        return self._submit(room_name, verify_password, plain_password, hashed_password)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, room_name, fn, *args):
+        with self.pending_lock:
+            count = self.pending.get(room_name, 0)
+            if count >= self.room_admission_limit:
+                raise AdmissionError(room_name)
+            self.pending[room_name] = count + 1
+
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self._release(room_name)
+            raise
+        future.add_done_callback(lambda _: self._release(room_name))
+        return future
+
+    def _release(self, room_name):
+        with self.pending_lock:
+            count = self.pending.get(room_name, 0) - 1
+            if count > 0:
+                self.pending[room_name] = count
+            else:
+                self.pending.pop(room_name, None)
@@ -0,0 +1,89 @@
+from array import array
+
+# 既定値
+DEFAULT_MEMBER_RATE = 50.0  # 1参加者あたりの毎秒のデータグラム数
+DEFAULT_MEMBER_BURST = 100  # 続けて送れるデータグラム数
+DEFAULT_ADDRESS_RATE = 100.0  # 1送信元アドレスあたり
+DEFAULT_ADDRESS_BURST = 200
+DEFAULT_MAX_ENTRIES = 1 << 18  # 表ごとのバケット数の上限 (1件 16 バイト)
+DEFAULT_WAYS = 8  # 1つのキーを置ける枠の数 (探索する枠の上限)
+
+KEY_MASK = (1 << 64) - 1
+
+
+class RateLimiter:
+    """キーごとのトークンバケット (GCRA で1バケットを浮動小数1個で表す)
+
+    バケットはオブジェクトを作らず、キー (64 ビット整数) と「理論上の次の到着時刻」
+    (TAT) を固定長の配列に持つ。1件 16 バイトなので max_entries を 100 万にしても
+    16 MiB で収まる。キーはハッシュ値の位置から ways 個の枠のどこかに置く。
+
+    TAT が現在時刻より前のバケットは満タンと同じなので、捨てても結果は変わらない。
+    新しいキーはそうした空き同然の枠 (無ければ最も満タンに近い枠) を上書きするので、
+    掃除をしなくても使われなくなったバケットから順に再利用される。
+
+    ロックは取らない。複数のスレッドから同時に呼ばれると、まれに同じ枠を
+    上書きし合ってバケットが満タンに戻ることがあるが、制限が緩むだけで済む。
+    """
+
+    def __init__(
+        self,
+        rate,
+        burst,
+        max_entries=DEFAULT_MAX_ENTRIES,
+        ways=DEFAULT_WAYS,
+        on_evict=None,
+    ):
+        capacity = 1
+        while capacity < max(max_entries, ways):
+            capacity <<= 1
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.ways = ways
+        self.interval = 1.0 / rate  # 1件あたりに消費する時間
+        self.limit = self.interval * burst  # TAT が現在時刻より先に進んでよい幅
+        self.keys = array("Q", bytes(8 * capacity))  # 0 は空き
+        self.tats = array("d", bytes(8 * capacity))
+        self.on_evict = on_evict  # 使用中のバケットを上書きしたときに呼ぶ
+
+    def allow(self, key, now):
+        """key のバケットから1件分を取り出せれば True (now は time.monotonic())"""
+        key &= KEY_MASK
+        if key == 0:
+            key = 1
+        keys = self.keys
+        tats = self.tats
+        mask = self.mask
+        slot = key & mask
+
+        victim = slot
+        victim_tat = float("inf")
+        for _ in range(self.ways):
+            if keys[slot] == key:
+                tat = tats[slot]
+                if tat < now:
+                    tat = now
+                tat += self.interval
+                if tat - now > self.limit:
+                    return False
+                tats[slot] = tat
+                return True
+            tat = tats[slot]
+            if tat < victim_tat:
+                victim, victim_tat = slot, tat
+            slot = (slot + 1) & mask
+
+        # 無ければ最も満タンに近い枠を使う (空きの TAT は 0)
+        if victim_tat > now and self.on_evict is not None:
+            self.on_evict()
+        keys[victim] = key
+        tats[victim] = now + self.interval
+        return True
+
+    def active(self, now):
+        """使用中 (満タンでない) のバケット数 (全ての枠を見るので統計用)"""
+        return sum(1 for tat in self.tats if tat > now)
+
+    def memory(self):
+        """配列が使うバイト数"""
+        return self.keys.itemsize * len(self.keys) + self.tats.itemsize * len(self.tats)
@@ -0,0 +1,184 @@
+import struct
+import threading
+from collections import OrderedDict
+
+# 信頼性レイヤーのパケット種別 (UDP のメッセージ本文の先頭に付ける)
+RELIABLE_DATA = 1
+RELIABLE_ACK = 2
+
+# DATA: 種別, 連番, base (送信側がまだ再送できる最古の連番) + メッセージ
+DATA_HEADER = struct.Struct("!BII")
+# ACK: 種別, 次に必要な連番 (それより前は全て受信済み), 選択的 ACK のビットマップ
+ACK_PACKET = struct.Struct("!BII")
+SACK_BITS = 32  # ビット i は「次に必要な連番 + 1 + i」を受信済み
+
+# 既定値
+DEFAULT_WINDOW = 64  # 1参加者あたりの未確認メッセージ・並べ替え待ちメッセージの上限
+RETRANSMIT_TIMEOUT = 0.2  # 最初の再送までの秒数 (再送のたびに2倍)
+MAX_RETRANSMIT_TIMEOUT = 2.0
+MAX_RETRANSMITS = 8  # これを超えたら諦める
+RETRANSMIT_INTERVAL = 0.05  # 再送が必要なメッセージを確認する間隔
+
+
+def _ignore(name, value=1):
+    pass
+
+
+def coalesce_key(packet):
+    """送信待ちのパケットを置き換えてよいかの判定に使う値
+
+    ACK は新しいものだけ送ればよいので種別だけ、DATA は同じ連番の再送同士を置き換える。
+    """
+    if packet[0] == RELIABLE_ACK:
+        return RELIABLE_ACK
+    return bytes(packet[: 1 + 4])
+
+
+class ReliableSender:
+    """連番を付けて送り、ACK が届くまで保持して再送する
+
+    保持するのは最大 window 件。溢れたら最も古いものを諦める。
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, count=_ignore, first_seq=1):
+        self.window = window
+        self.count = count
+        self.next_seq = first_seq
+        self.unacked = OrderedDict()
+        """{連番: [パケット, 再送期限, 再送回数]}"""
+
+    def wrap(self, payload, now):
+        """payload に DATA ヘッダーを付けたパケットを返す (再送用に保持する)"""
+        if len(self.unacked) >= self.window:
+            self.unacked.popitem(last=False)
+            self.count("retransmit_giveups")
+
+        seq = self.next_seq
+        self.next_seq += 1
+        base = next(iter(self.unacked), seq)
+        packet = DATA_HEADER.pack(RELIABLE_DATA, seq, base) + payload
+        self.unacked[seq] = [packet, now + RETRANSMIT_TIMEOUT, 0]
+        return packet
+
+    def on_ack(self, cumulative, bitmap):
+        """ACK で確認された連番を再送対象から外す"""
+        unacked = self.unacked
+        while unacked and next(iter(unacked)) < cumulative:
+            unacked.popitem(last=False)
+        while bitmap:
+            lowest = bitmap & -bitmap
+            unacked.pop(cumulative + lowest.bit_length(), None)
+            bitmap ^= lowest
+
+    def due(self, now):
+        """再送期限が来たパケットのリスト (再送回数の上限を超えたものは諦める)"""
+        packets = []
+        for seq, entry in list(self.unacked.items()):
+            packet, deadline, retries = entry
+            if deadline > now:
+                continue
+            if retries >= MAX_RETRANSMITS:
+                del self.unacked[seq]
+                self.count("retransmit_giveups")
+                continue
+            entry[1] = now + min(
+                RETRANSMIT_TIMEOUT * 2 ** (retries + 1), MAX_RETRANSMIT_TIMEOUT
+            )
+            entry[2] = retries + 1
+            packets.append(packet)
+        if packets:
+            self.count("retransmits", len(packets))
+        return packets
+
+
+class ReliableReceiver:
+    """重複を捨て、連番の順に並べ替えて取り出す
+
+    先に届いたメッセージは最大 window 件まで保持する。送信側が諦めた連番
+    (DATA の base より前) は待たずに飛ばす。
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, count=_ignore):
+        self.window = window
+        self.count = count
+        self.expected = 1  # 次に取り出す連番
+        self.buffer = {}
+        """{連番: メッセージ} 先に届いたもの"""
+
+    def receive(self, seq, base, payload):
+        """DATA を受け取り、順番どおりに取り出せるメッセージのリストを返す"""
+        delivered = []
+        if base > self.expected:
+            # 送信側が再送を諦めた分は飛ばす
+            for buffered_seq in sorted(s for s in self.buffer if s < base):
+                delivered.append(self.buffer.pop(buffered_seq))
+            self.count("sequence_gaps", base - self.expected - len(delivered))
+            self.expected = base
+
+        if seq < self.expected or seq in self.buffer:
+            self.count("duplicate_datagrams")
+            return delivered
+
+        if seq != self.expected:
+            if seq - self.expected <= self.window and len(self.buffer) < self.window:
+                # 受信バッファの datagram は使い回されるのでコピーして保持する
+                self.buffer[seq] = bytes(payload)
+            return delivered
+
+        delivered.append(payload)
+        self.expected += 1
+        while self.expected in self.buffer:
+            delivered.append(self.buffer.pop(self.expected))
+            self.expected += 1
+        return delivered
+
+    def ack(self):
+        """受信状況を伝える ACK パケット"""
+        bitmap = 0
+        for seq in self.buffer:
+            offset = seq - self.expected - 1
+            if 0 <= offset < SACK_BITS:
+                bitmap |= 1 << offset
+        return ACK_PACKET.pack(RELIABLE_ACK, self.expected, bitmap)
+
+
+class ReliableChannel:
+    """1つの相手との双方向の信頼性レイヤー (送信側と受信側をまとめてロックする)
+
+    count(name, value) には再送・諦め・重複・欠落の件数が通知される。
+    first_seq は送信する最初の連番 (相手の受信側は base を見てそこまで飛ばす)。
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, count=_ignore, first_seq=1):
+        self.sender = ReliableSender(window, count, first_seq)
+        self.receiver = ReliableReceiver(window, count)
+        self.lock = threading.Lock()
+
+    def wrap(self, payload, now):
+        with self.lock:
+            return self.sender.wrap(payload, now)
+
+    def receive(self, packet):
+        """受信したパケットを処理して (取り出せたメッセージ, 返す ACK) を返す
+
+        ACK を受け取った場合と不正なパケットの場合は ([], None) を返す。
+        """
+        if len(packet) < DATA_HEADER.size:
+            return [], None
+        kind, first, second = DATA_HEADER.unpack_from(packet)
+        with self.lock:
+            if kind == RELIABLE_ACK:
+                self.sender.on_ack(first, second)
+                return [], None
+            if kind != RELIABLE_DATA:
+                return [], None
+            delivered = self.receiver.receive(first, second, packet[DATA_HEADER.size :])
+            return delivered, self.receiver.ack()
+
+    def due(self, now):
+        with self.lock:
+            return self.sender.due(now)
+
+    def pending(self):
+        """ACK を待っているメッセージがあるか"""
+        return bool(self.sender.unacked)
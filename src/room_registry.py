@@ -0,0 +1,349 @@
+import secrets
+import threading
+import time
+
+from history import DEFAULT_HISTORY_BYTES, DEFAULT_HISTORY_MESSAGES, MessageHistory
+
+# セッションID (4バイトのルームID + 8バイトの参加者ID)
+ROOM_ID_BITS = 32
+MEMBER_ID_BITS = 64
+SESSION_ID_SIZE = (ROOM_ID_BITS + MEMBER_ID_BITS) // 8
+MEMBER_ID_MASK = (1 << MEMBER_ID_BITS) - 1
+
+
+def session_id(member):
+    """参加者のセッションID (上位がルームID、下位が参加者ID)"""
+    return (member.room.room_id << MEMBER_ID_BITS) | member.member_id
+
+
+class Member:
+    """ルーム参加者
+
+    参加者は数十万件になり得るので、__slots__ で属性の dict を持たせない。
+    """
+
+    __slots__ = (
+        "token",
+        "username",
+        "address",
+        "prefix",
+        "last_active",
+        "heartbeat",
+        "member_id",
+        "room",
+        "reliable",
+        "envelope",
+        "compression",
+        "reassembler",
+        "joined_seq",
+    )
+
+    def __init__(self, token, username, address):
+        self.token = token
+        self.username = username
+        self.address = address
+        # 発言に付ける送信者名 (発言のたびに encode しないように参加時に作る)
+        self.prefix = f"{username}: ".encode("utf-8")
+        self.last_active = time.time()
+        self.heartbeat = False  # UDP のハートビートを受け取ったか (期限が短くなる)
+        self.member_id = None  # ルームに追加したときに割り当てる (members のキー)
+        self.room = None  # 追加したルーム
+        self.reliable = None  # 信頼性レイヤーを使う場合は ReliableChannel
+        self.envelope = False  # メッセージに型付きのヘッダー (envelope.py) を付けるか
+        self.compression = False  # 長いメッセージを圧縮・分割するか (envelope と併用)
+        self.reassembler = None  # compression を使う場合は受信用の Reassembler
+        # 参加した時点の履歴の次の連番 (これより前が参加前の発言)
+        self.joined_seq = None
+
+
+class Room:
+    """チャットルーム
+
+    members の読み書きは lock を取得して行う。ルームごとにロックを持つので
+    別のルームの処理とは競合しない。
+    members や参加者のアドレスを変更したら addresses を None に戻して、
+    ブロードキャスト先のタプルを作り直させる。
+    """
+
+    __slots__ = (
+        "room_id",
+        "name",
+        "host_token",
+        "password",
+        "members",
+        "lock",
+        "closed",
+        "addresses",
+        "envelope_addresses",
+        "compressed_addresses",
+        "reliable_members",
+        "history",
+    )
+
+    def __init__(self, room_id, name, host_token, password, history=None):
+        self.room_id = room_id
+        self.name = name
+        self.host_token = host_token
+        self.password = password  # ハッシュ化したパスワード
+        self.members = {}
+        """{member_id: Member}"""
+        self.lock = threading.Lock()
+        self.closed = False
+        self.addresses = None  # 参加者のアドレスのタプル (None なら作り直す)
+        # 以下は addresses と一緒に作る
+        self.envelope_addresses = ()  # 型付きのヘッダーを付けて送る参加者のアドレス
+        self.compressed_addresses = ()  # さらに圧縮・分割して送る参加者のアドレス
+        self.reliable_members = ()  # 信頼性レイヤーを使う参加者
+        self.history = history  # 最近のメッセージ (MessageHistory、無効なら None)
+
+    def add_member(self, member):
+        """参加者を追加 (閉じられたルームには追加しない)"""
+        with self.lock:
+            if self.closed:
+                return False
+            if self.history is not None:
+                member.joined_seq = self.history.next_seq
+            self.insert(member)
+            return True
+
+    def insert(self, member):
+        """ルーム内で重ならない参加者IDを割り当てて追加 (lock を取得した状態で呼び出す)"""
+        member_id = secrets.randbits(MEMBER_ID_BITS)
+        while member_id in self.members:
+            member_id = secrets.randbits(MEMBER_ID_BITS)
+        member.member_id = member_id
+        member.room = self
+        self.members[member_id] = member
+        self.addresses = None
+
+    def set_address(self, member, address):
+        """参加者の UDP アドレスを更新 (lock を取得した状態で呼び出す)"""
+        member.address = address
+        self.addresses = None
+
+    def enable_reliable(self, member, channel):
+        """参加者宛ての送信に信頼性レイヤーを使う (lock を取得した状態で呼び出す)"""
+        member.reliable = channel
+        self.addresses = None
+
+    def enable_envelope(self, member):
+        """参加者宛ての送信に型付きのヘッダーを付ける (lock を取得した状態で呼び出す)"""
+        member.envelope = True
+        self.addresses = None
+
+    def enable_compression(self, member):
+        """参加者宛ての長いメッセージを圧縮・分割する (lock を取得した状態で呼び出す)"""
+        member.compression = True
+        self.addresses = None
+
+    def recipient_addresses(self):
+        """信頼性レイヤーもヘッダーも使わない参加者のアドレス (lock を取得した状態で呼び出す)
+
+        参加者が変わるまで同じタプルを返すので、ブロードキャストのたびに
+        members をコピーせずに済む。タプルは変更しないのでロックの外で使ってよい。
+        それ以外の参加者は、呼び出した後の envelope_addresses / compressed_addresses /
+        reliable_members で参照する。
+        """
+        if self.addresses is None:
+            members = self.members.values()
+            plain = [m for m in members if m.reliable is None]
+            self.addresses = tuple(m.address for m in plain if not m.envelope)
+            self.envelope_addresses = tuple(
+                m.address for m in plain if m.envelope and not m.compression
+            )
+            self.compressed_addresses = tuple(m.address for m in plain if m.compression)
+            self.reliable_members = tuple(m for m in members if m.reliable is not None)
+        return self.addresses
+
+    def recipients(self):
+        """(ヘッダーを付けない宛先, ヘッダーを付ける宛先, 圧縮する宛先, 信頼性レイヤーを使う参加者)
+
+        lock を取得した状態で呼び出す。
+        """
+        return (
+            self.recipient_addresses(),
+            self.envelope_addresses,
+            self.compressed_addresses,
+            self.reliable_members,
+        )
+
+
+class RoomRegistry:
+    """ルーム名から Room を引くための登録簿
+
+    registry のロックはルームの作成・削除のときだけ取得する。参照は dict の
+    get だけなので、メッセージ処理ではロックを取らない。
+    参加者はトークン・登録した UDP アドレスからも1回の dict 参照で引ける。
+    索引のキーには参加者が持っているオブジェクトをそのまま使い、値は Member
+    (ルームは Member.room) にして、参加者ごとに増えるオブジェクトを索引の
+    エントリーだけにする。セッションIDからはルームIDでルームを引き、
+    参加者IDで Room.members を引く。
+    ルームIDは room_id_start から room_id_step ずつ割り当てる (複数ワーカー構成で
+    ルームIDから担当ワーカーを求められるようにするため)。
+    history_limits はルームごとの履歴の (件数, バイト数) の上限 (件数 0 で履歴なし)。
+    journal (StateLog) を設定すると、ルームと参加者の変更を記録する。
+    """
+
+    def __init__(
+        self,
+        room_id_start=1,
+        room_id_step=1,
+        history_limits=(DEFAULT_HISTORY_MESSAGES, DEFAULT_HISTORY_BYTES),
+    ):
+        self.rooms = {}
+        """{room_name: Room}"""
+        self.room_ids = {}
+        """{room_id: Room}"""
+        self.tokens = {}
+        """{token: Member}"""
+        self.by_address = {}
+        """{UDP アドレス: Member}  同じアドレスの参加者が複数いれば最後に登録したもの"""
+        self.lock = threading.Lock()
+        self.next_room_id = room_id_start
+        self.room_id_step = room_id_step
+        self.history_limits = history_limits
+        self.journal = None
+
+    def get(self, room_name):
+        return self.rooms.get(room_name)
+
+    def get_session(self, session_id):
+        """セッションIDから (Room, Member) を返す"""
+        room = self.room_ids.get(session_id >> MEMBER_ID_BITS)
+        if room is None:
+            return None
+        return _entry(room.members.get(session_id & MEMBER_ID_MASK))
+
+    def get_token(self, token):
+        """トークンから (Room, Member) を返す"""
+        return _entry(self.tokens.get(token))
+
+    def get_address(self, address):
+        """UDP アドレスから (Room, Member) を返す"""
+        return _entry(self.by_address.get(address))
+
+    def create(self, room_name, host_token, password, host):
+        """ルームを作成 (同名のルームが既にあれば None を返す)"""
+        with self.lock:
+            if room_name in self.rooms:
+                return None
+            room_id = self._next_room_id()
+            room = Room(room_id, room_name, host_token, password, self._new_history())
+            room.insert(host)
+            self.tokens[host.token] = host
+            self.rooms[room_name] = room
+            self.room_ids[room_id] = room
+            if self.journal is not None:
+                self.journal.room_created(room, host)
+            return room
+
+    def restore_room(self, room_id, room_name, host_token, password):
+        """記録から復元したルームを登録 (同名のルームが既にあれば None を返す)
+
+        参加者 (ホストを含む) は restore_member で追加する。
+        """
+        with self.lock:
+            if room_name in self.rooms:
+                return None
+            room = Room(room_id, room_name, host_token, password, self._new_history())
+            self.rooms[room_name] = room
+            self.room_ids[room_id] = room
+            # 復元したルームより後の ID から割り当てる
+            while self.next_room_id <= room_id:
+                self.next_room_id += self.room_id_step
+            return room
+
+    def restore_member(self, room, member, member_id):
+        """記録から復元した参加者を元のセッションIDで登録"""
+        with room.lock:
+            if member_id in room.members or member.token in self.tokens:
+                return False
+            member.member_id = member_id
+            member.room = room
+            room.members[member_id] = member
+            room.addresses = None
+        self.tokens[member.token] = member
+        # 記録した時点のアドレス (UDP の登録後ならそのアドレス) で引けるようにする
+        self.by_address[member.address] = member
+        return True
+
+    def add_member(self, room, member):
+        """参加者を追加 (閉じられたルームには追加しない)"""
+        if not room.add_member(member):
+            return False
+        self.tokens[member.token] = member
+        if self.journal is not None:
+            self.journal.member_joined(room, member)
+        return True
+
+    def remove_member(self, room, member):
+        """参加者を削除 (room.lock を取得した状態で呼び出す、退出済みなら None を返す)"""
+        if room.members.get(member.member_id) is not member:
+            return None
+        del room.members[member.member_id]
+        self._unindex(member)
+        room.addresses = None
+        if self.journal is not None:
+            self.journal.member_left(room, member)
+        return member
+
+    def set_address(self, room, member, address):
+        """参加者の UDP アドレスを更新して索引に登録 (room.lock を取得した状態で呼び出す)"""
+        self._unindex_address(member)
+        room.set_address(member, address)
+        if self.tokens.get(member.token) is member:
+            self.by_address[address] = member
+
+    def address_changed(self, room, member):
+        """参加者の UDP アドレスと信頼性レイヤーの設定を記録 (room.lock を取得した状態で呼び出す)"""
+        if self.journal is not None:
+            self.journal.member_address(room, member)
+
+    def remove(self, room):
+        """ルームを削除 (既に削除済みなら False を返す)"""
+        with self.lock:
+            if self.rooms.get(room.name) is not room:
+                return False
+            del self.rooms[room.name]
+            if self.room_ids.get(room.room_id) is room:
+                del self.room_ids[room.room_id]
+            if self.journal is not None:
+                self.journal.room_closed(room)
+
+        with room.lock:
+            room.closed = True
+            for member in room.members.values():
+                self._unindex(member)
+        return True
+
+    def _new_history(self):
+        if self.history_limits[0] > 0:
+            return MessageHistory(*self.history_limits)
+        return None
+
+    def _next_room_id(self):
+        # ID が一周した場合は、使われているルームIDを飛ばす
+        while True:
+            room_id = self.next_room_id % (1 << ROOM_ID_BITS)
+            self.next_room_id += self.room_id_step
+            if room_id not in self.room_ids:
+                return room_id
+
+    def _unindex(self, member):
+        if self.tokens.get(member.token) is member:
+            del self.tokens[member.token]
+        self._unindex_address(member)
+
+    def _unindex_address(self, member):
+        # 同じアドレスで後から登録した別の参加者の分は残す
+        if self.by_address.get(member.address) is member:
+            del self.by_address[member.address]
+
+    def snapshot(self):
+        """現在のルーム一覧"""
+        with self.lock:
+            return list(self.rooms.values())
+
+
+def _entry(member):
+    return (member.room, member) if member is not None else None
@@ -0,0 +1,145 @@
+import errno
+import socket
+import threading
+from collections import deque
+
+# 既定値
+DEFAULT_QUEUE_DEPTH = 64  # 1宛先あたりの送信待ちデータグラム数の上限
+DRAIN_RETRY_INTERVAL = 0.05  # 送信バッファが空くのを待つ間隔の上限
+
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+
+def _ignore(name, value=1):
+    pass
+
+
+class SendQueues:
+    """宛先ごとの送信待ちキュー
+
+    送信は常にノンブロッキングで行い、ソケットの送信バッファが一杯で送れなかった
+    データグラムだけを宛先ごとのキューに入れる。キューのある宛先への送信は順番を
+    保つためにキューの後ろに並べる。キューは送信スレッド (またはイベントループ) が drain で
+    宛先を1件ずつ順番に回って送る。
+    そのため1つの宛先に溜まった分が他の宛先の送信を待たせることはない。
+
+    - キューが max_depth を超えたら最も古いものを捨てる (drop-oldest)
+    - 同じ key のデータグラムが既に並んでいれば置き換える (coalesce。新しい ACK や
+      同じ連番の再送は古いものを送る意味がない)
+    - 宛先が到達不能などのエラーを返したら、その宛先のキューを全て捨てる
+
+    count(name, value) には捨てた件数・置き換えた件数・送信エラーの件数が通知される。
+    on_backlog はキューが空の状態から何か入ったときに (ロックの外で) 呼ばれるので、
+    イベントループではそこで送信可能になるのを待ち始める。
+    """
+
+    def __init__(self, sock, max_depth=DEFAULT_QUEUE_DEPTH, count=_ignore):
+        self.sock = sock
+        self.max_depth = max_depth
+        self.count = count
+        self.queues = {}
+        """{addr: deque([(データグラム, key)])}"""
+        self.order = deque()  # キューのある宛先 (drain で回る順番)
+        self.depth = 0  # 全宛先の送信待ちの合計
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.on_backlog = None
+
+    def send(self, data, addr, key=None):
+        """data を addr に送信 (送れなければキューに入れる)"""
+        if addr not in self.queues:
+            try:
+                self.sock.sendto(data, _MSG_DONTWAIT, addr)
+                return
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.count("send_errors")
+                return
+        self.enqueue(bytes(data), (addr,), key)
+
+    def backlogged(self, addrs):
+        """addrs をキューのある宛先とそれ以外に分ける"""
+        queues = self.queues
+        if not queues:
+            return (), addrs
+        queued = [addr for addr in addrs if addr in queues]
+        if not queued:
+            return (), addrs
+        return queued, [addr for addr in addrs if addr not in queues]
+
+    def enqueue(self, data, addrs, key=None):
+        """data (bytes。複数の宛先で共有する) を addrs のそれぞれのキューに入れる"""
+        if self.max_depth <= 0:
+            self.count("send_queue_drops", len(addrs))
+            return
+        with self.lock:
+            was_empty = not self.depth
+            for addr in addrs:
+                queue = self.queues.get(addr)
+                if queue is None:
+                    queue = self.queues[addr] = deque()
+                    self.order.append(addr)
+                elif key is not None and self._coalesce(queue, data, key):
+                    continue
+                elif len(queue) >= self.max_depth:
+                    queue.popleft()
+                    self.depth -= 1
+                    self.count("send_queue_drops")
+                queue.append((data, key))
+                self.depth += 1
+            self.ready.notify()
+        if was_empty and self.on_backlog is not None:
+            self.on_backlog()
+
+    def _coalesce(self, queue, data, key):
+        for i, (_, queued_key) in enumerate(queue):
+            if queued_key == key:
+                queue[i] = (data, key)
+                self.count("send_queue_coalesced")
+                return True
+        return False
+
+    def wait(self, timeout=None):
+        """キューに何か入るまで待つ (送信スレッド用)"""
+        with self.lock:
+            if not self.depth:
+                self.ready.wait(timeout)
+            return self.depth > 0
+
+    def drain(self):
+        """送信バッファが一杯になるまで、宛先を順番に回って1件ずつ送信
+
+        全て送れたら True を返す。
+        """
+        with self.lock:
+            order = self.order
+            while order:
+                addr = order[0]
+                queue = self.queues[addr]
+                data, _ = queue[0]
+                try:
+                    self.sock.sendto(data, _MSG_DONTWAIT, addr)
+                except BlockingIOError:
+                    return False
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    # この宛先には送れないので残りも捨てる
+                    self.count("send_errors", len(queue))
+                    self.depth -= len(queue)
+                    queue.clear()
+                else:
+                    queue.popleft()
+                    self.depth -= 1
+                order.popleft()
+                if queue:
+                    order.append(addr)
+                else:
+                    del self.queues[addr]
+            return True
+
+    def deepest(self):
+        """最も多く溜まっている宛先の件数 (統計用)"""
+        with self.lock:
+            return max(map(len, self.queues.values()), default=0)
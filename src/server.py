@@ -1,449 +1,1642 @@
+import argparse
+import asyncio
+import hmac
+import itertools
+import logging
+import os
+import select
+import signal
 import socket
 import threading
 import uuid
 import time
 import json
-import bcrypt
+from concurrent.futures import Future
+
+from batch_io import DEFAULT_BATCH_SIZE, HAVE_MMSG, BatchReceiver, BatchSender
+from cluster import BROKERS, DEFAULT_BROKER, FORWARDED, ClusterChannels, parse_nodes
+from control_session import ControlSession
+from credential_cache import DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL, CredentialCache
+from envelope import (
+    FLAG_HISTORY,
+    MSG_CHAT,
+    MSG_EVICTED,
+    MSG_JOINED,
+    MSG_LEAVE,
+    MSG_LEFT,
+    MSG_NOTICE,
+    MSG_ROOM_CLOSED,
+    Reassembler,
+    compress,
+    encode,
+    unwrap,
+    wrap,
+)
+from expiry import ExpiryQueue
+from framing import (
+    DEFAULT_MAX_FRAME_SIZE,
+    HEADER_SIZE,
+    AsyncFrameReader,
+    FrameError,
+    FrameReader,
+    encode_frame,
+)
+from fanout import outbound_buffer
+from history import DEFAULT_HISTORY_BYTES, DEFAULT_HISTORY_MESSAGES, TRUNCATED_MARK
+from log_config import (
+    DEFAULT_LOG_LEVEL,
+    DEFAULT_LOG_SAMPLE_RATE,
+    Sampler,
+    configure_logging,
+    shutdown_logging,
+)
+from metrics import Metrics
+from room_registry import (
+    ROOM_ID_BITS,
+    SESSION_ID_SIZE,
+    Member,
+    RoomRegistry,
+    session_id,
+)
+from workers import (
+    MAX_FORWARDED_DATA_SIZE,
+    owner_of,
+    owner_of_room_id,
+    pack_address,
+    start_workers,
+)
+from rate_limit import (
+    DEFAULT_ADDRESS_BURST,
+    DEFAULT_ADDRESS_RATE,
+    DEFAULT_MAX_ENTRIES,
+    DEFAULT_MEMBER_BURST,
+    DEFAULT_MEMBER_RATE,
+    RateLimiter,
+)
+from reliable import RETRANSMIT_INTERVAL, ReliableChannel, coalesce_key
+from send_queue import DEFAULT_QUEUE_DEPTH, DRAIN_RETRY_INTERVAL, SendQueues
+from state_log import DEFAULT_COMMIT_INTERVAL, DEFAULT_SNAPSHOT_INTERVAL, StateLog
+from password_hasher import (
+    DEFAULT_BCRYPT_ROUNDS,
+    DEFAULT_HASH_WORKERS,
+    DEFAULT_ROOM_ADMISSION_LIMIT,
+    AdmissionError,
+    PasswordHasher,
+)
 
 # サーバー設定
 TCP_HOST = "127.0.0.1"
 TCP_PORT = 8000
 UDP_HOST = "127.0.0.1"
 UDP_PORT = 8001
+TCP_BACKLOG = 128  # accept 待ちキューの長さ
+
+# サーバーエンジン
+ENGINE_ASYNCIO = "asyncio"
+ENGINE_THREAD = "thread"
+DEFAULT_ENGINE = ENGINE_ASYNCIO
 
 # 操作コード
 CREATE_ROOM = 1
 JOIN_ROOM = 2
+LEAVE_ROOM = 3  # 以下は制御セッションでのみ使う
+HEARTBEAT = 4
+LIST_ROOMS = 5
+HISTORY = 6
+SESSION_OPERATIONS = (
+    CREATE_ROOM,
+    JOIN_ROOM,
+    LEAVE_ROOM,
+    HEARTBEAT,
+    LIST_ROOMS,
+    HISTORY,
+)
 
 # 状態コード
 REQUEST = 0
 ACKNOWLEDGE = 1
 COMPLETE = 2
+COMPLETE_COMPRESSED = 3  # ペイロードを圧縮した COMPLETE (要求された場合だけ使う)
 
 # ステータスコード
 SUCCESS = 0
 ROOM_EXISTS = 1
 ROOM_NOT_FOUND = 2
 INVALID_PASSWORD = 3
+SERVER_BUSY = 4
+INVALID_REQUEST = 5  # 制御セッションで扱えない操作・不正なペイロード
+
+# クライアントが要求できる拡張機能
+FEATURE_COMPACT_SESSION = "compact_session"  # COMPLETE でセッションIDを返す
+FEATURE_CONTROL_SESSION = "control_session"  # 参加後も TCP 接続を制御用に使い続ける
+FEATURE_RELIABLE_DELIVERY = "reliable_delivery"  # UDP に連番・ACK・再送を付ける
+FEATURE_UDP_ENDPOINT = "udp_endpoint"  # COMPLETE で UDP の送信先を返す
+FEATURE_BINARY_ENVELOPE = "binary_envelope"  # UDP のメッセージにヘッダーを付ける
+FEATURE_COMPRESSION = "compression"  # 長いメッセージを圧縮・分割する
+
+# 制御セッション
+SESSION_IDLE_TIMEOUT = 90  # この間リクエストが無ければ切断されたものとみなす
+# 制御セッションを受け付けるか (セッションは1つのワーカーのルームしか扱えないので、
+# --workers / --cluster-nodes では --no-control-session で無効にする)
+CONTROL_SESSIONS = True
+
+# ワーカープロセス
+PARENT_CHECK_INTERVAL = 1  # 親プロセスが終了していないかを確認する間隔
 
 # クライアント管理
-CLEANUP_INTERVAL = 20
+CLEANUP_INTERVAL = 20  # 期限の来る参加者がいないときの確認間隔
 INACTIVITY_TIMEOUT = 300
+HEARTBEAT_TIMEOUT = (
+    15  # UDP のハートビートを送ってくる参加者はこの間届かなければ退出させる
+)
 
-# チャットルーム管理
-chat_rooms = {}
-"""
-{
-room_name: {
-    host_token: host_token,
-    password: password,
-    tokens: {token: ip_address}
-    }
-}
-"""
-tokens = {}
-"""
-{
-token: {
-    room_name:room_name,
-    username:username
-    }
-}
-"""
-client_timestamp = {}
-"""
-{token:timestamp}
-"""
-
-# ロック
-rooms_lock = threading.Lock()
-tokens_lock = threading.Lock()
-timestamp_lock = threading.Lock()
+# チャットルーム管理 (トークンや最終発言時刻は各ルームの Member に保持する)
+registry = RoomRegistry()
+HISTORY_LIMITS = (DEFAULT_HISTORY_MESSAGES, DEFAULT_HISTORY_BYTES)  # ルームごとの履歴
+
+# 分割して送るメッセージのID
+fragment_ids = itertools.count(1)
+
+# 参加者の無発言タイムアウト (期限の早い順に (Room, Member) を取り出す)
+expiry_queue = ExpiryQueue()
 
 # イベント
 udp_closed = threading.Event()
 
+# 複数ワーカー構成 (--workers) でのワーカー情報
+worker_index = 0
+worker_count = 1
+worker_channels = (
+    None  # WorkerChannels / ClusterChannels (担当外のルーム宛ての通信を転送する)
+)
+
+# UDP 送信
+udp_socket = None
+udp_sender = None  # BatchSender (ブロードキャストをまとめて送信する)
+send_queues = None  # SendQueues (送信バッファが一杯で送れなかった分を宛先ごとに溜める)
+SEND_QUEUE_DEPTH = DEFAULT_QUEUE_DEPTH
+UDP_BATCH_SIZE = DEFAULT_BATCH_SIZE
+
+# TCP フレーム (ルーム名 + ペイロード) の上限
+MAX_FRAME_SIZE = DEFAULT_MAX_FRAME_SIZE
+
+# UDP の流量制限 (送信元アドレスごと・参加者ごとの RateLimiter、無効なら None)
+address_limiter = None
+member_limiter = None
+
+# 状態の永続化 (--state-dir を指定したときだけ StateLog を使う)
+STATE_DIR = None
+STATE_COMMIT_INTERVAL = DEFAULT_COMMIT_INTERVAL
+STATE_SNAPSHOT_INTERVAL = DEFAULT_SNAPSHOT_INTERVAL
+state_log = None
+
+# 信頼性レイヤー: ACK を待っているメッセージがある参加者
+retransmit_members = set()
+retransmit_lock = threading.Lock()
+
+# パスワードのハッシュ化・検証用ワーカープール
+password_hasher = PasswordHasher()
+
+# 検証済みパスワードのキャッシュ
+credential_cache = CredentialCache()
+
+# ログと統計
+logger = logging.getLogger("server")
+metrics = Metrics()
+metrics.add_gauge("rooms", lambda: len(registry.rooms))
+metrics.add_gauge("sessions", lambda: len(registry.tokens))
+metrics.add_gauge("expiry_queue", lambda: len(expiry_queue))
+metrics.add_gauge("credential_cache", lambda: credential_cache.stats())
+metrics.add_gauge("send_queue_depth", lambda: send_queues.depth if send_queues else 0)
+metrics.add_gauge("send_queue_max", lambda: send_queues.deepest() if send_queues else 0)
+metrics_file = None  # 統計を JSON で書き出すファイル
+METRICS_INTERVAL = 10
+debug_messages = False  # メッセージ単位の DEBUG ログを出すか (無効ならコストなし)
+message_sampler = Sampler(DEFAULT_LOG_SAMPLE_RATE)
+
 
 def generate_token():
     """一意のトークンを生成"""
     return str(uuid.uuid4())
 
 
-def handle_tcp_connection(client_socket, client_address):
-    """TCP接続の処理"""
+def handle_tcp_connection(client_socket, client_address, frame=None):
+    """TCP接続の処理 (frame は他のワーカーが受信済みのデータ)"""
+    frames = FrameReader(client_socket, MAX_FRAME_SIZE, frame or b"")
     try:
-        # ヘッダー受信 (32バイト)
-        header = client_socket.recv(32)
-        if not header or len(header) < 32:
-            print("Invalid Header")
+        request_frame = frames.read()
+        if request_frame is None:
+            logger.warning("Invalid Header", extra={"client": client_address})
             return
-
-        room_name_size = header[0]
-        operation = header[1]
-        state = header[2]
-        payload_size = int.from_bytes(header[3:32], byteorder="big")
-
-        # ボディ受信
-        body = client_socket.recv(room_name_size + payload_size)
-        if not body or len(body) < room_name_size + payload_size:
-            print("Invalid Body")
+        # 他のノードが中継した接続なら、元のクライアントのアドレスに置き換える
+        forwarded = forwarded_address(request_frame)
+        if forwarded is not None:
+            client_address = forwarded
+            request_frame = frames.read()
+            if request_frame is None:
+                return
+        room_name, operation, state, payload = request_frame
+
+        # 担当外のルームなら接続ごと担当ワーカー (ノード) へ渡す
+        # (続けて送られてきたリクエストを読み込んでいれば一緒に渡す)
+        owner = owner_of(room_name, worker_count)
+        if owner != worker_index:
+            worker_channels.forward_connection(
+                owner,
+                client_socket,
+                client_address,
+                request_frame.encode() + frames.pending(),
+            )
             return
 
-        room_name = body[:room_name_size].decode("utf-8")
-        payload = body[room_name_size : room_name_size + payload_size]
+        if operation not in SESSION_OPERATIONS or state != REQUEST:
+            return
 
-        if operation == CREATE_ROOM and state == REQUEST:
-            # チャットルーム作成リクエスト
-            try:
-                create_data = json.loads(payload.decode("utf-8"))
-                username = create_data.get("username", "")
-                password = create_data.get("password", "")
-                handle_create_room(
-                    client_socket, room_name, username, client_address, password
-                )
-            except json.JSONDecodeError:
-                # 不正なペイロード
+        try:
+            request = json.loads(payload.decode("utf-8"))
+        except json.JSONDecodeError:
+            # 不正なペイロード
+            if operation in (CREATE_ROOM, JOIN_ROOM):
                 send_tcp_response(
                     client_socket, room_name, operation, ACKNOWLEDGE, INVALID_PASSWORD
                 )
+            return
 
-        elif operation == JOIN_ROOM and state == REQUEST:
-            # チャットルーム参加リクエスト
-            try:
-                join_data = json.loads(payload.decode("utf-8"))
-                username = join_data.get("username", "")
-                password = join_data.get("password", "")
-                handle_join_room(
-                    client_socket, room_name, username, client_address, password
-                )
-            except json.JSONDecodeError:
-                # 不正なペイロード
+        features = request.get("features", [])
+        if operation in (CREATE_ROOM, JOIN_ROOM):
+            if invalid_udp_port(request) or refuses_session(features):
                 send_tcp_response(
-                    client_socket, room_name, operation, ACKNOWLEDGE, INVALID_PASSWORD
+                    client_socket, room_name, operation, ACKNOWLEDGE, INVALID_REQUEST
                 )
+                return
+            handle_room_request = (
+                handle_create_room if operation == CREATE_ROOM else handle_join_room
+            )
+            member = handle_room_request(
+                frames,
+                room_name,
+                request.get("username", ""),
+                client_address,
+                request.get("password", ""),
+                features,
+                request.get("udp_port"),
+            )
+            if member is None or FEATURE_CONTROL_SESSION not in features:
+                return
+
+            # 参加後も接続を制御セッションとして使う
+            session = ControlSession(client_address, features)
+            add_session_member(session, room_name, member)
+            run_control_session(frames, session)
+
+        elif refuses_session(features):
+            response = {"request_id": request.get("request_id")}
+            response["status"] = INVALID_REQUEST
+            client_socket.sendall(
+                build_session_response(room_name, operation, response)
+            )
+
+        elif FEATURE_CONTROL_SESSION in features:
+            # ルーム一覧の取得などから始める制御セッション
+            session = ControlSession(client_address, features)
+            run_control_session(frames, session, (room_name, operation, request))
 
+    except FrameError as e:
+        logger.warning("Invalid Frame: %s", e, extra={"client": client_address})
     except Exception as e:
-        print(f"TCP処理エラー: {e}")
+        logger.error("TCP処理エラー: %s", e, extra={"client": client_address})
     finally:
         client_socket.close()
 
 
-def handle_create_room(client_socket, room_name, username, client_address, password=""):
-    """チャットルーム作成処理"""
-    with rooms_lock:
-        if room_name in chat_rooms:
-            # 既に同名のルームが存在する
-            send_tcp_response(
-                client_socket, room_name, CREATE_ROOM, ACKNOWLEDGE, ROOM_EXISTS
-            )
-            return
+def invalid_udp_port(request_data):
+    """リクエストの udp_port が UDP のポート番号として使えない値か (省略は正しい)
+
+    登録したアドレスはブロードキャストのたびに使うので、登録する前に確認する。
+    """
+    udp_port = request_data.get("udp_port")
+    if udp_port is None:
+        return False
+    # bool は int の派生クラスなので type で比べる
+    return type(udp_port) is not int or not 1 <= udp_port <= 65535
+
+
+def refuses_session(features):
+    """制御セッションを無効にしているのに、制御セッションを要求されたか"""
+    return not CONTROL_SESSIONS and FEATURE_CONTROL_SESSION in features
+
 
-        # 新しいトークン生成
-        host_token = generate_token()
+def forwarded_address(request_frame):
+    """クラスタの他のノードが中継した接続なら、元のクライアントのアドレスを返す"""
+    if request_frame.operation != FORWARDED or not isinstance(
+        worker_channels, ClusterChannels
+    ):
+        return None
+    return worker_channels.forwarded_address(request_frame.payload)
 
+
+def prepare_create_room(room_name, password=""):
+    """ルーム作成前のパスワードハッシュ化を投入し (ステータスコード, Future) を返す"""
+    if registry.get(room_name) is not None:
+        # 既に同名のルームが存在する
+        return ROOM_EXISTS, None
+
+    try:
         # パスワード設定が無い場合は空文字をハッシュ化
-        hashed_password = hash_password(password)
+        future = password_hasher.hash(room_name, password)
+    except AdmissionError:
+        metrics.increment("server_busy")
+        return SERVER_BUSY, None
+
+    # 作成者のパスワードは検証済みとしてキャッシュしておく
+    def remember(done):
+        if done.exception() is None:
+            credential_cache.add(room_name, done.result(), password)
+
+    future.add_done_callback(remember)
+    return SUCCESS, future
+
+
+def register_room(room_name, username, client_address, hashed_password):
+    """チャットルームを登録し (ステータスコード, ホストの Member) を返す"""
+    # 新しいトークン生成
+    host_token = generate_token()
+
+    # チャットルーム作成
+    host = Member(host_token, username, client_address)
+    room = registry.create(room_name, host_token, hashed_password, host)
+    if room is None:
+        # ハッシュ化の間に同名のルームが作成された
+        return ROOM_EXISTS, None
+
+    expiry_queue.schedule(host.last_active + INACTIVITY_TIMEOUT, (room, host))
+
+    metrics.increment("rooms_created")
+    logger.info(
+        "ルーム作成",
+        extra={"room": room_name, "user": username, "client": client_address},
+    )
+    return SUCCESS, host
 
-        # チャットルーム作成
-        chat_rooms[room_name] = {
-            "host_token": host_token,
-            "password": hashed_password,  # ハッシュ化したパスワードを文字列として保存
-            "tokens": {host_token: client_address},
-        }
 
-    with tokens_lock:
-        tokens[host_token] = {"room_name": room_name, "username": username}
+def prepare_join_room(room_name, password=""):
+    """ルーム参加前のパスワード検証を投入し (ステータスコード, ハッシュ, Future) を返す"""
+    room = registry.get(room_name)
+    if room is None:
+        # ルームが存在しない
+        return ROOM_NOT_FOUND, None, None
 
-    with timestamp_lock:
-        client_timestamp[host_token] = time.time()
+    room_password = room.password
 
-    # 成功応答
-    send_tcp_response(client_socket, room_name, CREATE_ROOM, ACKNOWLEDGE, SUCCESS)
+    # 同じパスワードで検証済みなら bcrypt を省略
+    if credential_cache.contains(room_name, room_password, password):
+        future = Future()
+        future.set_result(True)
+        return SUCCESS, room_password, future
 
-    # トークン送信
-    send_tcp_complete(client_socket, room_name, CREATE_ROOM, host_token)
+    try:
+        future = password_hasher.verify(room_name, password, room_password)
+    except AdmissionError:
+        metrics.increment("server_busy")
+        return SERVER_BUSY, None, None
 
-    print(f"ルーム作成: {room_name}, ホスト: {username}, アドレス: {client_address}")
+    def remember(done):
+        if done.exception() is None and done.result():
+            credential_cache.add(room_name, room_password, password)
 
-    # UDP port 受信
-    udp_port_bytes = client_socket.recv(2)
-    udp_port = int.from_bytes(udp_port_bytes, "big")
-    with rooms_lock:
-        chat_rooms[room_name]["tokens"][host_token] = (client_address[0], udp_port)
+    future.add_done_callback(remember)
+    return SUCCESS, room_password, future
 
 
-def handle_join_room(client_socket, room_name, username, client_address, password=""):
-    """チャットルーム参加処理"""
-    with rooms_lock:
-        if room_name not in chat_rooms:
-            # ルームが存在しない
-            send_tcp_response(
-                client_socket, room_name, JOIN_ROOM, ACKNOWLEDGE, ROOM_NOT_FOUND
-            )
-            return
+def register_member(room_name, username, client_address, hashed_password, verified):
+    """ルームに参加者を登録し (ステータスコード, Member) を返す"""
+    if not verified:
+        metrics.increment("auth_failures")
+        return INVALID_PASSWORD, None
 
-        room = chat_rooms[room_name]
+    room = registry.get(room_name)
+    if room is None:
+        # 検証の間にルームが閉じられた
+        return ROOM_NOT_FOUND, None
 
-        # パスワードの検証
-        room_password = room["password"]
-        if not verify_password(password, room_password):
-            send_tcp_response(
-                client_socket, room_name, JOIN_ROOM, ACKNOWLEDGE, INVALID_PASSWORD
-            )
-            return
+    if room.password != hashed_password:
+        # 検証の間にルームが作り直された
+        return INVALID_PASSWORD, None
+
+    # 新しいトークン生成
+    user_token = generate_token()
+
+    # トークンをルームに追加
+    member = Member(user_token, username, client_address)
+    if not registry.add_member(room, member):
+        return ROOM_NOT_FOUND, None
+
+    expiry_queue.schedule(member.last_active + INACTIVITY_TIMEOUT, (room, member))
+
+    metrics.increment("members_joined")
+    logger.info(
+        "ルーム参加",
+        extra={"room": room_name, "user": username, "client": client_address},
+    )
+    return SUCCESS, member
+
+
+def register_udp_address(room_name, member, udp_address, features=()):
+    """クライアントから通知された UDP アドレスを登録
+
+    reliable_delivery を要求されていれば、この参加者との UDP に信頼性レイヤーを使う。
+    binary_envelope を要求されていれば、メッセージに型付きのヘッダーを付ける。
+    compression も要求されていれば、長いメッセージを圧縮・分割する。
+    """
+    room = registry.get(room_name)
+    if room is None:
+        return
+
+    with room.lock:
+        if room.members.get(member.member_id) is member:
+            registry.set_address(room, member, udp_address)
+            if FEATURE_RELIABLE_DELIVERY in features and member.reliable is None:
+                room.enable_reliable(member, ReliableChannel(count=metrics.increment))
+            if FEATURE_BINARY_ENVELOPE in features:
+                room.enable_envelope(member)
+                if FEATURE_COMPRESSION in features:
+                    room.enable_compression(member)
+                    member.reassembler = Reassembler(count=metrics.increment)
+            registry.address_changed(room, member)
+
+
+def handle_create_room(
+    frames,
+    room_name,
+    username,
+    client_address,
+    password="",
+    features=(),
+    udp_port=None,
+):
+    """チャットルーム作成処理 (成功すればホストの Member を返す)"""
+    client_socket = frames.sock
+    status, host = create_room(room_name, username, client_address, password)
+    if status != SUCCESS:
+        send_tcp_response(client_socket, room_name, CREATE_ROOM, ACKNOWLEDGE, status)
+        return None
+
+    # 成功応答
+    send_tcp_response(client_socket, room_name, CREATE_ROOM, ACKNOWLEDGE, SUCCESS)
+
+    # UDP port がリクエストに含まれていれば、完了応答より前に登録する
+    # (完了応答を受け取ってすぐ送られたメッセージを捨てないように)
+    if udp_port is not None:
+        register_udp_address(room_name, host, (client_address[0], udp_port), features)
+
+    # トークン送信
+    send_tcp_complete(
+        client_socket, room_name, CREATE_ROOM, complete_payload(host, features)
+    )
+
+    # UDP port 受信 (リクエストに含まれていなければ2バイトで受け取る)
+    if udp_port is None:
+        udp_port = int.from_bytes(frames.read_exact(2) or b"", "big")
+        register_udp_address(room_name, host, (client_address[0], udp_port), features)
+    return host
+
+
+def create_room(room_name, username, client_address, password=""):
+    """パスワードのハッシュ化を待ってルームを作成し (ステータスコード, Member) を返す"""
+    status, future = prepare_create_room(room_name, password)
+    if status != SUCCESS:
+        return status, None
+    return register_room(room_name, username, client_address, future.result())
 
-        # 新しいトークン生成
-        user_token = generate_token()
 
-        # トークンをルームに追加
-        room["tokens"][user_token] = client_address
+def join_room(room_name, username, client_address, password=""):
+    """パスワードの検証を待ってルームに参加し (ステータスコード, Member) を返す"""
+    status, hashed_password, future = prepare_join_room(room_name, password)
+    if status != SUCCESS:
+        return status, None
+    return register_member(
+        room_name, username, client_address, hashed_password, future.result()
+    )
 
-    with tokens_lock:
-        tokens[user_token] = {"room_name": room_name, "username": username}
 
-    with timestamp_lock:
-        client_timestamp[user_token] = time.time()
+def handle_join_room(
+    frames,
+    room_name,
+    username,
+    client_address,
+    password="",
+    features=(),
+    udp_port=None,
+):
+    """チャットルーム参加処理 (成功すれば Member を返す)"""
+    client_socket = frames.sock
+    status, member = join_room(room_name, username, client_address, password)
+    if status != SUCCESS:
+        send_tcp_response(client_socket, room_name, JOIN_ROOM, ACKNOWLEDGE, status)
+        return None
 
     # 成功応答
     send_tcp_response(client_socket, room_name, JOIN_ROOM, ACKNOWLEDGE, SUCCESS)
 
+    # UDP port がリクエストに含まれていれば、完了応答と参加メッセージより前に登録する
+    # (参加メッセージや、完了応答の直後に届いた発言を受け取れるように)
+    if udp_port is not None:
+        register_udp_address(room_name, member, (client_address[0], udp_port), features)
+
     # トークン送信
-    send_tcp_complete(client_socket, room_name, JOIN_ROOM, user_token)
+    send_tcp_complete(
+        client_socket, room_name, JOIN_ROOM, complete_payload(member, features)
+    )
 
     # 参加メッセージをルームに送信
-    system_message = f"{username} がチャットルームに参加しました"
-    broadcast_message_to_room(room_name, system_message, None)
+    broadcast_join_message(room_name, member)
 
-    print(f"ルーム参加: {room_name}, ユーザー: {username}, アドレス: {client_address}")
+    # UDP port 受信 (リクエストに含まれていなければ2バイトで受け取る)
+    if udp_port is None:
+        udp_port = int.from_bytes(frames.read_exact(2) or b"", "big")
+        register_udp_address(room_name, member, (client_address[0], udp_port), features)
+    return member
 
-    # UDP port 受信
-    udp_port_bytes = client_socket.recv(2)
-    udp_port = int.from_bytes(udp_port_bytes, "big")
-    with rooms_lock:
-        chat_rooms[room_name]["tokens"][user_token] = (client_address[0], udp_port)
 
+def run_control_session(frames, session, first_request=None):
+    """制御セッションのリクエストを接続が切れるまで処理する
 
-def send_tcp_response(client_socket, room_name, operation, state, status_code):
-    """TCP応答送信"""
-    room_name_bytes = room_name.encode("utf-8")
-    room_name_size = len(room_name_bytes)
+    続けて送られてきたリクエスト (パイプライン) も受信した順に1件ずつ処理する。
+    """
+    client_socket = frames.sock
+    client_socket.settimeout(SESSION_IDLE_TIMEOUT)
+    try:
+        request = first_request
+        while True:
+            if request is None:
+                request_frame = frames.read()
+                if request_frame is None:
+                    break
+                request = decode_session_request(request_frame)
+
+            room_name, operation, request_data = request
+            request = None
+            if operation in (CREATE_ROOM, JOIN_ROOM) and request_data is not None:
+                status, member = INVALID_REQUEST, None
+                if owns_room(room_name) and not invalid_udp_port(request_data):
+                    join = create_room if operation == CREATE_ROOM else join_room
+                    status, member = join(
+                        room_name,
+                        request_data.get("username", ""),
+                        session.client_address,
+                        request_data.get("password", ""),
+                    )
+                response = finish_session_join(
+                    session, room_name, operation, request_data, status, member
+                )
+            else:
+                response = process_session_request(
+                    session, room_name, operation, request_data
+                )
+            client_socket.sendall(
+                build_session_response(
+                    room_name, operation, response, wants_compression(request_data)
+                )
+            )
+    except OSError:
+        # タイムアウト (ハートビートが途絶えた) も切断として扱う
+        pass
+    except FrameError as e:
+        logger.warning("Invalid Frame: %s", e, extra={"client": session.client_address})
+    finally:
+        close_control_session(session)
+
+
+def decode_session_request(request_frame):
+    """制御セッションのリクエストを (room_name, operation, dict) に分解
+
+    ペイロードが JSON のオブジェクトでなければ dict の代わりに None を返す。
+    """
+    try:
+        request_data = json.loads(request_frame.payload.decode("utf-8"))
+    except ValueError:
+        request_data = None
+    if not isinstance(request_data, dict):
+        request_data = None
+    return request_frame.room_name, request_frame.operation, request_data
+
+
+def owns_room(room_name):
+    """このワーカーが担当するルームか"""
+    return owner_of(room_name, worker_count) == worker_index
+
+
+def add_session_member(session, room_name, member):
+    """参加したルームを制御セッションに記録 (接続が切れたら退出させる)"""
+    room = registry.get(room_name)
+    if room is not None and room.members.get(member.member_id) is member:
+        session.add(room, member)
+
+
+def finish_session_join(session, room_name, operation, request_data, status, member):
+    """制御セッションでのルーム作成・参加の後処理をして応答を返す"""
+    response = {"request_id": request_data.get("request_id"), "status": status}
+    if status != SUCCESS:
+        return response
+
+    features = request_data.get("features", session.features)
+    udp_port = request_data.get("udp_port")
+    if udp_port is not None:
+        register_udp_address(
+            room_name, member, (session.client_address[0], udp_port), features
+        )
+    add_session_member(session, room_name, member)
+    if operation == JOIN_ROOM:
+        broadcast_join_message(room_name, member)
+
+    credential = session_credential(member, features)
+    if FEATURE_COMPACT_SESSION in features:
+        response["session_id"] = credential.hex()
+    else:
+        response["token"] = member.token
+    if FEATURE_UDP_ENDPOINT in features:
+        response["udp_endpoint"] = [UDP_HOST, UDP_PORT]
+    return response
+
+
+def process_session_request(session, room_name, operation, request_data):
+    """制御セッションのルーム作成・参加以外の操作を処理して応答を返す"""
+    if request_data is None:
+        return {"request_id": None, "status": INVALID_REQUEST}
+
+    response = {"request_id": request_data.get("request_id"), "status": SUCCESS}
+    if operation == LEAVE_ROOM:
+        entry = session.remove(room_name)
+        if entry is None:
+            response["status"] = ROOM_NOT_FOUND
+        else:
+            leave_room(*entry)
+
+    elif operation == HEARTBEAT:
+        # このセッションで参加している全てのルームで発言があったものとみなす
+        now = time.time()
+        for room, member in session.memberships.values():
+            member.last_active = now
+        response["rooms"] = list(session.memberships)
+
+    elif operation == LIST_ROOMS:
+        response["rooms"] = [
+            {"name": room.name, "members": len(room.members)}
+            for room in registry.snapshot()
+        ]
+
+    elif operation == HISTORY:
+        entry = session.get(room_name)
+        if entry is None:
+            response["status"] = ROOM_NOT_FOUND
+        else:
+            response.update(query_history(*entry, request_data))
+
+    else:
+        response["status"] = INVALID_REQUEST
+    return response
+
+
+def query_history(room, member, request_data):
+    """ルームの履歴を HISTORY の応答の項目として返す
+
+    since があればその連番以降の全て (途中で切り詰めない)、なければ参加する前の
+    最後の limit 件を返す。
+    """
+    if room.history is None:
+        return {"first_seq": 1, "next_seq": 1, "messages": []}
+
+    since = request_data.get("since")
+    limit = request_data.get("limit")
+    if not isinstance(since, int) or isinstance(since, bool):
+        since = None
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit < 0:
+        limit = None
+    before = member.joined_seq if since is None else None
+    first_seq, next_seq, messages = room.history.query(since, before, limit)
+    return {
+        "first_seq": first_seq,
+        "next_seq": next_seq,
+        "messages": [[seq, str(message, "utf-8")] for seq, message in messages],
+    }
 
-    status_bytes = status_code.to_bytes(1, byteorder="big")
-    payload_size = len(status_bytes)
 
-    # ヘッダー作成
-    header = bytes([room_name_size, operation, state]) + payload_size.to_bytes(
-        29, byteorder="big"
+def wants_compression(request_data):
+    """リクエストに "compress": true (応答の履歴を圧縮する) が付いているか"""
+    return request_data is not None and request_data.get("compress") is True
+
+
+def build_session_response(room_name, operation, response, compressed=False):
+    """制御セッションの応答 (JSON ペイロード) のバイト列を作成
+
+    messages (履歴) を含む応答は、クライアントが受け取れるフレームの大きさごとに
+    分けて続けて送る。最後以外のフレームには "more": true を付ける。
+    compressed なら履歴の各フレームのペイロードを圧縮し、状態を COMPLETE_COMPRESSED にする。
+    """
+    messages = response.pop("messages", None)
+    if messages is None:
+        payload_bytes = json.dumps(response).encode("utf-8")
+        return encode_frame(room_name, operation, COMPLETE, payload_bytes)
+
+    # ルーム名・他の項目・"more" (と圧縮で増えることがある分) を除いた残りに
+    # 収まるだけメッセージを詰める
+    overhead = len(room_name.encode("utf-8")) + len(json.dumps(response)) + 128
+    budget = DEFAULT_MAX_FRAME_SIZE - overhead
+    batches = [[]]
+    size = 0
+    for message in messages:
+        message_size = len(json.dumps(message, ensure_ascii=False).encode("utf-8"))
+        if message_size + 2 > budget:
+            # エスケープで1件だけでフレームに収まらなくなったものは切り詰める
+            message, message_size = fit_history_entry(message, budget - 2)
+        if batches[-1] and size + message_size + 2 > budget:
+            batches.append([])
+            size = 0
+        batches[-1].append(message)
+        size += message_size + 2
+
+    frames = []
+    for index, batch in enumerate(batches):
+        payload = dict(response, messages=batch, more=index < len(batches) - 1)
+        payload_bytes = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        if compressed:
+            frames.append(
+                encode_frame(
+                    room_name, operation, COMPLETE_COMPRESSED, compress(payload_bytes)
+                )
+            )
+        else:
+            frames.append(encode_frame(room_name, operation, COMPLETE, payload_bytes))
+    return b"".join(frames)
+
+
+def fit_history_entry(entry, budget):
+    """履歴の [連番, メッセージ] を JSON で budget バイト以下になるまで切り詰める
+
+    (切り詰めた [連番, メッセージ], その JSON のバイト数) を返す。
+    """
+    seq, text = entry
+    mark = str(TRUNCATED_MARK, "utf-8")
+    while True:
+        size = len(json.dumps([seq, text], ensure_ascii=False).encode("utf-8"))
+        if size <= budget:
+            return [seq, text], size
+        text = text[: len(text) * budget // size - len(mark) - 1] + mark
+
+
+def leave_room(room, member):
+    """参加者を退出させる (ホストならルームを閉じる)"""
+    if room.closed or registry.get(room.name) is not room:
+        # タイムアウトなどで既に閉じられたルーム
+        return
+    if member.token == room.host_token:
+        close_chat_room(room.name)
+        return
+
+    with room.lock:
+        removed = registry.remove_member(room, member)
+    if removed is not None:
+        broadcast_message_to_room(
+            room.name,
+            f"{member.username} がチャットルームから退出しました",
+            None,
+            MSG_LEFT,
+            sender_id(member),
+        )
+
+
+def close_control_session(session):
+    """制御セッションの終了 (参加中のルームから全て退出させる)"""
+    for room, member in session.close():
+        leave_room(room, member)
+
+
+def session_credential(member, features):
+    """COMPLETE で返す認証情報 (要求があればバイナリのセッションID)"""
+    if FEATURE_COMPACT_SESSION in features:
+        return session_id(member).to_bytes(SESSION_ID_SIZE, byteorder="big")
+    return member.token.encode("utf-8")
+
+
+def complete_payload(member, features):
+    """COMPLETE のペイロード (要求があれば末尾に6バイトで UDP の送信先を付ける)
+
+    クラスタではルームを担当するノードの UDP のアドレスになる。
+    """
+    credential = session_credential(member, features)
+    if FEATURE_UDP_ENDPOINT in features:
+        credential += pack_address((UDP_HOST, UDP_PORT))
+    return credential
+
+
+def broadcast_join_message(room_name, member):
+    """参加メッセージをルームに送信 (参加した本人には送らない)"""
+    system_message = f"{member.username} がチャットルームに参加しました"
+    broadcast_message_to_room(
+        room_name, system_message, member.token, MSG_JOINED, sender_id(member)
     )
 
-    # 送信
-    client_socket.sendall(header + room_name_bytes + status_bytes)
+
+def build_tcp_response(room_name, operation, state, status_code):
+    """TCP応答のバイト列を作成"""
+    status_bytes = status_code.to_bytes(1, byteorder="big")
+    return encode_frame(room_name, operation, state, status_bytes)
 
 
-def send_tcp_complete(client_socket, room_name, operation, token):
-    """TCP完了応答送信"""
-    room_name_bytes = room_name.encode("utf-8")
-    room_name_size = len(room_name_bytes)
+def build_tcp_complete(room_name, operation, token_bytes):
+    """TCP完了応答のバイト列を作成"""
+    return encode_frame(room_name, operation, COMPLETE, token_bytes)
 
-    token_bytes = token.encode("utf-8")
-    payload_size = len(token_bytes)
 
-    # ヘッダー作成
-    header = bytes([room_name_size, operation, COMPLETE]) + payload_size.to_bytes(
-        29, byteorder="big"
+def send_tcp_response(client_socket, room_name, operation, state, status_code):
+    """TCP応答送信"""
+    client_socket.sendall(build_tcp_response(room_name, operation, state, status_code))
+
+
+def send_tcp_complete(client_socket, room_name, operation, token_bytes):
+    """TCP完了応答送信"""
+    client_socket.sendall(build_tcp_complete(room_name, operation, token_bytes))
+
+
+def dispatch_udp_packet(data, addr):
+    """UDP パケットの形式を判別して処理
+
+    data は受信バッファの memoryview のこともあるので、処理が終わった後まで残さない。
+    送信者は送信元アドレスの索引から1回の参照で引き、パケットの資格情報と照合する。
+    一致しない場合 (未登録のアドレスや、同じアドレスの別の参加者) だけ、
+    セッションIDやトークンの索引から引き直す。
+    """
+    data = memoryview(data)
+    entry = registry.get_address(addr)
+    if data[0] == 0 and data[1] == SESSION_ID_SIZE:
+        # ルーム名を省略し、トークンの代わりにセッションIDを載せた形式
+        packet_session_id = int.from_bytes(
+            data[2 : 2 + SESSION_ID_SIZE], byteorder="big"
+        )
+        if entry is None or session_id(entry[1]) != packet_session_id:
+            metrics.increment("address_index_misses")
+            entry = registry.get_session(packet_session_id)
+        message = data[2 + SESSION_ID_SIZE :]
+    else:
+        header_size = 2 + data[0] + data[1]
+        room_name = data[2 : 2 + data[0]]
+        token = data[2 + data[0] : header_size]
+        if entry is None or not matches_token(entry, room_name, token):
+            metrics.increment("address_index_misses")
+            entry = registry.get_token(str(token, "utf-8", "replace"))
+            if entry is not None and not matches_token(entry, room_name, token):
+                entry = None
+        message = data[header_size:]
+
+    if not message:
+        process_heartbeat(entry, addr)
+    else:
+        process_message(entry, message, addr)
+
+
+def matches_token(entry, room_name, token):
+    """旧形式のパケットのルーム名とトークン (バイト列) が参加者のものか"""
+    room, member = entry
+    return room_name == room.name.encode("utf-8") and hmac.compare_digest(
+        token, member.token.encode("utf-8")
     )
 
-    # 送信
-    client_socket.sendall(header + room_name_bytes + token_bytes)
+
+_MIN_HEADER_SIZE = 2
 
 
 def handle_udp_message(udp_socket):
-    _MIN_HEADER_SIZE = 2
-    """UDP メッセージ処理"""
+    """UDP メッセージ処理 (1回の受信で溜まっているデータグラムをまとめて処理)"""
+    receiver = BatchReceiver(udp_socket, UDP_BATCH_SIZE)
     while not udp_closed.is_set():
         try:
-            data, addr = udp_socket.recvfrom(4096)
-            if not data:
-                continue
+            datagrams = receiver.receive()
+        except Exception as e:
+            logger.error("UDP message handle error: %s", e)
+            continue
 
-            if len(data) < _MIN_HEADER_SIZE:
-                print("Invalid request data. message contains two bytes at least.")
-                continue
+        for data, addr in datagrams:
+            handle_datagram(data, addr)
 
-            room_name_size = data[0]
-            token_size = data[1]
 
-            room_name = data[2 : 2 + room_name_size].decode("utf-8")
-            token = data[2 + room_name_size : 2 + room_name_size + token_size].decode(
-                "utf-8"
-            )
-            message = data[2 + room_name_size + token_size :].decode("utf-8")
+def handle_datagram(data, addr):
+    """受信したデータグラム1件を処理"""
+    if not data:
+        return
 
-            process_message(room_name, token, message, addr)
+    if len(data) < _MIN_HEADER_SIZE:
+        metrics.increment("dropped_datagrams")
+        if debug_messages:
+            logger.debug("Invalid request data", extra={"client": addr})
+        return
 
-        except Exception as e:
-            print(f"UDP message handle error: {e}")
+    if not within_rate_limits(data, addr):
+        return
 
+    try:
+        # 担当外のルーム宛てなら担当ワーカーへ転送
+        if worker_channels is not None:
+            owner = datagram_owner(data)
+            if owner != worker_index:
+                worker_channels.forward_datagram(owner, data, addr)
+                return
+
+        metrics.increment("messages_in")
+        metrics.increment("bytes_in", len(data))
+        dispatch_udp_packet(data, addr)
+    except Exception as e:
+        metrics.increment("dropped_datagrams")
+        if debug_messages:
+            logger.debug("UDP message handle error: %s", e, extra={"client": addr})
 
-def process_message(room_name, token, message, addr):
-    """メッセージ処理"""
-    with rooms_lock:
-        if room_name not in chat_rooms:
-            return
 
-        room = chat_rooms[room_name]
+def within_rate_limits(data, addr):
+    """送信元アドレスと送信者ごとの流量制限 (デコードやロックより前に確認する)"""
+    now = time.monotonic()
+    if address_limiter is not None and not address_limiter.allow(hash(addr), now):
+        metrics.increment("rate_limited_address")
+        return False
+    if member_limiter is not None and not member_limiter.allow(sender_key(data), now):
+        metrics.increment("rate_limited_member")
+        return False
+    return True
 
-        if token not in room["tokens"]:
-            return
 
-        if room["tokens"][token] != addr:
-            return
+def sender_key(data):
+    """データグラムの送信者を表す整数 (セッションIDの参加者ID、またはトークンのハッシュ)"""
+    if data[0] == 0 and data[1] == SESSION_ID_SIZE:
+        return int.from_bytes(data[2 + ROOM_ID_BITS // 8 : 2 + SESSION_ID_SIZE], "big")
+    start = 2 + data[0]
+    return hash(bytes(data[start : start + data[1]]))
 
-    with tokens_lock:
-        if token not in tokens:
-            return
 
-        username = tokens[token]["username"]
+def datagram_owner(data):
+    """データグラムの宛先ルームを担当するワーカー"""
+    if data[0] == 0 and data[1] == SESSION_ID_SIZE:
+        room_id = int.from_bytes(data[2 : 2 + ROOM_ID_BITS // 8], byteorder="big")
+        return owner_of_room_id(room_id, worker_count)
 
-    with timestamp_lock:
-        if token not in client_timestamp:
-            return
+    room_name = str(data[2 : 2 + data[0]], "utf-8")
+    return owner_of(room_name, worker_count)
 
-        client_timestamp[token] = time.time()
 
-    print("broard cast")
+def handle_worker_messages():
+    """他のワーカーから転送された通信の処理"""
+    while not udp_closed.is_set():
+        try:
+            kind, payload, addr, client_socket = worker_channels.receive()
+        except Exception as e:
+            logger.error("ワーカー間通信エラー: %s", e)
+            continue
 
-    # メッセージブロードキャスト
-    formatted_message = f"{username}: {message}"
-    broadcast_message_to_room(room_name, formatted_message, token)
+        if kind == "datagram":
+            handle_datagram(payload, addr)
+        else:
+            client_thread = threading.Thread(
+                target=handle_tcp_connection,
+                args=(client_socket, addr, payload),
+                daemon=True,
+            )
+            client_thread.start()
 
-    # ホスト退出チェック
-    if token == room["host_token"] and message.strip().lower() == "/exit":
-        close_chat_room(room_name)
 
+def process_message(entry, message, addr):
+    """送信者 entry ((Room, Member)。見つからなかった場合は None) のメッセージ処理
 
-def send_message_bytes_to_client(ip, message_bytes):
-    """各自にメッセージを送信"""
+    message は UTF-8 かどうかを配信時に確認する。
+    """
+    if entry is None:
+        metrics.increment("dropped_datagrams")
+        return
 
-    # UDP送信
-    try:
-        print(ip)
-        udp_socket.sendto(message_bytes, ip)
-    except Exception as e:
-        print(f"メッセージ送信エラー: {e}")
+    room, member = entry
+    deliver_message(room, member, message, addr)
+
+
+def process_heartbeat(entry, addr):
+    """ハートビート (本文が空のデータグラム) の処理
+
+    デコードや配信はせず、送信元を確認して最終応答時刻を更新するだけにする。
+    最初のハートビートでその参加者の期限を HEARTBEAT_TIMEOUT に切り替える。
+    """
+    if entry is None:
+        metrics.increment("dropped_datagrams")
+        return
 
+    room, member = entry
+    if member.address != addr:
+        metrics.increment("dropped_datagrams")
+        return
 
-def broadcast_message_to_room(room_name, message, exclude_token=None):
-    """ルーム内の全員にメッセージをブロードキャスト"""
-    with rooms_lock:
-        if room_name not in chat_rooms:
+    # 時刻の代入だけなのでロックは取らない (退出と重なっても読み捨てられる)
+    member.last_active = time.time()
+    metrics.increment("heartbeats")
+    if member.heartbeat:
+        return
+
+    with room.lock:
+        if member.heartbeat or room.members.get(member.member_id) is not member:
             return
+        member.heartbeat = True
+    expiry_queue.schedule(member.last_active + HEARTBEAT_TIMEOUT, (room, member))
+
 
-        room = chat_rooms[room_name]
-        recipients = []
-        print(recipients)
+def deliver_message(room, member, message, addr):
+    """送信元を確認してメッセージ (UTF-8 のバイト列) をルームに配信
+
+    信頼性レイヤーを使う参加者の message は DATA / ACK パケット。
+    """
+    with room.lock:
+        if room.members.get(member.member_id) is not member or member.address != addr:
+            metrics.increment("dropped_datagrams")
+            return
 
-        for token, ip in room["tokens"].items():
-            if token != exclude_token:
-                recipients.append((token, ip))
-        print(recipients)
+        member.last_active = time.time()
+        recipients = room.recipients()
+
+    if member.reliable is None:
+        handle_member_message(room, member, message, recipients)
+        return
+
+    # 信頼性レイヤー: ACK を返し、連番の順に揃ったメッセージだけを配信する
+    messages, ack = member.reliable.receive(message)
+    if ack is not None:
+        send_message_bytes_to_client(addr, ack, coalesce_key(ack))
+    for message in messages:
+        handle_member_message(room, member, message, recipients)
+
+
+def handle_member_message(room, member, message, recipients):
+    """参加者から届いたメッセージ1件の処理
+
+    ヘッダーを付ける参加者のメッセージは種別で振り分ける。それ以外の参加者の
+    メッセージは全て発言で、ホストの "/exit" だけはルームを閉じる。
+    """
+    if not member.envelope:
+        broadcast_from_member(room, member, message, recipients)
+        # ホスト退出チェック
+        if member.token == room.host_token and is_exit_command(message):
+            close_chat_room(room.name)
+        return
+
+    if member.reassembler is not None:
+        # 分割されたメッセージは揃うまで待つ (扱えないものは Reassembler が捨てる)
+        envelope = member.reassembler.receive(message, time.time())
+        if envelope is None:
+            return
+    else:
+        envelope = unwrap(message)
+    kind = envelope[0] if envelope is not None else None
+    if kind == MSG_CHAT:
+        broadcast_from_member(room, member, envelope[4], recipients)
+    elif kind == MSG_LEAVE:
+        leave_room(room, member)
+    else:
+        metrics.increment("dropped_datagrams")
+
+
+def broadcast_from_member(room, member, message, recipients):
+    """参加者の発言を送信者以外に配信する"""
+    try:
+        str(message, "utf-8")  # UTF-8 として正しいかだけ確認する
+    except UnicodeDecodeError:
+        metrics.increment("dropped_datagrams")
+        return
+
+    # "ユーザー名: メッセージ" を使い回しのバッファに組み立てて、送信者以外に送信
+    payload = outbound_buffer().compose(member.prefix, message)
+    seq = room.history.append(payload) if room.history is not None else 0
+    fan_out(payload, MSG_CHAT, seq, sender_id(member), recipients, exclude=member)
+
+    if debug_messages and message_sampler.hit():
+        logger.debug(
+            "broadcast",
+            extra={
+                "room": room.name,
+                "recipients": sum(map(len, recipients)) - 1,
+                "bytes": len(payload),
+            },
+        )
+
+
+def fan_out(payload, kind, seq, sender, recipients, exclude=None):
+    """payload をルームの参加者 (exclude の Member を除く) に送信
+
+    ヘッダーを付ける参加者には、種別・連番・送信者IDを付けた1つのデータグラムを共有して送る。
+    圧縮する参加者には、1回だけ圧縮・分割したデータグラムを共有して送る。
+    """
+    addresses, envelope_addresses, compressed_addresses, reliable_members = recipients
+
+    # 信頼性レイヤーを使う送信者のアドレスはどのアドレスのタプルにも含まれない
+    skip = skip_envelope = skip_compressed = None
+    if exclude is not None and exclude.reliable is None:
+        if exclude.compression:
+            skip_compressed = exclude.address
+        elif exclude.envelope:
+            skip_envelope = exclude.address
+        else:
+            skip = exclude.address
+
+    if addresses:
+        send_datagrams(payload, addresses, skip)
+    flags = FLAG_HISTORY if seq else 0
+    enveloped = packed = None
+    if envelope_addresses or reliable_members:
+        enveloped = wrap(kind, payload, seq, sender, flags)
+    if compressed_addresses or reliable_members:
+        packed = encode(
+            kind,
+            payload,
+            seq,
+            sender,
+            flags,
+            next(fragment_ids) & 0xFFFFFFFF,
+            count=metrics.increment,
+        )
+    if envelope_addresses:
+        send_datagrams(enveloped, envelope_addresses, skip_envelope)
+    if compressed_addresses:
+        for datagram in packed:
+            send_datagrams(datagram, compressed_addresses, skip_compressed)
+    send_reliable(payload, reliable_members, exclude, enveloped, packed)
+
+
+def sender_id(member):
+    """ヘッダーに載せる送信者ID (セッションIDの参加者IDの部分)"""
+    return member.member_id
+
+
+def is_exit_command(message):
+    """ホストの退出コマンドかどうか (長いメッセージはコピーせずに判定する)"""
+    return len(message) < 16 and bytes(message).strip().lower() == b"/exit"
+
+
+def send_message_bytes_to_client(ip, message_bytes, key=None):
+    """各自にメッセージを送信 (送信バッファが一杯なら宛先のキューに入れる)
+
+    key が同じデータグラムが既にキューにあれば置き換える。
+    """
+    send_queues.send(message_bytes, ip, key)
+
+
+def broadcast_message_to_room(
+    room_name, message, exclude_token=None, kind=MSG_NOTICE, sender=0
+):
+    """ルーム内の全員にメッセージをブロードキャスト
+
+    kind と sender はヘッダーを付ける参加者に伝える種別と送信者ID。
+    """
+    room = registry.get(room_name)
+    if room is None:
+        return
+
+    with room.lock:
+        recipients = room.recipients()
+        entry = registry.get_token(exclude_token)
+        excluded = entry[1] if entry is not None and entry[0] is room else None
 
     # UDP送信
     message_bytes = message.encode("utf-8")
-    for token, ip in recipients:
-        send_message_bytes_to_client(ip, message_bytes)
+    seq = room.history.append(message_bytes) if room.history is not None else 0
+    fan_out(message_bytes, kind, seq, sender, recipients, exclude=excluded)
+
+
+def send_reliable(message_bytes, members, exclude=None, enveloped=None, packed=None):
+    """信頼性レイヤーを使う参加者に、それぞれの連番を付けて送信
+
+    enveloped (ヘッダーを付けたもの) や packed (圧縮・分割したデータグラムのリスト) を
+    渡した場合、それを使う参加者にはそちらを送る。
+    """
+    if not members:
+        return
+    now = time.time()
+    for member in members:
+        if member is exclude:
+            continue
+        if packed is not None and member.compression:
+            datagrams = packed
+        elif enveloped is not None and member.envelope:
+            datagrams = (enveloped,)
+        else:
+            datagrams = (message_bytes,)
+        for datagram in datagrams:
+            packet = member.reliable.wrap(datagram, now)
+            metrics.increment("messages_out")
+            metrics.increment("bytes_out", len(packet))
+            send_message_bytes_to_client(member.address, packet, coalesce_key(packet))
+    with retransmit_lock:
+        retransmit_members.update(m for m in members if m is not exclude)
+
+
+def send_to_member(member, message_bytes, kind=MSG_NOTICE):
+    """1人の参加者にメッセージを送信"""
+    if member.envelope:
+        message_bytes = wrap(kind, message_bytes)
+    if member.reliable is not None:
+        send_reliable(message_bytes, (member,))
+    else:
+        send_message_bytes_to_client(member.address, message_bytes)
+
+
+def retransmit_messages(now):
+    """ACK の届いていないメッセージを再送 (退出した参加者にも上限まで再送する)"""
+    with retransmit_lock:
+        members = list(retransmit_members)
+    for member in members:
+        for packet in member.reliable.due(now):
+            send_message_bytes_to_client(member.address, packet, coalesce_key(packet))
+        if not member.reliable.pending():
+            with retransmit_lock:
+                retransmit_members.discard(member)
+
+
+def drain_send_queues():
+    """送信スレッド (送信バッファが空くのを待って送信待ちキューを送る)"""
+    while not udp_closed.is_set():
+        try:
+            if send_queues.wait(CLEANUP_INTERVAL) and not send_queues.drain():
+                select.select([], [udp_socket], [], DRAIN_RETRY_INTERVAL)
+        except (OSError, ValueError):
+            # 停止時にソケットが閉じられた
+            return
+
+
+def retransmit_loop():
+    """再送スレッド"""
+    while True:
+        time.sleep(RETRANSMIT_INTERVAL)
+        retransmit_messages(time.time())
+
+
+def send_datagrams(message_bytes, addrs, exclude=None):
+    """同じメッセージを複数の宛先 (exclude のアドレスを除く) にまとめて送信"""
+    recipients = len(addrs) if exclude is None else len(addrs) - 1
+    metrics.increment("messages_out", recipients)
+    metrics.increment("bytes_out", recipients * len(message_bytes))
+
+    # 送信待ちのある宛先には、順番を保つためにキューの後ろに並べる
+    queued, addrs = send_queues.backlogged(addrs)
+
+    if udp_sender is not None:
+        addrs = udp_sender.send(message_bytes, addrs, exclude)
+    else:
+        for addr in addrs:
+            if addr != exclude:
+                send_message_bytes_to_client(addr, message_bytes)
+        addrs = ()
+
+    # 送信バッファが一杯で送れなかった宛先はキューに入れる (データは全員で共有する)
+    if queued or addrs:
+        pending = [addr for addr in (*queued, *addrs) if addr != exclude]
+        if pending:
+            send_queues.enqueue(bytes(message_bytes), pending)
 
 
 def close_chat_room(room_name):
     """チャットルームを閉じる"""
-    with rooms_lock:
-        if room_name not in chat_rooms:
-            return
-
-        room = chat_rooms[room_name]
-        tokens_to_remove = list(room["tokens"].keys())
+    room = registry.get(room_name)
+    if room is None:
+        return
 
     # 閉じるメッセージを送信
-    broadcast_message_to_room(room_name, "チャットルームが閉じられました", None)
-
-    with rooms_lock:
-        # ルームを削除
-        del chat_rooms[room_name]
+    broadcast_message_to_room(
+        room_name, "チャットルームが閉じられました", None, MSG_ROOM_CLOSED
+    )
 
-    # トークンを削除
-    with tokens_lock:
-        for token in tokens_to_remove:
-            if token in tokens:
-                del tokens[token]
+    # ルームを削除 (参加者のトークンと最終発言時刻もルームと一緒に破棄される)
+    if not registry.remove(room):
+        return
 
-    # timestampを削除
-    with timestamp_lock:
-        for token in tokens_to_remove:
-            if token in client_timestamp:
-                del client_timestamp[token]
+    credential_cache.invalidate_room(room_name)
 
-    print(f"ルーム閉鎖: {room_name}")
+    logger.info("ルーム閉鎖", extra={"room": room_name})
 
 
 def cleanup_inactive_clients():
-    """非アクティブなクライアントのクリーンアップ"""
+    """非アクティブなクライアントのクリーンアップ (次の期限まで待って処理する)"""
     while True:
-        time.sleep(CLEANUP_INTERVAL)
-        current_time = time.time()
+        time.sleep(cleanup_delay(time.time()))
+        remove_inactive_clients(time.time())
+
 
-        rooms_to_check = []
-        with rooms_lock:
-            rooms_to_check = list(chat_rooms.keys())
+def cleanup_delay(now):
+    """次の掃除までの秒数
 
-        for room_name in rooms_to_check:
-            with rooms_lock:
-                if room_name not in chat_rooms:
-                    continue
+    待っている間にハートビートで早い期限が積まれることがあるので、
+    HEARTBEAT_TIMEOUT の 1/3 より長くは待たない。
+    """
+    return expiry_queue.delay(now, min(CLEANUP_INTERVAL, HEARTBEAT_TIMEOUT / 3))
 
-                room = chat_rooms[room_name]
-                host_token = room["host_token"]
 
-            if current_time - client_timestamp.get(host_token, 0) > INACTIVITY_TIMEOUT:
-                close_chat_room(room_name)
+def remove_inactive_clients(current_time):
+    """タイムアウトしたホストのルームと参加者を削除
+
+    期限が来た参加者だけを見る。登録後に発言していれば新しい期限で積み直す。
+    ハートビートを送ってくる参加者は HEARTBEAT_TIMEOUT の間届かなければ、
+    クライアントが終了したものとして退出させる。
+    """
+    for _, (room, member) in expiry_queue.pop_due(current_time):
+        with room.lock:
+            if room.closed or room.members.get(member.member_id) is not member:
+                # 退出済み
                 continue
 
-            inactive_members = []
-            for token, ip in room["tokens"].items():
-                if token == host_token:
-                    continue
-                last_active = client_timestamp.get(token, 0)
-                if current_time - last_active > INACTIVITY_TIMEOUT:
-                    inactive_members.append((token, ip))
-
-            for token, ip in inactive_members:
-                send_message_bytes_to_client(
-                    ip,
-                    "しばらく発言しなかったので、チャットルームから退出させました".encode(
-                        "utf-8"
-                    ),
-                )
-                with rooms_lock:
-                    del room["tokens"][token]
-                with tokens_lock:
-                    del tokens[token]
-                with timestamp_lock:
-                    del client_timestamp[token]
+            timeout = HEARTBEAT_TIMEOUT if member.heartbeat else INACTIVITY_TIMEOUT
+            deadline = member.last_active + timeout
+            if deadline >= current_time:
+                expiry_queue.schedule(deadline, (room, member))
+                continue
+
+            is_host = member.token == room.host_token
+            if not is_host:
+                registry.remove_member(room, member)
+
+        if member.heartbeat:
+            metrics.increment("heartbeat_timeouts")
+        if is_host:
+            close_chat_room(room.name)
+            continue
+
+        if member.heartbeat:
+            notice = "応答が無かったので、チャットルームから退出させました"
+        else:
+            notice = "しばらく発言しなかったので、チャットルームから退出させました"
+        send_to_member(member, notice.encode("utf-8"), MSG_EVICTED)
+
+
+def configure_password_hasher(
+    workers=DEFAULT_HASH_WORKERS,
+    use_processes=False,
+    rounds=DEFAULT_BCRYPT_ROUNDS,
+    room_admission_limit=DEFAULT_ROOM_ADMISSION_LIMIT,
+):
+    """パスワード処理用ワーカープールを設定し直す"""
+    global password_hasher
+    password_hasher.shutdown()
+    password_hasher = PasswordHasher(
+        workers, use_processes, rounds, room_admission_limit
+    )
+
+
+def configure_credential_cache(max_entries=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+    """認証キャッシュを設定し直す"""
+    global credential_cache
+    credential_cache = CredentialCache(max_entries, ttl)
+
+
+def configure_rate_limits(
+    member_rate=DEFAULT_MEMBER_RATE,
+    member_burst=DEFAULT_MEMBER_BURST,
+    address_rate=DEFAULT_ADDRESS_RATE,
+    address_burst=DEFAULT_ADDRESS_BURST,
+    max_entries=DEFAULT_MAX_ENTRIES,
+):
+    """UDP の流量制限を設定し直す (rate が 0 なら制限しない)"""
+    global member_limiter, address_limiter
+
+    def count_eviction():
+        metrics.increment("rate_limit_evictions")
+
+    member_limiter = address_limiter = None
+    if member_rate > 0:
+        member_limiter = RateLimiter(
+            member_rate, member_burst, max_entries, on_evict=count_eviction
+        )
+    if address_rate > 0:
+        address_limiter = RateLimiter(
+            address_rate, address_burst, max_entries, on_evict=count_eviction
+        )
+
+
+def configure_cluster(spec, node_index, secret, broker=DEFAULT_BROKER):
+    """複数のサーバーでルームを分担する (spec は全ノード共通の "host:tcp:udp:broker,...")
+
+    ルームの担当はワーカーと同じくルーム名のハッシュで決めるので、
+    ノード間で共有する情報はノードの並びと、ノード間の通信に MAC を付ける
+    共有鍵 secret だけで済む。
+    """
+    global worker_index, worker_count, worker_channels, registry
+    global TCP_HOST, TCP_PORT, UDP_HOST, UDP_PORT
+    nodes = parse_nodes(spec)
+    node = nodes[node_index]
+    TCP_HOST, TCP_PORT, UDP_HOST, UDP_PORT = (
+        node.host,
+        node.tcp_port,
+        node.host,
+        node.udp_port,
+    )
+    worker_index = node_index
+    worker_count = len(nodes)
+    worker_channels = ClusterChannels(
+        nodes,
+        node_index,
+        BROKERS[broker](nodes, node_index),
+        secret.encode("utf-8"),
+        count=metrics.increment,
+    )
+    # ルームIDから担当ノードが分かるように、ID をノード数おきに割り当てる
+    registry = RoomRegistry(node_index + worker_count, worker_count, HISTORY_LIMITS)
+    logger.info("クラスタのノード %d/%d として起動します", node_index, worker_count)
+
+
+def configure_logging_and_metrics(
+    level=DEFAULT_LOG_LEVEL,
+    json_output=False,
+    sample_rate=DEFAULT_LOG_SAMPLE_RATE,
+    path=None,
+    interval=METRICS_INTERVAL,
+):
+    """ログの出力先と統計の書き出し先を設定"""
+    global debug_messages, message_sampler, metrics_file, METRICS_INTERVAL
+    configure_logging(
+        level,
+        json_output,
+        on_drop=lambda: metrics.increment("log_records_dropped"),
+    )
+    debug_messages = logger.isEnabledFor(logging.DEBUG)
+    message_sampler = Sampler(sample_rate)
+    metrics_file = path
+    METRICS_INTERVAL = interval
+
+
+def metrics_path():
+    """このプロセスの統計ファイル (複数ワーカー構成ではワーカー番号を付ける)"""
+    if worker_channels is None:
+        return metrics_file
+    return f"{metrics_file}.{worker_index}"
+
+
+def open_state_log():
+    """--state-dir の状態を復元し、以降の変更を記録する"""
+    global state_log
+    if STATE_DIR is None:
+        return
+
+    directory = STATE_DIR
+    if worker_channels is not None:
+        # ワーカーごとに担当するルームだけを記録する
+        directory = os.path.join(STATE_DIR, str(worker_index))
+    state_log = StateLog(
+        directory,
+        STATE_COMMIT_INTERVAL,
+        STATE_SNAPSHOT_INTERVAL,
+        count=metrics.increment,
+    )
+
+    start = time.perf_counter()
+    rooms, members = state_log.restore(registry, restored_reliable_channel)
+    now = time.time()
+    for room in registry.snapshot():
+        for member in room.members.values():
+            # 停止していた間は無発言として数えない
+            member.last_active = now
+            expiry_queue.schedule(now + INACTIVITY_TIMEOUT, (room, member))
+            if member.compression:
+                member.reassembler = Reassembler(count=metrics.increment)
+    state_log.start(registry)
+    registry.journal = state_log
+    logger.info(
+        "状態を復元しました",
+        extra={
+            "rooms": rooms,
+            "members": members,
+            "seconds": round(time.perf_counter() - start, 3),
+        },
+    )
+
+
+def restored_reliable_channel():
+    """復元した参加者の ReliableChannel
+
+    停止前の連番は記録していないので、停止前より大きくなるよう現在時刻 (秒) から
+    始める。クライアントの受信側は base を見てそこまで飛ばす。
+    """
+    return ReliableChannel(
+        count=metrics.increment, first_seq=int(time.time()) & 0x7FFFFFFF
+    )
 
 
-def start_server():
+def close_state_log():
+    """記録を止めて、溜まっている記録を書き込む
+
+    停止時に切断される制御セッションの退出は記録しない (再起動後も参加したままにする)。
+    """
+    if state_log is None:
+        return
+    registry.journal = None
+    state_log.close()
+
+
+def start_server(engine=DEFAULT_ENGINE, backlog=TCP_BACKLOG, workers=1):
     """サーバー起動"""
+    if workers > 1:
+        start_worker_processes(engine, backlog, workers)
+        return
+
+    open_state_log()
+    if metrics_file:
+        metrics.start_exporter(metrics_path(), METRICS_INTERVAL)
+
+    if engine == ENGINE_THREAD:
+        start_threaded_server(backlog)
+    else:
+        try:
+            asyncio.run(run_async_server(backlog))
+        except KeyboardInterrupt:
+            logger.info("サーバー停止中...")
+        finally:
+            udp_closed.set()
+            password_hasher.shutdown()
+            report_metrics()
+
+
+def report_metrics():
+    """停止時の統計を出力"""
+    snapshot = metrics.snapshot()
+    if metrics_file:
+        metrics.write(metrics_path())
+    logger.info("サーバー停止完了", extra={"metrics": snapshot})
+
+
+def start_worker_processes(engine, backlog, workers):
+    """SO_REUSEPORT で同じポートを共有するワーカープロセスを起動"""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        logger.error(
+            "この環境では SO_REUSEPORT が使えないため --workers は指定できません"
+        )
+        return
+
+    # SIGTERM で停止されたときも、ワーカーを停止させてから終了する
+    # (ワーカーが残るとポートを使い続ける)
+    signal.signal(signal.SIGTERM, interrupt)
+    processes = start_workers(run_worker, workers, engine, backlog)
+    logger.info("ワーカー %d 個を起動しました", workers)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # ワーカーは SIGINT を無視しているので SIGTERM で停止させる
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+def interrupt(signum, frame):
+    """SIGTERM で KeyboardInterrupt と同じ終了処理を行う"""
+    raise KeyboardInterrupt
+
+
+def watch_parent(parent_pid):
+    """親プロセスが終了したら (SIGKILL などで後始末されなかった場合) ワーカーを停止する"""
+    while os.getppid() == parent_pid:
+        time.sleep(PARENT_CHECK_INTERVAL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def run_worker(index, channels, engine, backlog):
+    """ワーカープロセスの本体 (担当するルームだけを管理する)"""
+    global worker_index, worker_count, worker_channels, registry
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, interrupt)
+    threading.Thread(target=watch_parent, args=(os.getppid(),), daemon=True).start()
+    channels.bind(index)
+    worker_index = index
+    worker_count = channels.worker_count
+    worker_channels = channels
+
+    # ルームIDから担当ワーカーが分かるように、ID を worker_count おきに割り当てる
+    registry = RoomRegistry(index + worker_count, worker_count, HISTORY_LIMITS)
+    start_server(engine, backlog)
+    shutdown_logging()
+
+
+def start_threaded_server(backlog=TCP_BACKLOG):
+    """スレッドモードでサーバー起動 (接続ごとにスレッドを生成)"""
     # TCP ソケット設定
     tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     tcp_socket.setsockopt(
         socket.SOL_SOCKET, socket.SO_REUSEADDR, 1
     )  # 即座のアドレス再利用許可
+    if worker_channels is not None:
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     tcp_socket.bind((TCP_HOST, TCP_PORT))
-    tcp_socket.listen(5)  # 同時接続数
+    tcp_socket.listen(backlog)  # 同時接続数
 
     # UDP ソケット設定
-    global udp_socket
+    global udp_socket, udp_sender, send_queues
     udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if worker_channels is not None:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     udp_socket.bind((UDP_HOST, UDP_PORT))
+    udp_sender = BatchSender(udp_socket, UDP_BATCH_SIZE)
+    send_queues = SendQueues(udp_socket, SEND_QUEUE_DEPTH, metrics.increment)
+
+    # 送信待ちキューの送信スレッド起動
+    send_thread = threading.Thread(target=drain_send_queues, daemon=True)
+    send_thread.start()
 
     # UDP処理スレッド起動
     udp_thread = threading.Thread(
@@ -455,7 +1648,18 @@ def start_server():
     cleanup_thread = threading.Thread(target=cleanup_inactive_clients, daemon=True)
     cleanup_thread.start()
 
-    print(f"サーバー起動: TCP {TCP_HOST}:{TCP_PORT}, UDP {UDP_HOST}:{UDP_PORT}")
+    # 信頼性レイヤーの再送スレッド起動
+    retransmit_thread = threading.Thread(target=retransmit_loop, daemon=True)
+    retransmit_thread.start()
+
+    # ワーカー間通信スレッド起動
+    if worker_channels is not None:
+        worker_thread = threading.Thread(target=handle_worker_messages, daemon=True)
+        worker_thread.start()
+
+    logger.info(
+        "サーバー起動: TCP %s:%s, UDP %s:%s", TCP_HOST, TCP_PORT, UDP_HOST, UDP_PORT
+    )
 
     try:
         while True:
@@ -469,29 +1673,596 @@ def start_server():
             client_thread.start()
 
     except KeyboardInterrupt:
-        print("サーバー停止中...")
+        logger.info("サーバー停止中...")
     finally:
+        close_state_log()
         tcp_socket.close()
         udp_closed.set()
         udp_socket.close()
-        print("サーバー停止完了")
+        password_hasher.shutdown()
+        report_metrics()
+
+
+async def handle_tcp_stream(reader, writer, frame=None):
+    """TCP接続の処理 (asyncio, frame は他のワーカーが受信済みのデータ)"""
+    client_address = writer.get_extra_info("peername")
+    frames = AsyncFrameReader(reader, MAX_FRAME_SIZE, frame or b"")
+    try:
+        request_frame = await frames.read()
+        if request_frame is None:
+            logger.warning("Invalid Header", extra={"client": client_address})
+            return
+        # 他のノードが中継した接続なら、元のクライアントのアドレスに置き換える
+        forwarded = forwarded_address(request_frame)
+        if forwarded is not None:
+            client_address = forwarded
+            request_frame = await frames.read()
+            if request_frame is None:
+                return
+        room_name, operation, state, payload = request_frame
+
+        # 担当外のルームなら接続ごと担当ワーカー (ノード) へ渡す
+        owner = owner_of(room_name, worker_count)
+        if owner != worker_index:
+            await worker_channels.forward_stream(
+                owner,
+                reader,
+                writer,
+                client_address,
+                request_frame.encode() + frames.pending(),
+            )
+            return
+
+        if operation not in SESSION_OPERATIONS or state != REQUEST:
+            return
+
+        try:
+            request_data = json.loads(payload.decode("utf-8"))
+        except json.JSONDecodeError:
+            # 不正なペイロード
+            if operation in (CREATE_ROOM, JOIN_ROOM):
+                writer.write(
+                    build_tcp_response(
+                        room_name, operation, ACKNOWLEDGE, INVALID_PASSWORD
+                    )
+                )
+                await writer.drain()
+            return
+
+        username = request_data.get("username", "")
+        password = request_data.get("password", "")
+        features = request_data.get("features", [])
+
+        if operation not in (CREATE_ROOM, JOIN_ROOM):
+            if refuses_session(features):
+                response = {"request_id": request_data.get("request_id")}
+                response["status"] = INVALID_REQUEST
+                writer.write(build_session_response(room_name, operation, response))
+                await writer.drain()
+            elif FEATURE_CONTROL_SESSION in features:
+                # ルーム一覧の取得などから始める制御セッション
+                session = ControlSession(client_address, features)
+                first_request = (room_name, operation, request_data)
+                await run_control_session_async(frames, writer, session, first_request)
+            return
+
+        if invalid_udp_port(request_data) or refuses_session(features):
+            writer.write(
+                build_tcp_response(room_name, operation, ACKNOWLEDGE, INVALID_REQUEST)
+            )
+            await writer.drain()
+            return
+
+        status, member = await room_request_async(
+            operation, room_name, username, client_address, password
+        )
+        writer.write(build_tcp_response(room_name, operation, ACKNOWLEDGE, status))
+        if status != SUCCESS:
+            await writer.drain()
+            return
+
+        # UDP port がリクエストに含まれていれば、完了応答と参加メッセージより前に登録する
+        udp_port = request_data.get("udp_port")
+        if udp_port is not None:
+            register_udp_address(
+                room_name, member, (client_address[0], udp_port), features
+            )
+
+        # トークン送信
+        writer.write(
+            build_tcp_complete(room_name, operation, complete_payload(member, features))
+        )
+        await writer.drain()
+
+        if operation == JOIN_ROOM:
+            # 参加メッセージをルームに送信
+            broadcast_join_message(room_name, member)
+
+        # UDP port 受信 (リクエストに含まれていなければ2バイトで受け取る)
+        if udp_port is None:
+            udp_port = int.from_bytes(await frames.read_exact(2), "big")
+            register_udp_address(
+                room_name, member, (client_address[0], udp_port), features
+            )
 
+        if FEATURE_CONTROL_SESSION in features:
+            # 参加後も接続を制御セッションとして使う
+            session = ControlSession(client_address, features)
+            add_session_member(session, room_name, member)
+            await run_control_session_async(frames, writer, session)
 
-def hash_password(password):
-    """パスワードをハッシュ化する"""
-    password_bytes = password.encode("utf-8")
-    hashed = bcrypt.hashpw(password_bytes, bcrypt.gensalt(12)).decode("utf-8")
-    return hashed
+    except (FrameError, asyncio.IncompleteReadError) as e:
+        logger.warning("Invalid Frame: %s", e, extra={"client": client_address})
+    except Exception as e:
+        logger.error("TCP処理エラー: %s", e, extra={"client": client_address})
+    except asyncio.CancelledError:
+        # サーバー停止時に待機中だった制御セッション
+        pass
+    finally:
+        writer.close()
+
+
+async def room_request_async(operation, room_name, username, client_address, password):
+    """ルーム作成・参加を行い (ステータスコード, Member) を返す (asyncio)
+
+    bcrypt はワーカープールで実行し、その間イベントループは他の接続を処理する
+    """
+    if operation == CREATE_ROOM:
+        status, future = prepare_create_room(room_name, password)
+        if status != SUCCESS:
+            return status, None
+        hashed_password = await asyncio.wrap_future(future)
+        return register_room(room_name, username, client_address, hashed_password)
+
+    status, hashed_password, future = prepare_join_room(room_name, password)
+    if status != SUCCESS:
+        return status, None
+    verified = await asyncio.wrap_future(future)
+    return register_member(
+        room_name, username, client_address, hashed_password, verified
+    )
+
+
+async def run_control_session_async(frames, writer, session, first_request=None):
+    """制御セッションのリクエストを接続が切れるまで処理する (asyncio)"""
+    try:
+        request = first_request
+        while True:
+            if request is None:
+                try:
+                    request_frame = await asyncio.wait_for(
+                        frames.read(), SESSION_IDLE_TIMEOUT
+                    )
+                except (asyncio.TimeoutError, OSError):
+                    # タイムアウト (ハートビートが途絶えた) も切断として扱う
+                    break
+                if request_frame is None:
+                    break
+                request = decode_session_request(request_frame)
+
+            room_name, operation, request_data = request
+            request = None
+            if operation in (CREATE_ROOM, JOIN_ROOM) and request_data is not None:
+                status, member = INVALID_REQUEST, None
+                if owns_room(room_name) and not invalid_udp_port(request_data):
+                    status, member = await room_request_async(
+                        operation,
+                        room_name,
+                        request_data.get("username", ""),
+                        session.client_address,
+                        request_data.get("password", ""),
+                    )
+                response = finish_session_join(
+                    session, room_name, operation, request_data, status, member
+                )
+            else:
+                response = process_session_request(
+                    session, room_name, operation, request_data
+                )
+            writer.write(
+                build_session_response(
+                    room_name, operation, response, wants_compression(request_data)
+                )
+            )
+            await writer.drain()
+    except asyncio.CancelledError:
+        # サーバーの停止: 再起動後も参加したままにするので退出させない
+        session.close()
+        raise
+    finally:
+        close_control_session(session)
+
+
+class ChatDatagramProtocol(asyncio.DatagramProtocol):
+    """UDP メッセージ処理 (asyncio)"""
 
+    def __init__(self):
+        self.receiver = None
 
-def verify_password(plain_password, hashed_password):
-    """ハッシュ化されたパスワードを検証する"""
-    password_bytes = plain_password.encode('utf-8')
-    if isinstance(hashed_password, str):
-        hashed_password = hashed_password.encode("utf-8")
-    result = bcrypt.checkpw(password_bytes, hashed_password)
-    return result
+    def connection_made(self, transport):
+        global udp_socket, udp_sender, send_queues
+        sock = transport.get_extra_info("socket")
+
+        # 送信は transport (上限なしにバッファする) を通さず、複製したソケットから
+        # ノンブロッキングで行い、送れなかった分は宛先ごとのキューに入れる
+        udp_socket = socket.fromfd(sock.fileno(), sock.family, sock.type)
+        send_queues = SendQueues(udp_socket, SEND_QUEUE_DEPTH, metrics.increment)
+        loop = asyncio.get_running_loop()
+        send_queues.on_backlog = lambda: loop.call_soon_threadsafe(
+            loop.add_writer, udp_socket.fileno(), drain_send_queues_async
+        )
+
+        # recvmmsg / sendmmsg が使える場合はソケットを直接読み書きしてまとめて処理する
+        # (使えない場合は transport 経由で1件ずつ受信する)
+        if HAVE_MMSG:
+            self.receiver = BatchReceiver(sock, UDP_BATCH_SIZE)
+            udp_sender = BatchSender(sock, UDP_BATCH_SIZE)
+
+    def datagram_received(self, data, addr):
+        handle_datagram(data, addr)
+
+        # 同じ起床で届いている残りのデータグラムもまとめて処理
+        if self.receiver is not None:
+            try:
+                datagrams = self.receiver.receive(block=False)
+            except OSError as e:
+                logger.error("UDP message handle error: %s", e)
+                return
+
+            for data, addr in datagrams:
+                handle_datagram(data, addr)
+
+
+def drain_send_queues_async():
+    """送信バッファが空いたら送信待ちキューを送る (asyncio)"""
+    if send_queues.drain():
+        asyncio.get_running_loop().remove_writer(udp_socket.fileno())
+
+
+def receive_worker_messages():
+    """他のワーカーから転送された通信の処理 (asyncio)"""
+    while True:
+        try:
+            kind, payload, addr, client_socket = worker_channels.receive(
+                socket.MSG_DONTWAIT
+            )
+        except BlockingIOError:
+            return
+        except Exception as e:
+            logger.error("ワーカー間通信エラー: %s", e)
+            return
+
+        if kind == "datagram":
+            handle_datagram(payload, addr)
+        else:
+            asyncio.create_task(handle_forwarded_connection(client_socket, payload))
+
+
+async def handle_forwarded_connection(client_socket, frame):
+    """他のワーカーから渡された TCP 接続の処理 (asyncio)"""
+    reader, writer = await asyncio.open_connection(sock=client_socket)
+    await handle_tcp_stream(reader, writer, frame)
+
+
+async def cleanup_inactive_clients_async():
+    """非アクティブなクライアントのクリーンアップ (asyncio)"""
+    while True:
+        await asyncio.sleep(cleanup_delay(time.time()))
+        remove_inactive_clients(time.time())
+
+
+async def retransmit_loop_async():
+    """信頼性レイヤーの再送 (asyncio)"""
+    while True:
+        await asyncio.sleep(RETRANSMIT_INTERVAL)
+        retransmit_messages(time.time())
+
+
+async def run_async_server(backlog=TCP_BACKLOG):
+    """asyncio モードでサーバー起動 (単一のイベントループで全接続を処理)"""
+    loop = asyncio.get_running_loop()
+
+    # 複数ワーカー構成では同じポートを SO_REUSEPORT で共有する
+    reuse_port = worker_channels is not None
+
+    # UDP エンドポイント設定
+    transport, _ = await loop.create_datagram_endpoint(
+        ChatDatagramProtocol, local_addr=(UDP_HOST, UDP_PORT), reuse_port=reuse_port
+    )
+
+    # TCP サーバー設定
+    tcp_server = await asyncio.start_server(
+        handle_tcp_stream,
+        TCP_HOST,
+        TCP_PORT,
+        backlog=backlog,
+        reuse_address=True,
+        reuse_port=reuse_port,
+    )
+
+    # ワーカー間通信
+    if worker_channels is not None:
+        loop.add_reader(worker_channels.receiver.fileno(), receive_worker_messages)
+
+    cleanup_task = asyncio.create_task(cleanup_inactive_clients_async())
+    retransmit_task = asyncio.create_task(retransmit_loop_async())
+
+    logger.info(
+        "サーバー起動: TCP %s:%s, UDP %s:%s", TCP_HOST, TCP_PORT, UDP_HOST, UDP_PORT
+    )
+
+    try:
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    finally:
+        close_state_log()
+        cleanup_task.cancel()
+        retransmit_task.cancel()
+        transport.close()
+        if udp_socket is not None:
+            udp_socket.close()
+
+
+def positive_seconds(value):
+    """argparse の type: 0 より大きい秒数 (0 以下の間隔では待たずに回り続ける)"""
+    seconds = float(value)
+    if not seconds > 0:
+        raise argparse.ArgumentTypeError(f"0 より大きい秒数を指定してください: {value}")
+    return seconds
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="チャットメッセンジャーサーバー")
+    parser.add_argument(
+        "--engine",
+        choices=[ENGINE_ASYNCIO, ENGINE_THREAD],
+        default=DEFAULT_ENGINE,
+        help="サーバーエンジン (thread は接続ごとにスレッドを生成する従来方式)",
+    )
+    parser.add_argument(
+        "--backlog", type=int, default=TCP_BACKLOG, help="TCP accept 待ちキューの長さ"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="ワーカープロセス数 (2 以上で SO_REUSEPORT によりポートを共有し、"
+        "ルームをワーカー間で分担する)",
+    )
+    parser.add_argument(
+        "--cluster-nodes",
+        help="複数のサーバーでルームを分担する場合の全ノードの "
+        '"host:tcp_port:udp_port:broker_port" をカンマ区切りで (全ノードで同じ並び)',
+    )
+    parser.add_argument(
+        "--node-index",
+        type=int,
+        default=0,
+        help="--cluster-nodes のうち、このサーバーの番号 (0 から)",
+    )
+    parser.add_argument(
+        "--cluster-broker",
+        choices=sorted(BROKERS),
+        default=DEFAULT_BROKER,
+        help="ノード間でデータグラムを転送するブローカー",
+    )
+    parser.add_argument(
+        "--cluster-secret",
+        default=os.environ.get("CHAT_CLUSTER_SECRET"),
+        help="ノード間の通信を認証する全ノード共通の鍵 "
+        "(省略時は環境変数 CHAT_CLUSTER_SECRET。--cluster-nodes には必須)",
+    )
+    parser.add_argument(
+        "--no-control-session",
+        action="store_true",
+        help="制御セッションを受け付けない (参加後に TCP 接続を閉じる旧形式だけを使う)。"
+        "--workers / --cluster-nodes では必須",
+    )
+    parser.add_argument(
+        "--max-frame-size",
+        type=int,
+        default=DEFAULT_MAX_FRAME_SIZE,
+        help="TCP リクエストのルーム名 + ペイロードの上限 (バイト)。"
+        "超えたリクエストを送った接続は切断する",
+    )
+    parser.add_argument(
+        "--udp-batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="1回のシステムコールで送受信するデータグラム数の上限",
+    )
+    parser.add_argument(
+        "--send-queue-depth",
+        type=int,
+        default=DEFAULT_QUEUE_DEPTH,
+        help="送信バッファが一杯のときに宛先ごとに溜めるデータグラム数の上限 "
+        "(超えたら古いものから捨てる。0 で溜めずに捨てる)",
+    )
+    parser.add_argument(
+        "--member-rate",
+        type=float,
+        default=DEFAULT_MEMBER_RATE,
+        help="1参加者あたりの毎秒の UDP データグラム数の上限 (0 で制限しない)",
+    )
+    parser.add_argument(
+        "--member-burst",
+        type=int,
+        default=DEFAULT_MEMBER_BURST,
+        help="1参加者が続けて送れる UDP データグラム数",
+    )
+    parser.add_argument(
+        "--address-rate",
+        type=float,
+        default=DEFAULT_ADDRESS_RATE,
+        help="1送信元アドレスあたりの毎秒の UDP データグラム数の上限 (0 で制限しない)",
+    )
+    parser.add_argument(
+        "--address-burst",
+        type=int,
+        default=DEFAULT_ADDRESS_BURST,
+        help="1送信元アドレスが続けて送れる UDP データグラム数",
+    )
+    parser.add_argument(
+        "--rate-limit-entries",
+        type=int,
+        default=DEFAULT_MAX_ENTRIES,
+        help="流量制限のバケット数の上限 (参加者・アドレスそれぞれ、1件 16 バイト)",
+    )
+    parser.add_argument(
+        "--heartbeat-timeout",
+        type=positive_seconds,
+        default=HEARTBEAT_TIMEOUT,
+        help="UDP のハートビートを送ってくる参加者を、届かなくなってから退出させるまでの秒数",
+    )
+    parser.add_argument(
+        "--history-messages",
+        type=int,
+        default=DEFAULT_HISTORY_MESSAGES,
+        help="ルームごとに保持する最近のメッセージの件数 (0 で履歴を保持しない)",
+    )
+    parser.add_argument(
+        "--history-bytes",
+        type=int,
+        default=DEFAULT_HISTORY_BYTES,
+        help="ルームごとに保持する最近のメッセージの合計バイト数の上限"
+        " (1件は HISTORY の応答の1フレームに収まる長さに切り詰める)",
+    )
+    parser.add_argument(
+        "--state-dir",
+        help="ルームと参加者の状態を記録するディレクトリ。"
+        "指定すると再起動時に復元する",
+    )
+    parser.add_argument(
+        "--state-commit-interval",
+        type=positive_seconds,
+        default=DEFAULT_COMMIT_INTERVAL,
+        help="状態の記録をまとめて書き込むまで待つ秒数",
+    )
+    parser.add_argument(
+        "--state-snapshot-interval",
+        type=positive_seconds,
+        default=DEFAULT_SNAPSHOT_INTERVAL,
+        help="状態のスナップショットを作り直す間隔 (秒)",
+    )
+    parser.add_argument(
+        "--hash-workers",
+        type=int,
+        default=DEFAULT_HASH_WORKERS,
+        help="パスワード処理のワーカー数",
+    )
+    parser.add_argument(
+        "--hash-processes",
+        action="store_true",
+        help="パスワード処理をスレッドではなくプロセスプールで実行する",
+    )
+    parser.add_argument(
+        "--bcrypt-rounds",
+        type=int,
+        default=DEFAULT_BCRYPT_ROUNDS,
+        help="bcrypt のコストファクター",
+    )
+    parser.add_argument(
+        "--room-admission-limit",
+        type=int,
+        default=DEFAULT_ROOM_ADMISSION_LIMIT,
+        help="1ルームあたりの同時パスワード処理数 (超過分は SERVER_BUSY を返す)",
+    )
+    parser.add_argument(
+        "--credential-cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help="検証済みパスワードのキャッシュ件数 (0 で無効)",
+    )
+    parser.add_argument(
+        "--credential-cache-ttl",
+        type=positive_seconds,
+        default=DEFAULT_CACHE_TTL,
+        help="検証済みパスワードのキャッシュ有効期間 (秒)",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default=DEFAULT_LOG_LEVEL,
+        help="ログレベル (DEBUG でメッセージ単位のログを出力する)",
+    )
+    parser.add_argument(
+        "--log-format",
+        choices=["text", "json"],
+        default="text",
+        help="ログの形式",
+    )
+    parser.add_argument(
+        "--log-sample-rate",
+        type=int,
+        default=DEFAULT_LOG_SAMPLE_RATE,
+        help="メッセージ単位の DEBUG ログを N 件に1件だけ出力する",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="統計 (送受信数・破棄数・認証失敗数など) を JSON で書き出すファイル",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=positive_seconds,
+        default=METRICS_INTERVAL,
+        help="統計を書き出す間隔 (秒)",
+    )
+    args = parser.parse_args()
+    if args.cluster_nodes and args.workers > 1:
+        parser.error("--cluster-nodes と --workers は同時に指定できません")
+    # 制御セッションは最初のリクエストのルームを担当するワーカーが受け持ち、
+    # 他のワーカーのルームの参加や一覧を扱えない
+    if (args.cluster_nodes or args.workers > 1) and not args.no_control_session:
+        parser.error("--workers / --cluster-nodes には --no-control-session が必要です")
+    if args.cluster_nodes and not args.cluster_secret:
+        parser.error("--cluster-nodes には --cluster-secret が必要です")
+    # 担当外のルームへの接続は受信済みのデータを添えて転送するので IPC に収める
+    if args.max_frame_size + HEADER_SIZE > MAX_FORWARDED_DATA_SIZE:
+        parser.error(
+            f"--max-frame-size は {MAX_FORWARDED_DATA_SIZE - HEADER_SIZE} 以下"
+        )
+    return args
 
 
 if __name__ == "__main__":
-    start_server()
+    args = parse_args()
+    configure_logging_and_metrics(
+        args.log_level,
+        args.log_format == "json",
+        args.log_sample_rate,
+        args.metrics_file,
+        args.metrics_interval,
+    )
+    configure_password_hasher(
+        args.hash_workers,
+        args.hash_processes,
+        args.bcrypt_rounds,
+        args.room_admission_limit,
+    )
+    configure_credential_cache(args.credential_cache_size, args.credential_cache_ttl)
+    configure_rate_limits(
+        args.member_rate,
+        args.member_burst,
+        args.address_rate,
+        args.address_burst,
+        args.rate_limit_entries,
+    )
+    UDP_BATCH_SIZE = args.udp_batch_size
+    SEND_QUEUE_DEPTH = args.send_queue_depth
+    HEARTBEAT_TIMEOUT = args.heartbeat_timeout
+    CONTROL_SESSIONS = not args.no_control_session
+    MAX_FRAME_SIZE = args.max_frame_size
+    HISTORY_LIMITS = (args.history_messages, args.history_bytes)
+    STATE_DIR = args.state_dir
+    STATE_COMMIT_INTERVAL = args.state_commit_interval
+    STATE_SNAPSHOT_INTERVAL = args.state_snapshot_interval
+    registry = RoomRegistry(history_limits=HISTORY_LIMITS)
+    if args.cluster_nodes:
+        configure_cluster(
+            args.cluster_nodes,
+            args.node_index,
+            args.cluster_secret,
+            args.cluster_broker,
+        )
+    start_server(args.engine, args.backlog, args.workers)
+    shutdown_logging()
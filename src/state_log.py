@@ -0,0 +1,401 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from room_registry import Member
+
+# 既定値
+DEFAULT_COMMIT_INTERVAL = 0.005  # 記録をまとめて書き込むまで待つ秒数 (グループコミット)
+DEFAULT_SNAPSHOT_INTERVAL = 60  # スナップショットを作り直す間隔 (秒)
+
+SNAPSHOT_FILE = "snapshot.bin"
+SEGMENT_FORMAT = "wal.{:08d}.log"
+SNAPSHOT_MAGIC = b"OCMS"
+
+# 記録の種別
+ROOM_CREATED = 1
+MEMBER_JOINED = 2
+MEMBER_ADDRESS = 3
+MEMBER_LEFT = 4
+ROOM_CLOSED = 5
+
+# 記録: ボディの長さ, ボディの CRC32 + ボディ (種別 1 バイト + 項目)
+RECORD_HEADER = struct.Struct("!II")
+SNAPSHOT_HEADER = struct.Struct("!4sI")  # マジック, 続きを記録しているセグメント番号
+_ROOM = struct.Struct("!BI")  # 種別, ルームID
+_MEMBER = struct.Struct("!BIQ")  # 種別, ルームID, 参加者ID
+_STRING_SIZE = struct.Struct("!H")
+_PORT = struct.Struct("!H")
+_FLAGS = struct.Struct("!B")
+FLAG_RELIABLE = 1
+FLAG_ENVELOPE = 2
+FLAG_COMPRESSION = 4
+
+
+def _string(value):
+    data = value.encode("utf-8")
+    return _STRING_SIZE.pack(len(data)) + data
+
+
+def _record(body):
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def _member_key(kind, room, member):
+    return _MEMBER.pack(kind, room.room_id, member.member_id)
+
+
+def has_host(registry, room):
+    """ルームのホストが参加者として登録されているか"""
+    entry = registry.get_token(room.host_token)
+    return entry is not None and entry[0] is room
+
+
+def encode_room_created(room):
+    return _record(
+        _ROOM.pack(ROOM_CREATED, room.room_id)
+        + _string(room.name)
+        + _string(room.host_token)
+        + _string(room.password)
+    )
+
+
+def encode_member_joined(room, member):
+    ip, port = member.address
+    return _record(
+        _member_key(MEMBER_JOINED, room, member)
+        + _string(member.token)
+        + _string(member.username)
+        + _string(ip)
+        + _PORT.pack(port)
+    )
+
+
+def encode_member_address(room, member):
+    ip, port = member.address
+    flags = FLAG_RELIABLE if member.reliable is not None else 0
+    if member.envelope:
+        flags |= FLAG_ENVELOPE
+    if member.compression:
+        flags |= FLAG_COMPRESSION
+    return _record(
+        _member_key(MEMBER_ADDRESS, room, member)
+        + _string(ip)
+        + _PORT.pack(port)
+        + _FLAGS.pack(flags)
+    )
+
+
+def encode_member_left(room, member):
+    return _record(_member_key(MEMBER_LEFT, room, member))
+
+
+def encode_room_closed(room):
+    return _record(_ROOM.pack(ROOM_CLOSED, room.room_id))
+
+
+class _Fields:
+    """記録のボディから項目を順に取り出す"""
+
+    def __init__(self, body):
+        self.body = body
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = fmt.unpack_from(self.body, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def string(self):
+        (size,) = self.unpack(_STRING_SIZE)
+        start = self.offset
+        self.offset += size
+        return str(self.body[start : self.offset], "utf-8")
+
+
+def read_records(path, offset=0):
+    """ファイルの offset 以降の記録を (種別, _Fields) で順に返す
+
+    ファイルは mmap して読み、コピーせずに解析する。途中で壊れた記録
+    (書き込み途中で停止した末尾など) があればそこで止める。
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                end = len(view)
+                while offset + RECORD_HEADER.size <= end:
+                    size, crc = RECORD_HEADER.unpack_from(view, offset)
+                    start = offset + RECORD_HEADER.size
+                    with view[start : start + size] as body:
+                        if size == 0 or len(body) < size or zlib.crc32(body) != crc:
+                            return
+                        yield body[0], _Fields(body)
+                    offset = start + size
+
+
+class StateLog:
+    """ルームと参加者の状態の追記専用ログとスナップショット
+
+    ルームの作成・参加・アドレス登録・退出・閉鎖を長さ付きのバイナリ記録として
+    セグメントファイルに追記する。記録を呼び出し元で組み立てて溜めておき、書き込み
+    スレッドが commit_interval ごとにまとめて write と fsync を1回ずつ行うので、
+    参加処理やメッセージ配信はディスクを待たない。
+    snapshot_interval ごとに現在の状態だけをスナップショットに書き出し、それより前の
+    セグメントを削除する。起動時はスナップショットとその後のセグメントを再生する。
+    count(name, value) には書き込んだ記録数とコミット数が通知される。
+    """
+
+    def __init__(
+        self,
+        directory,
+        commit_interval=DEFAULT_COMMIT_INTERVAL,
+        snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL,
+        count=None,
+    ):
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.snapshot_interval = snapshot_interval
+        self.count = count or (lambda name, value=1: None)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.registry = None
+        self.segment = 0
+        self.file = None
+        self.thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    # ---- 記録 (RoomRegistry から呼ばれる) ----
+
+    def room_created(self, room, host):
+        self._append(encode_room_created(room) + encode_member_joined(room, host))
+
+    def member_joined(self, room, member):
+        self._append(encode_member_joined(room, member))
+
+    def member_address(self, room, member):
+        self._append(encode_member_address(room, member))
+
+    def member_left(self, room, member):
+        self._append(encode_member_left(room, member))
+
+    def room_closed(self, room):
+        self._append(encode_room_closed(room))
+
+    def _append(self, record):
+        with self.lock:
+            self.pending.append(record)
+        self.wakeup.set()
+
+    # ---- 復元 ----
+
+    def restore(self, registry, reliable_channel):
+        """スナップショットとその後のセグメントを registry に再生する
+
+        reliable_channel() は reliable_delivery を使っていた参加者に付け直す
+        ReliableChannel を作る。戻り値は (ルーム数, 参加者数)。
+        """
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        first_segment = self._snapshot_segment(snapshot_path)
+        segments = [s for s in self._segments() if s >= (first_segment or 0)]
+        sources = [(self._segment_path(s), 0) for s in segments]
+        if first_segment is not None:
+            sources.insert(0, (snapshot_path, SNAPSHOT_HEADER.size))
+
+        rooms = {}
+        """{room_id: Room}"""
+        members = {}
+        """{(room_id, member_id): Member}"""
+        reliable = set()
+        for path, offset in sources:
+            for kind, fields in read_records(path, offset):
+                self._apply(registry, kind, fields, rooms, members, reliable)
+
+        # ホストの記録が揃っていないルーム (書き込み途中で停止した) は捨てる
+        for room in list(rooms.values()):
+            if not has_host(registry, room):
+                registry.remove(room)
+                del rooms[room.room_id]
+        for key in reliable:
+            member = members.get(key)
+            room = rooms.get(key[0])
+            if member is not None and room is not None:
+                with room.lock:
+                    room.enable_reliable(member, reliable_channel())
+
+        self.segment = max(segments, default=first_segment or 0)
+        return len(rooms), sum(len(room.members) for room in rooms.values())
+
+    def _apply(self, registry, kind, fields, rooms, members, reliable):
+        """記録を1件再生する (スナップショットと重なる記録は読み捨てる)"""
+        if kind == ROOM_CREATED:
+            (_, room_id) = fields.unpack(_ROOM)
+            name, host_token, password = (
+                fields.string(),
+                fields.string(),
+                fields.string(),
+            )
+            if room_id not in rooms:
+                room = registry.restore_room(room_id, name, host_token, password)
+                if room is not None:
+                    rooms[room_id] = room
+            return
+
+        if kind == ROOM_CLOSED:
+            (_, room_id) = fields.unpack(_ROOM)
+            room = rooms.pop(room_id, None)
+            if room is not None:
+                registry.remove(room)
+            return
+
+        _, room_id, member_id = fields.unpack(_MEMBER)
+        room = rooms.get(room_id)
+        key = (room_id, member_id)
+        if kind == MEMBER_JOINED:
+            token, username, ip = fields.string(), fields.string(), fields.string()
+            (port,) = fields.unpack(_PORT)
+            if room is not None and key not in members:
+                member = Member(token, username, (ip, port))
+                if registry.restore_member(room, member, member_id):
+                    members[key] = member
+
+        elif kind == MEMBER_ADDRESS:
+            ip = fields.string()
+            (port,) = fields.unpack(_PORT)
+            (flags,) = fields.unpack(_FLAGS)
+            member = members.get(key)
+            if room is not None and member is not None:
+                with room.lock:
+                    registry.set_address(room, member, (ip, port))
+                    if flags & FLAG_ENVELOPE:
+                        room.enable_envelope(member)
+                    if flags & FLAG_COMPRESSION:
+                        room.enable_compression(member)
+                if flags & FLAG_RELIABLE:
+                    reliable.add(key)
+
+        elif kind == MEMBER_LEFT:
+            member = members.pop(key, None)
+            reliable.discard(key)
+            if room is not None and member is not None:
+                with room.lock:
+                    registry.remove_member(room, member)
+
+    # ---- 書き込み ----
+
+    def start(self, registry):
+        """現在の状態をスナップショットにしてから書き込みスレッドを起動"""
+        self.registry = registry
+        self._write_snapshot()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """溜まっている記録を書き込んで停止"""
+        self.closed = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.file is not None:
+            self.file.close()
+
+    def _run(self):
+        next_snapshot = time.monotonic() + self.snapshot_interval
+        while not self.closed:
+            self.wakeup.wait(max(0.0, next_snapshot - time.monotonic()))
+            if not self.closed:
+                # 続けて届く記録を少し待って1回の書き込みにまとめる
+                time.sleep(self.commit_interval)
+            self.wakeup.clear()
+            self._commit()
+            if time.monotonic() >= next_snapshot:
+                self._write_snapshot()
+                next_snapshot = time.monotonic() + self.snapshot_interval
+        self._commit()
+
+    def _commit(self):
+        with self.lock:
+            records, self.pending = self.pending, []
+        if not records:
+            return
+        self.file.write(b"".join(records))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.count("state_log_records", len(records))
+        self.count("state_log_commits")
+
+    def _write_snapshot(self):
+        """新しいセグメントに切り替え、現在の状態を書き出して古いセグメントを消す
+
+        切り替えた後に状態を読むので、スナップショットと新しいセグメントの先頭の
+        記録は重なることがある (再生時に読み捨てる)。
+        """
+        self._commit()
+        if self.file is not None:
+            self.file.close()
+        self.segment += 1
+        self.file = open(self._segment_path(self.segment), "ab")
+
+        records = []
+        for room in self.registry.snapshot():
+            with room.lock:
+                if room.closed or not has_host(self.registry, room):
+                    continue
+                records.append(encode_room_created(room))
+                for member in room.members.values():
+                    # MEMBER_JOINED に現在のアドレスを載せるので、アドレスの記録は
+                    # 信頼性レイヤーかヘッダーを使う参加者の分だけ
+                    records.append(encode_member_joined(room, member))
+                    if member.reliable is not None or member.envelope:
+                        records.append(encode_member_address(room, member))
+
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.segment))
+            f.write(b"".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+        for segment in self._segments():
+            if segment < self.segment:
+                os.remove(self._segment_path(segment))
+
+    def _snapshot_segment(self, path):
+        """スナップショットの続きが記録されている最初のセグメント番号
+
+        スナップショットが無いか壊れていれば None を返す。
+        """
+        try:
+            with open(path, "rb") as f:
+                header = f.read(SNAPSHOT_HEADER.size)
+        except FileNotFoundError:
+            return None
+        if len(header) < SNAPSHOT_HEADER.size:
+            return None
+        magic, segment = SNAPSHOT_HEADER.unpack(header)
+        return segment if magic == SNAPSHOT_MAGIC else None
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith("wal.") and name.endswith(".log"):
+                try:
+                    segments.append(int(name[4:-4]))
+                except ValueError:
+                    continue
+        return sorted(segments)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, SEGMENT_FORMAT.format(segment))
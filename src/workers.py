@@ -0,0 +1,134 @@
+import array
+import hashlib
+import multiprocessing
+import socket
+
+# プロセス間通信のメッセージ種別
+_KIND_DATAGRAM = b"U"  # 担当外のルーム宛て UDP データグラム
+_KIND_CONNECTION = b"T"  # 担当外のルームへの TCP 接続 (fd を添付)
+
+ADDRESS_SIZE = 6  # IPv4 アドレス 4 バイト + ポート 2 バイト
+MAX_IPC_MESSAGE_SIZE = 65536
+MAX_FORWARDED_DATA_SIZE = (
+    MAX_IPC_MESSAGE_SIZE - 1 - ADDRESS_SIZE
+)  # 転送できる受信済みデータ
+
+
+def owner_of(room_name, worker_count):
+    """ルーム名から担当ワーカーを決める (rendezvous hashing)
+
+    ワーカーごとのスコアが最大のものを担当とする。ワーカー数が変わっても
+    大半のルームは担当が変わらない。プロセス間で同じ結果になるよう
+    hash() ではなく blake2b を使う。
+    """
+    if worker_count == 1:
+        return 0
+
+    name_bytes = room_name.encode("utf-8")
+    best_worker, best_score = 0, b""
+    for worker in range(worker_count):
+        score = hashlib.blake2b(
+            name_bytes, digest_size=8, salt=worker.to_bytes(16, "big")
+        ).digest()
+        if score > best_score:
+            best_worker, best_score = worker, score
+    return best_worker
+
+
+def owner_of_room_id(room_id, worker_count):
+    """ルームIDから担当ワーカーを決める (ルームIDは担当ワーカーごとに割り当てる)"""
+    return room_id % worker_count
+
+
+def pack_address(addr):
+    """(IPv4 アドレス, ポート) を 6 バイトにする"""
+    ip, port = addr
+    return socket.inet_aton(ip) + port.to_bytes(2, "big")
+
+
+def unpack_address(data):
+    """pack_address の逆"""
+    return socket.inet_ntoa(data[:4]), int.from_bytes(data[4:ADDRESS_SIZE], "big")
+
+
+class WorkerChannels:
+    """ワーカー間でデータグラムと TCP 接続を受け渡す
+
+    ワーカーごとに AF_UNIX のデータグラムソケットの組を用意し、
+    inbox[i] をワーカー i が読み、outbox[i] には全ワーカーが書き込む。
+    TCP 接続は SCM_RIGHTS で fd ごと担当ワーカーへ渡す。
+    """
+
+    def __init__(self, worker_count):
+        self.worker_count = worker_count
+        self.outbox = []
+        self.inbox = []
+        for _ in range(worker_count):
+            sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.outbox.append(sender)
+            self.inbox.append(receiver)
+        self.worker_index = None
+
+    def bind(self, worker_index):
+        """ワーカープロセス内で自分の受信用ソケットを決める"""
+        self.worker_index = worker_index
+        for index, receiver in enumerate(self.inbox):
+            if index != worker_index:
+                receiver.close()
+
+    @property
+    def receiver(self):
+        return self.inbox[self.worker_index]
+
+    def forward_datagram(self, worker, data, addr):
+        """UDP データグラムを担当ワーカーへ転送"""
+        self.outbox[worker].send(_KIND_DATAGRAM + pack_address(addr) + data)
+
+    def forward_connection(self, worker, client_socket, client_address, frame):
+        """受信済みのリクエストと TCP 接続を担当ワーカーへ渡す"""
+        message = _KIND_CONNECTION + pack_address(client_address) + frame
+        socket.send_fds(self.outbox[worker], [message], [client_socket.fileno()])
+
+    async def forward_stream(self, worker, reader, writer, client_address, frame):
+        """受信済みのリクエストと asyncio の接続を担当ワーカーへ渡す"""
+        # 渡した後にこのワーカーが続きを読み込まないようにする
+        writer.transport.pause_reading()
+        self.forward_connection(
+            worker, writer.get_extra_info("socket"), client_address, frame
+        )
+
+    def receive(self, flags=0):
+        """転送されてきたメッセージを1件受信する
+
+        UDP の場合は ("datagram", data, addr)、
+        TCP の場合は ("connection", frame, addr, socket) を返す。
+        """
+        # socket.recv_fds は flags を渡さないので recvmsg を直接使う
+        fds = array.array("i")
+        message, ancdata, _, _ = self.receiver.recvmsg(
+            MAX_IPC_MESSAGE_SIZE, socket.CMSG_LEN(fds.itemsize), flags
+        )
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[: len(data) - len(data) % fds.itemsize])
+        kind = message[:1]
+        addr = unpack_address(message[1 : 1 + ADDRESS_SIZE])
+        payload = message[1 + ADDRESS_SIZE :]
+        if kind == _KIND_CONNECTION and fds:
+            return "connection", payload, addr, socket.socket(fileno=fds[0])
+        for fd in fds:
+            socket.close(fd)
+        return "datagram", payload, addr, None
+
+
+def start_workers(target, worker_count, *args):
+    """target(worker_index, channels, *args) をワーカープロセスとして起動"""
+    channels = WorkerChannels(worker_count)
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=target, args=(index, channels, *args))
+        for index in range(worker_count)
+    ]
+    for process in processes:
+        process.start()
+    return processes
@@ -0,0 +1,111 @@
+"""クラスタのノード間通信の認証のテスト
+
+ブローカーの代わりにメモリ上のキューを使い、MAC の付いていない・合わない
+FORWARDED フレームと転送データグラムが捨てられることを確認する。
+"""
+
+import os
+import sys
+from collections import Counter, deque
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from cluster import FORWARDED, FORWARDED_MAX_AGE, ClusterChannels, Node  # noqa: E402
+from framing import FrameDecoder  # noqa: E402
+
+NODES = [Node("127.0.0.1", 8000, 8001, 8100), Node("127.0.0.1", 8010, 8011, 8110)]
+CLIENT = ("192.0.2.1", 50000)
+NOW = 1_700_000_000
+
+
+class QueueBroker:
+    """publish したメッセージをそのまま receive で返すブローカー"""
+
+    def __init__(self):
+        self.messages = deque()
+
+    def publish(self, node, message):
+        self.messages.append(message)
+
+    def receive(self, flags=0):
+        if not self.messages:
+            raise BlockingIOError
+        return self.messages.popleft()
+
+
+def channels(secret=b"secret", broker=None):
+    counts = Counter()
+
+    def count(name, value=1):
+        counts[name] += value
+
+    channel = ClusterChannels(NODES, 0, broker or QueueBroker(), secret, count)
+    return channel, counts
+
+
+def forwarded_payload(channel, now=NOW):
+    """forwarded_frame が作るフレームのペイロード"""
+    frame = FrameDecoder().feed(channel.forwarded_frame(CLIENT, now))[0]
+    assert frame.operation == FORWARDED
+    return frame.payload
+
+
+def test_forwarded_frame_round_trip():
+    channel, counts = channels()
+    assert channel.forwarded_address(forwarded_payload(channel), NOW) == CLIENT
+    assert not counts
+
+
+def test_forwarded_frame_with_other_secret_is_rejected():
+    sender, _ = channels(b"other")
+    receiver, counts = channels()
+    assert receiver.forwarded_address(forwarded_payload(sender), NOW) is None
+    assert counts["cluster_auth_failures"] == 1
+
+
+@pytest.mark.parametrize("index", [0, 5, 6, -1])
+def test_tampered_forwarded_frame_is_rejected(index):
+    channel, counts = channels()
+    payload = bytearray(forwarded_payload(channel))
+    payload[index] ^= 1
+    assert channel.forwarded_address(bytes(payload), NOW) is None
+    assert counts["cluster_auth_failures"] == 1
+
+
+@pytest.mark.parametrize("payload", [b"", b"\x7f\x00\x00\x01\x1f\x40"])
+def test_short_forwarded_frame_is_rejected(payload):
+    channel, counts = channels()
+    assert channel.forwarded_address(payload, NOW) is None
+    assert counts["cluster_auth_failures"] == 1
+
+
+def test_stale_forwarded_frame_is_rejected():
+    channel, counts = channels()
+    payload = forwarded_payload(channel)
+    assert channel.forwarded_address(payload, NOW + FORWARDED_MAX_AGE) == CLIENT
+    assert channel.forwarded_address(payload, NOW + FORWARDED_MAX_AGE + 1) is None
+    assert counts["cluster_auth_failures"] == 1
+
+
+def test_datagram_round_trip():
+    channel, counts = channels()
+    channel.forward_datagram(1, b"hello", CLIENT)
+    assert channel.receive() == ("datagram", b"hello", CLIENT, None)
+    assert not counts
+
+
+def test_unauthenticated_datagrams_are_dropped():
+    broker = QueueBroker()
+    sender, _ = channels(b"other", broker)
+    receiver, counts = channels(broker=broker)
+    sender.forward_datagram(1, b"forged", CLIENT)
+    broker.publish(1, b"short")
+    receiver.forward_datagram(1, b"genuine", CLIENT)
+    # 不正なメッセージは飛ばして次の正しいメッセージを返す
+    assert receiver.receive() == ("datagram", b"genuine", CLIENT, None)
+    assert counts["cluster_auth_failures"] == 2
+    with pytest.raises(BlockingIOError):
+        receiver.receive()
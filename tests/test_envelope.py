@@ -0,0 +1,229 @@
+"""UDP のメッセージに付ける型付きのヘッダー (envelope.py) のテスト
+
+長いメッセージの圧縮・分割は、並べ替え・重複・欠落があっても Reassembler で
+元の本文に戻ることを確認する。
+"""
+
+import os
+import random
+import sys
+from collections import Counter
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from envelope import (  # noqa: E402
+    COMPRESS_THRESHOLD,
+    ENVELOPE_VERSION,
+    FLAG_COMPRESSED,
+    FLAG_FRAGMENT,
+    FLAG_HISTORY,
+    FRAGMENT_HEADER,
+    FRAGMENT_SIZE,
+    HEADER,
+    MAX_FRAGMENTS,
+    MAX_MESSAGE_SIZE,
+    MSG_CHAT,
+    MSG_LEFT,
+    REASSEMBLY_TIMEOUT,
+    Reassembler,
+    compress,
+    decompress,
+    encode,
+    unwrap,
+    wrap,
+)
+
+NOW = 1000.0
+
+
+@pytest.mark.parametrize(
+    "kind, body, seq, sender, flags",
+    [
+        (MSG_CHAT, "alice: こんにちは".encode("utf-8"), 1, 2, 0),
+        (MSG_LEFT, b"", 0, (1 << 64) - 1, 0),
+        (MSG_CHAT, b"x" * 65535, (1 << 32) - 1, 0, FLAG_HISTORY),
+    ],
+)
+def test_round_trip(kind, body, seq, sender, flags):
+    data = wrap(kind, body, seq, sender, flags)
+    assert len(data) == HEADER.size + len(body)
+    envelope = unwrap(data)
+    assert envelope[:4] == (kind, flags, seq, sender)
+    assert bytes(envelope[4]) == body
+
+
+def test_wrap_memoryview():
+    body = memoryview(b"--hello--")[2:-2]
+    assert bytes(unwrap(wrap(MSG_CHAT, body))[4]) == b"hello"
+
+
+def test_unknown_flags_are_kept():
+    """受信側は知らないフラグのビットを無視できる"""
+    assert unwrap(wrap(MSG_CHAT, b"hi", flags=0x8000))[1] == 0x8000
+
+
+def test_trailing_bytes_are_ignored():
+    """本文より後ろは後のバージョンで項目を足すための領域"""
+    envelope = unwrap(wrap(MSG_CHAT, b"hi") + b"future")
+    assert bytes(envelope[4]) == b"hi"
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        wrap(MSG_CHAT, b"hi")[: HEADER.size - 1],
+        # 本文の長さより短い
+        wrap(MSG_CHAT, b"hello")[:-1],
+        # 別のバージョン
+        bytes([ENVELOPE_VERSION + 1]) + wrap(MSG_CHAT, b"hi")[1:],
+        # ヘッダーの無い旧形式のメッセージ
+        "alice: こんにちは、みなさん".encode("utf-8"),
+    ],
+)
+def test_invalid_datagram(data):
+    assert unwrap(data) is None
+
+
+def counter():
+    counts = Counter()
+
+    def count(name, value=1):
+        counts[name] += value
+
+    return counts, count
+
+
+def random_bytes(size, seed=0):
+    """圧縮しても縮まない本文"""
+    return random.Random(seed).randbytes(size)
+
+
+def chat_text(size, seed=0):
+    """圧縮すると縮む本文"""
+    rng = random.Random(seed)
+    words = ["了解です。", "ありがとうございます。", "hello ", "world ", "チャット"]
+    text = "".join(rng.choice(words) for _ in range(size))
+    return text.encode("utf-8")[:size]
+
+
+def reassemble(datagrams, reassembler=None, now=NOW):
+    reassembler = reassembler or Reassembler()
+    results = [reassembler.receive(data, now) for data in datagrams]
+    completed = [result for result in results if result is not None]
+    assert len(completed) <= 1
+    return completed[0] if completed else None
+
+
+def test_short_message_is_sent_as_is():
+    counts, count = counter()
+    body = b"x" * COMPRESS_THRESHOLD
+    [data] = encode(MSG_CHAT, body, 3, 4, count=count)
+    assert data == wrap(MSG_CHAT, body, 3, 4)
+    assert not counts
+
+
+def test_compressed_round_trip():
+    counts, count = counter()
+    body = chat_text(FRAGMENT_SIZE * 2)
+    [data] = encode(MSG_CHAT, body, 3, 4, FLAG_HISTORY, count=count)
+    assert unwrap(data)[1] == FLAG_HISTORY | FLAG_COMPRESSED
+    assert len(data) < len(body)
+    assert counts == {"compressed_messages": 1}
+    assert reassemble([data]) == (MSG_CHAT, FLAG_HISTORY, 3, 4, body)
+
+
+def test_incompressible_message_is_not_compressed():
+    body = random_bytes(COMPRESS_THRESHOLD + 1)
+    [data] = encode(MSG_CHAT, body)
+    assert unwrap(data)[1] == 0
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_fragmented_round_trip_in_any_order(seed):
+    counts, count = counter()
+    body = random_bytes(FRAGMENT_SIZE * 4 + 1, seed)
+    datagrams = encode(MSG_CHAT, body, 5, 6, message_id=7, count=count)
+    assert len(datagrams) == 5
+    assert counts == {"fragmented_messages": 1}
+    for data in datagrams:
+        kind, flags, seq, sender, fragment = unwrap(data)
+        assert (kind, flags, seq, sender) == (MSG_CHAT, FLAG_FRAGMENT, 5, 6)
+        assert len(fragment) <= FRAGMENT_HEADER.size + FRAGMENT_SIZE
+
+    # 並べ替えと重複があっても、揃った時点で1回だけ組み立てる
+    rng = random.Random(seed)
+    shuffled = datagrams + rng.sample(datagrams, 2)
+    rng.shuffle(shuffled)
+    assert reassemble(shuffled) == (MSG_CHAT, 0, 5, 6, body)
+
+
+def test_compressed_and_fragmented_round_trip():
+    body = chat_text(MAX_MESSAGE_SIZE, seed=1)
+    datagrams = encode(MSG_CHAT, body, message_id=1)
+    assert len(datagrams) > 1
+    assert unwrap(datagrams[0])[1] == FLAG_COMPRESSED | FLAG_FRAGMENT
+    assert reassemble(reversed(datagrams))[4] == body
+
+
+def test_interleaved_messages():
+    first = encode(MSG_CHAT, random_bytes(3000, 1), message_id=1)
+    second = encode(MSG_CHAT, random_bytes(3000, 2), message_id=2)
+    reassembler = Reassembler()
+    results = [
+        reassembler.receive(data, NOW) for pair in zip(first, second) for data in pair
+    ]
+    assert [bytes(r[4]) for r in results if r is not None] == [
+        random_bytes(3000, 1),
+        random_bytes(3000, 2),
+    ]
+
+
+def test_incomplete_message_expires():
+    counts, count = counter()
+    reassembler = Reassembler(count=count)
+    datagrams = encode(MSG_CHAT, random_bytes(3000), message_id=1)
+    assert reassemble(datagrams[:-1], reassembler) is None
+    # 期限を過ぎてから残りが届いても組み立てない
+    later = NOW + REASSEMBLY_TIMEOUT
+    assert reassemble(datagrams[-1:], reassembler, later) is None
+    assert counts["reassembly_drops"] == 1
+
+
+def test_oldest_pending_message_is_dropped():
+    counts, count = counter()
+    reassembler = Reassembler(max_pending=2, count=count)
+    messages = [encode(MSG_CHAT, random_bytes(3000, i), message_id=i) for i in range(3)]
+    for datagrams in messages:
+        assert reassemble(datagrams[:1], reassembler) is None
+    assert counts["reassembly_drops"] == 1
+    assert reassemble(messages[0][1:], reassembler) is None
+    assert reassemble(messages[2][1:], reassembler)[4] == random_bytes(3000, 2)
+
+
+def test_invalid_fragments_are_ignored():
+    fragment = FRAGMENT_HEADER.pack(1, 0, MAX_FRAGMENTS + 1) + b"x"
+    assert reassemble([wrap(MSG_CHAT, fragment, flags=FLAG_FRAGMENT)]) is None
+    fragment = FRAGMENT_HEADER.pack(1, 2, 2) + b"x"
+    assert reassemble([wrap(MSG_CHAT, fragment, flags=FLAG_FRAGMENT)]) is None
+    too_long = FRAGMENT_HEADER.pack(1, 0, 2) + b"x" * (FRAGMENT_SIZE + 1)
+    assert reassemble([wrap(MSG_CHAT, too_long, flags=FLAG_FRAGMENT)]) is None
+
+
+def test_corrupted_compressed_message_is_dropped():
+    counts, count = counter()
+    packed = bytearray(compress(chat_text(1000)))
+    packed[len(packed) // 2] ^= 0xFF
+    data = wrap(MSG_CHAT, packed, flags=FLAG_COMPRESSED)
+    assert reassemble([data], Reassembler(count=count)) is None
+    assert counts["reassembly_drops"] == 1
+
+
+def test_decompress_limits_size():
+    packed = compress(b"\0" * (MAX_MESSAGE_SIZE + 1))
+    assert decompress(packed) is None
+    assert decompress(packed, MAX_MESSAGE_SIZE + 1) == b"\0" * (MAX_MESSAGE_SIZE + 1)
+    assert decompress(packed[:-1], MAX_MESSAGE_SIZE + 1) is None
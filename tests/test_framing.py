@@ -0,0 +1,184 @@
+"""TCP フレームの分解 (FrameDecoder / FrameReader / AsyncFrameReader) のテスト
+
+受信したデータがフレームの途中で区切られていても、複数のフレームがまとめて
+届いても、送った順に同じフレームが取り出せることを確認する。
+"""
+
+import asyncio
+import os
+import random
+import socket
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from framing import (  # noqa: E402
+    HEADER_SIZE,
+    AsyncFrameReader,
+    Frame,
+    FrameDecoder,
+    FrameError,
+    FrameReader,
+)
+
+MAX_FRAME_SIZE = 256
+
+
+def frame(index, payload_size=10, room_name="ルーム"):
+    return Frame(room_name, index % 7, index % 4, bytes([index % 256]) * payload_size)
+
+
+def test_frame_split_across_reads():
+    expected = frame(1, 40)
+    data = expected.encode()
+    decoder = FrameDecoder(MAX_FRAME_SIZE)
+    # ヘッダーの途中・ルーム名の途中・ペイロードの途中で区切る
+    cuts = [0, 5, HEADER_SIZE + 2, HEADER_SIZE + 20]
+    for start, end in zip(cuts, cuts[1:]):
+        assert decoder.feed(data[start:end]) == []
+    assert decoder.feed(data[cuts[-1] :]) == [expected]
+    assert len(decoder) == 0
+
+
+def test_several_frames_in_one_read():
+    expected = [frame(i, i * 3) for i in range(5)]
+    decoder = FrameDecoder(MAX_FRAME_SIZE)
+    data = b"".join(f.encode() for f in expected)
+    # 最後のフレームの途中までを1回で受信する
+    assert decoder.feed(data[:-1]) == expected[:-1]
+    assert decoder.feed(data[-1:]) == expected[-1:]
+
+
+def test_data_larger_than_buffer_in_one_read():
+    """バッファに収まらない量を1回で渡しても、空いた所に移しながら取り出す"""
+    expected = [frame(i, MAX_FRAME_SIZE - 9) for i in range(10)]
+    decoder = FrameDecoder(MAX_FRAME_SIZE)
+    assert decoder.feed(b"".join(f.encode() for f in expected)) == expected
+
+
+def test_initial_data_larger_than_buffer():
+    """他のワーカーから渡された受信済みのデータは backlog から順に取り出す"""
+    expected = [frame(i, MAX_FRAME_SIZE - 9) for i in range(5)]
+    decoder = FrameDecoder(MAX_FRAME_SIZE, b"".join(f.encode() for f in expected))
+    assert decoder.frames() == expected
+    assert decoder.pending() == b""
+
+
+@pytest.mark.parametrize("payload_size", [MAX_FRAME_SIZE - 8, 2**40])
+def test_frame_over_limit(payload_size):
+    # ルーム名 9 バイト + ペイロードが上限を超える (ヘッダーだけで判定する)
+    header = frame(1).encode()[:HEADER_SIZE]
+    header = header[:3] + payload_size.to_bytes(HEADER_SIZE - 3, "big")
+    with pytest.raises(FrameError):
+        FrameDecoder(MAX_FRAME_SIZE).feed(header)
+
+
+def test_frame_at_limit():
+    expected = frame(1, MAX_FRAME_SIZE - 9)
+    assert FrameDecoder(MAX_FRAME_SIZE).feed(expected.encode()) == [expected]
+
+
+def test_room_name_not_utf8():
+    data = bytearray(frame(1).encode())
+    data[HEADER_SIZE] = 0xFF
+    with pytest.raises(FrameError):
+        FrameDecoder(MAX_FRAME_SIZE).feed(bytes(data))
+
+
+def test_take_between_frames():
+    """参加後に送られる UDP ポートの2バイトのようなフレーム以外のデータ"""
+    first, second = frame(1), frame(2)
+    decoder = FrameDecoder(MAX_FRAME_SIZE)
+    assert decoder.feed(first.encode() + b"\x1f") == [first]
+    assert decoder.take(2) is None
+    assert decoder.feed(b"\x40") == []
+    assert decoder.take(2) == b"\x1f\x40"
+    assert decoder.feed(second.encode()) == [second]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_chunking_round_trip(seed):
+    rng = random.Random(seed)
+    expected = [
+        frame(i, rng.randrange(MAX_FRAME_SIZE - 20), rng.choice(["", "a", "ルーム"]))
+        for i in range(200)
+    ]
+    data = b"".join(f.encode() for f in expected)
+    decoder = FrameDecoder(MAX_FRAME_SIZE)
+    received = []
+    while data:
+        size = rng.randint(1, 2 * (HEADER_SIZE + MAX_FRAME_SIZE))
+        received.extend(decoder.feed(data[:size]))
+        data = data[size:]
+    assert received == expected
+    assert len(decoder) == 0
+
+
+def test_reader_split_across_recv():
+    expected = [frame(i, 100) for i in range(3)]
+    data = b"".join(f.encode() for f in expected)
+    left, right = socket.socketpair()
+    with left, right:
+        reader = FrameReader(right, MAX_FRAME_SIZE)
+        left.sendall(data[:50])
+        left.sendall(data[50:])
+        left.shutdown(socket.SHUT_WR)
+        assert [reader.read() for _ in expected] == expected
+        # フレームの境目での切断
+        assert reader.read() is None
+
+
+def test_reader_eof_in_middle_of_frame():
+    left, right = socket.socketpair()
+    with left, right:
+        left.sendall(frame(1, 100).encode()[:-1])
+        left.shutdown(socket.SHUT_WR)
+        with pytest.raises(FrameError):
+            FrameReader(right, MAX_FRAME_SIZE).read()
+
+
+def test_reader_read_exact_eof():
+    left, right = socket.socketpair()
+    with left, right:
+        left.sendall(b"\x1f")
+        left.shutdown(socket.SHUT_WR)
+        assert FrameReader(right, MAX_FRAME_SIZE).read_exact(2) is None
+
+
+def async_reader(data, initial=b""):
+    """data を受信済みで、その後切断された StreamReader を読む AsyncFrameReader"""
+    stream = asyncio.StreamReader()
+    stream.feed_data(data)
+    stream.feed_eof()
+    return AsyncFrameReader(stream, MAX_FRAME_SIZE, initial)
+
+
+def test_async_reader_round_trip():
+    expected = [frame(i, MAX_FRAME_SIZE - 9) for i in range(6)]
+    data = b"".join(f.encode() for f in expected)
+
+    async def read_all():
+        # 最初の2フレームと少しは他のワーカーが受信済み
+        reader = async_reader(data[600:], data[:600])
+        return [await reader.read() for _ in expected] + [await reader.read()]
+
+    assert asyncio.run(read_all()) == expected + [None]
+
+
+def test_async_reader_eof_in_middle_of_frame():
+    async def read():
+        return await async_reader(frame(1, 100).encode()[:-1]).read()
+
+    with pytest.raises(FrameError):
+        asyncio.run(read())
+
+
+def test_async_reader_read_exact_eof():
+    async def read():
+        return await async_reader(b"\x1f").read_exact(2)
+
+    with pytest.raises(asyncio.IncompleteReadError):
+        asyncio.run(read())
@@ -0,0 +1,82 @@
+"""ルームのメッセージ履歴 (history.py のリングバッファ) のテスト"""
+
+import os
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from history import TRUNCATED_MARK, MessageHistory, truncate  # noqa: E402
+
+
+def messages(history, **kwargs):
+    return [message for _, message in history.query(**kwargs)[2]]
+
+
+def test_wraparound_keeps_latest_messages():
+    history = MessageHistory(max_messages=3, max_bytes=1000)
+    seqs = [history.append(f"m{i}".encode()) for i in range(1, 8)]
+    assert seqs == list(range(1, 8))
+    first_seq, next_seq, entries = history.query()
+    assert (first_seq, next_seq) == (5, 8)
+    assert entries == [(5, b"m5"), (6, b"m6"), (7, b"m7")]
+    assert history.size == 6
+
+
+def test_query_ranges_across_wraparound():
+    history = MessageHistory(max_messages=4, max_bytes=1000)
+    for i in range(1, 11):
+        history.append(f"m{i}".encode())
+    # 残っているのは 7〜10 (枠の末尾から先頭に折り返している)
+    assert messages(history, since=9) == [b"m9", b"m10"]
+    assert messages(history, since=1) == [b"m7", b"m8", b"m9", b"m10"]
+    assert messages(history, before=9) == [b"m7", b"m8"]
+    assert messages(history, limit=3) == [b"m8", b"m9", b"m10"]
+    assert messages(history, before=10, limit=2) == [b"m8", b"m9"]
+    assert messages(history, since=11) == []
+    assert messages(history, limit=0) == []
+
+
+def test_byte_limit_drops_oldest():
+    history = MessageHistory(max_messages=10, max_bytes=10)
+    for message in (b"aaaa", b"bbbb", b"cccc"):
+        history.append(message)
+    assert messages(history) == [b"bbbb", b"cccc"]
+    assert history.size == 8
+    assert history.first_seq == 2
+
+
+def test_message_over_byte_limit_clears_history():
+    """1件で上限を超えるものは保持しないが、連番は進める"""
+    history = MessageHistory(max_messages=10, max_bytes=10, max_entry_bytes=100)
+    history.append(b"short")
+    assert history.append(b"x" * 11) == 2
+    assert history.query() == (3, 3, [])
+    assert history.append(b"next") == 3
+    assert messages(history) == [b"next"]
+
+
+def test_long_entry_is_truncated():
+    history = MessageHistory(max_messages=10, max_bytes=1000, max_entry_bytes=20)
+    history.append(b"x" * 100)
+    [message] = messages(history)
+    assert len(message) == 20
+    assert message.endswith(TRUNCATED_MARK)
+
+
+def test_truncate_does_not_split_characters():
+    message = "あいうえお".encode("utf-8")  # 1文字 3 バイト
+    for size in range(len(TRUNCATED_MARK), len(message)):
+        truncated = truncate(message, size)
+        assert len(truncated) <= size
+        assert truncated.endswith(TRUNCATED_MARK)
+        # 途中で切った文字が残っていない
+        assert truncated.decode("utf-8")
+
+
+def test_append_copies_buffer():
+    history = MessageHistory(max_messages=2, max_bytes=100)
+    buffer = bytearray(b"hello")
+    history.append(memoryview(buffer))
+    buffer[:] = b"HELLO"
+    assert messages(history) == [b"hello"]
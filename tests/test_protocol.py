@@ -0,0 +1,337 @@
+"""サーバーのプロトコルテスト (asyncio / thread の両エンジンで同じテストを実行する)
+
+サーバーを別プロセスで起動し、client.py を使ってルーム作成・参加・
+パスワード誤り・UDP のメッセージ配信を確認する。サーバーは固定のポート
+(TCP 8000 / UDP 8001、クラスタは 8020 / 8021 / 8120) を使うので、同時に他のサーバーを起動しないこと。
+
+    python3 -m pytest tests
+"""
+
+import importlib.util
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from envelope import MSG_CHAT, MSG_JOINED, Reassembler  # noqa: E402
+from framing import FrameReader  # noqa: E402
+from history import MAX_ENTRY_BYTES, TRUNCATED_MARK  # noqa: E402
+
+HOST = "127.0.0.1"
+TCP_PORT = 8000
+UDP_PORT = 8001
+CLUSTER_TCP_PORT = 8020
+CLUSTER_UDP_PORT = 8021
+CLUSTER_BROKER_PORT = 8120
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("サーバーが起動しませんでした")
+
+
+@pytest.fixture(scope="module", params=["asyncio", "thread"])
+def server(request):
+    """指定したエンジンでサーバーを起動する"""
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(SRC, "server.py"),
+            "--engine",
+            request.param,
+            "--bcrypt-rounds",
+            "4",
+        ],
+        cwd=SRC,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(TCP_PORT)
+        yield request.param
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+@pytest.fixture
+def no_session_server():
+    """制御セッションを無効にしたサーバーを1ノードのクラスタとして別のポートで起動する"""
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(SRC, "server.py"),
+            "--cluster-nodes",
+            f"{HOST}:{CLUSTER_TCP_PORT}:{CLUSTER_UDP_PORT}:{CLUSTER_BROKER_PORT}",
+            "--cluster-secret",
+            "secret",
+            "--no-control-session",
+            "--bcrypt-rounds",
+            "4",
+        ],
+        cwd=SRC,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(CLUSTER_TCP_PORT)
+        yield
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+@pytest.fixture
+def new_client():
+    """client.py のモジュールを状態を共有しないように1つずつ読み込む"""
+    clients = []
+
+    def load():
+        spec = importlib.util.spec_from_file_location(
+            f"client_{len(clients)}", os.path.join(SRC, "client.py")
+        )
+        client = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(client)
+        clients.append(client)
+        return client
+
+    yield load
+    for client in clients:
+        for sock in (client.udp_socket, client.control_socket):
+            if sock is not None:
+                sock.close()
+
+
+def room_name():
+    return f"room-{uuid.uuid4().hex[:8]}"
+
+
+def receive_envelopes(client, timeout=2.0):
+    """UDP で届いたメッセージを (種別, 本文) のリストで返す"""
+    client.udp_socket.settimeout(timeout)
+    reassembler = Reassembler()
+    messages = []
+    try:
+        while True:
+            data, _ = client.udp_socket.recvfrom(65535)
+            envelope = reassembler.receive(data, time.time())
+            if envelope is not None:
+                messages.append((envelope[0], str(envelope[4], "utf-8")))
+    except socket.timeout:
+        pass
+    return messages
+
+
+def receive_chat(client, timeout=2.0):
+    """UDP で届いたメッセージのうち、発言の本文を返す"""
+    return [
+        text for kind, text in receive_envelopes(client, timeout) if kind == MSG_CHAT
+    ]
+
+
+def test_create_room(server, new_client):
+    host = new_client()
+    assert host.create_room(HOST, TCP_PORT, room_name(), "alice", "pw")
+    assert host.client_token
+
+
+def test_create_existing_room_fails(server, new_client):
+    name = room_name()
+    assert new_client().create_room(HOST, TCP_PORT, name, "alice", "pw")
+    assert not new_client().create_room(HOST, TCP_PORT, name, "bob", "pw")
+
+
+def test_join_room(server, new_client):
+    name = room_name()
+    assert new_client().create_room(HOST, TCP_PORT, name, "alice", "pw")
+    member = new_client()
+    assert member.join_room(HOST, TCP_PORT, name, "bob", "pw")
+    assert member.client_token
+
+
+def test_join_with_wrong_password_fails(server, new_client):
+    name = room_name()
+    assert new_client().create_room(HOST, TCP_PORT, name, "alice", "pw")
+    member = new_client()
+    assert not member.join_room(HOST, TCP_PORT, name, "bob", "wrong")
+    assert member.client_token is None
+
+
+def test_udp_delivery(server, new_client):
+    name = room_name()
+    host = new_client()
+    assert host.create_room(HOST, TCP_PORT, name, "alice", "pw")
+    member = new_client()
+    assert member.join_room(HOST, TCP_PORT, name, "bob", "pw")
+
+    assert member.send_message(HOST, UDP_PORT, "hello")
+    assert "bob: hello" in receive_chat(host)
+    assert host.send_message(HOST, UDP_PORT, "hi bob")
+    assert "alice: hi bob" in receive_chat(member)
+
+
+def test_udp_registered_before_complete(server, new_client):
+    """UDP のポートをリクエストに含めると、完了応答の前に登録される
+
+    参加メッセージは他の参加者にだけ届き、参加した本人には送らない。
+    """
+    name = room_name()
+    host = new_client()
+    assert host.create_room(HOST, TCP_PORT, name, "alice", "pw")
+    member = new_client()
+    assert member.join_room(HOST, TCP_PORT, name, "bob", "pw")
+    # 完了応答の直後に送った発言も配信される
+    assert member.send_message(HOST, UDP_PORT, "right after join")
+
+    notice = (MSG_JOINED, "bob がチャットルームに参加しました")
+    received = receive_envelopes(host)
+    assert notice in received
+    assert (MSG_CHAT, "bob: right after join") in received
+    assert notice not in receive_envelopes(member)
+
+
+@pytest.mark.parametrize("udp_port", ["x", 70000, 0, True])
+def test_invalid_udp_port_is_rejected(server, new_client, udp_port):
+    """不正な udp_port の参加は INVALID_REQUEST になり、他の参加者への配信は続く"""
+    name = room_name()
+    host = new_client()
+    assert host.create_room(HOST, TCP_PORT, name, "alice", "pw")
+
+    # 参加リクエストに含めた場合
+    mallory = new_client()
+    with socket.create_connection((HOST, TCP_PORT)) as sock:
+        sock.sendall(
+            mallory.build_room_request(
+                mallory.JOIN_ROOM, name, "mallory", "pw", (), {"udp_port": udp_port}
+            )
+        )
+        response = FrameReader(sock).read()
+        assert response.payload[0] == mallory.INVALID_REQUEST
+
+    # 制御セッションの途中で参加した場合
+    with socket.create_connection((HOST, TCP_PORT)) as sock:
+        features = [mallory.FEATURE_CONTROL_SESSION]
+        sock.sendall(
+            mallory.build_request(mallory.LIST_ROOMS, "", {"features": features})
+        )
+        frames = FrameReader(sock)
+        assert mallory.receive_control_response(frames) is not None
+        sock.sendall(
+            mallory.build_room_request(
+                mallory.JOIN_ROOM,
+                name,
+                "mallory",
+                "pw",
+                features,
+                {"udp_port": udp_port},
+            )
+        )
+        response = mallory.receive_control_response(frames)
+        assert response["status"] == mallory.INVALID_REQUEST
+
+    member = new_client()
+    assert member.join_room(HOST, TCP_PORT, name, "bob", "pw")
+    assert host.send_message(HOST, UDP_PORT, "hello after mallory")
+    assert "alice: hello after mallory" in receive_chat(member)
+
+
+def test_large_messages_in_history(server, new_client):
+    """1フレームに収まらない発言が履歴にあっても、参加した参加者の制御セッションが使える"""
+    name = room_name()
+    host = new_client()
+    assert host.create_room(HOST, TCP_PORT, name, "alice", "pw")
+    long_message = "長いメッセージ" * 2000  # 42 KB
+    quoted_message = '"' * 10000  # JSON のエスケープで 2 倍になる
+    assert host.send_message(HOST, UDP_PORT, long_message)
+    assert host.send_message(HOST, UDP_PORT, quoted_message)
+    time.sleep(0.3)
+
+    member = new_client()
+    assert member.join_room(HOST, TCP_PORT, name, "bob", "pw")
+    messages = [message for _, message in member.fetch_history(name, 10)]
+    mark = str(TRUNCATED_MARK, "utf-8")
+    assert messages[0].startswith("alice: 長いメッセージ")
+    assert messages[0].endswith(mark)
+    assert len(messages[0].encode("utf-8")) <= MAX_ENTRY_BYTES
+    assert messages[1].startswith('alice: ""') and messages[1].endswith(mark)
+
+
+@pytest.mark.parametrize(
+    "options", [["--workers", "2"], ["--cluster-nodes", f"{HOST}:8030:8031:8130"]]
+)
+def test_workers_require_no_control_session(options):
+    """制御セッションは1つのワーカーのルームしか扱えないので、起動時に拒否する"""
+    result = subprocess.run(
+        [sys.executable, os.path.join(SRC, "server.py"), *options],
+        cwd=SRC,
+        capture_output=True,
+        text=True,
+        timeout=10,
+        env=dict(os.environ, CHAT_CLUSTER_SECRET="secret"),
+    )
+    assert result.returncode == 2
+    assert "--no-control-session" in result.stderr
+
+
+def test_control_session_is_refused(no_session_server, new_client):
+    """--no-control-session のサーバーは制御セッションの要求に INVALID_REQUEST を返す"""
+    name = room_name()
+    host = new_client()
+    assert not host.create_room(HOST, CLUSTER_TCP_PORT, name, "alice", "pw")
+    assert host.list_rooms(HOST, CLUSTER_TCP_PORT) is None
+
+    host.use_control_session = False
+    assert host.create_room(HOST, CLUSTER_TCP_PORT, name, "alice", "pw")
+    member = new_client()
+    member.use_control_session = False
+    assert member.join_room(HOST, CLUSTER_TCP_PORT, name, "bob", "pw")
+    # 旧形式では COMPLETE の後に UDP のポートを送るので、登録されるまで待つ
+    time.sleep(0.3)
+    assert member.send_message(HOST, CLUSTER_UDP_PORT, "hello")
+    assert "bob: hello" in receive_chat(host)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        ["--heartbeat-timeout", "0"],
+        ["--heartbeat-timeout", "-5"],
+        ["--state-commit-interval", "0"],
+        ["--state-snapshot-interval", "-1"],
+        ["--credential-cache-ttl", "0"],
+        ["--metrics-interval", "nan"],
+    ],
+)
+def test_non_positive_interval_is_rejected(options):
+    """0 以下の間隔では掃除などのスレッドが回り続けるので、起動時に拒否する"""
+    result = subprocess.run(
+        [sys.executable, os.path.join(SRC, "server.py"), *options],
+        cwd=SRC,
+        capture_output=True,
+        text=True,
+        timeout=10,
+    )
+    assert result.returncode == 2
+    assert options[0] in result.stderr
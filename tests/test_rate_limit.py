@@ -0,0 +1,80 @@
+"""流量制限 (rate_limit.py の GCRA) のテスト
+
+1件あたりの時間が2進数で割り切れる値 (毎秒4件 = 0.25秒) を使い、
+浮動小数の誤差で境目の判定が変わらないようにする。
+"""
+
+import os
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from rate_limit import RateLimiter  # noqa: E402
+
+RATE = 4.0
+BURST = 5
+INTERVAL = 1 / RATE
+NOW = 1000.0
+
+
+def allowed(limiter, key, now, attempts):
+    return sum(limiter.allow(key, now) for _ in range(attempts))
+
+
+def test_burst_then_deny():
+    limiter = RateLimiter(RATE, BURST)
+    assert allowed(limiter, 1, NOW, BURST) == BURST
+    assert not limiter.allow(1, NOW)
+
+
+def test_refill_after_deny():
+    limiter = RateLimiter(RATE, BURST)
+    assert allowed(limiter, 1, NOW, BURST + 1) == BURST
+    # 1件分の時間が経つと1件だけ送れる
+    assert allowed(limiter, 1, NOW + INTERVAL, 3) == 1
+    # 満タンになるまで待っても burst より多くは送れない
+    assert allowed(limiter, 1, NOW + 10, BURST + 1) == BURST
+
+
+def test_steady_rate_is_allowed():
+    limiter = RateLimiter(RATE, BURST)
+    assert all(limiter.allow(1, NOW + i * INTERVAL) for i in range(100))
+    # 間隔の半分で送り続けると burst を使い切った後は半分だけ通る
+    results = [
+        limiter.allow(1, NOW + 100 * INTERVAL + i * INTERVAL / 2) for i in range(40)
+    ]
+    assert sum(results) < 40
+    assert results[-2:].count(True) == 1
+
+
+def test_keys_are_independent():
+    limiter = RateLimiter(RATE, BURST)
+    assert allowed(limiter, 1, NOW, BURST + 1) == BURST
+    assert limiter.allow(2, NOW)
+    # 0 は空きの印なので、1 と同じバケットを使う
+    assert not limiter.allow(0, NOW)
+    # 64 ビットを超える分は切り捨てる
+    assert not limiter.allow(1 + (1 << 64), NOW)
+
+
+def test_active_bucket_is_evicted_when_full():
+    evictions = []
+    limiter = RateLimiter(
+        RATE, BURST, max_entries=8, ways=8, on_evict=lambda: evictions.append(1)
+    )
+    assert limiter.capacity == 8
+    for key in range(1, 9):
+        limiter.allow(key, NOW)
+    assert limiter.active(NOW) == 8
+    assert not evictions
+
+    # 満タンに戻ったバケットは上書きしても数えない
+    assert limiter.allow(9, NOW + 10)
+    assert not evictions
+    # 全ての枠が使用中なら、最も満タンに近い枠を上書きする
+    for key in range(10, 17):
+        limiter.allow(key, NOW + 10)
+    assert limiter.allow(17, NOW + 10)
+    assert evictions == [1]
+    assert limiter.memory() == 8 * 16
@@ -0,0 +1,159 @@
+"""再送と順序保証のレイヤー (reliable.py) のテスト
+
+選択的 ACK・再送・諦め・重複と並べ替えを個別に確認し、最後に欠落・重複・
+並べ替えのあるネットワークを模したやりとりで全体を確認する。
+"""
+
+import os
+import random
+import sys
+from collections import Counter
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from reliable import (  # noqa: E402
+    ACK_PACKET,
+    DATA_HEADER,
+    MAX_RETRANSMITS,
+    RELIABLE_ACK,
+    RETRANSMIT_INTERVAL,
+    RETRANSMIT_TIMEOUT,
+    ReliableChannel,
+    ReliableReceiver,
+    ReliableSender,
+)
+
+
+def counter():
+    counts = Counter()
+
+    def count(name, value=1):
+        counts[name] += value
+
+    return counts, count
+
+
+def sequence(packet):
+    return DATA_HEADER.unpack_from(packet)[1]
+
+
+def test_reordered_messages_are_delivered_in_order():
+    receiver = ReliableReceiver()
+    assert receiver.receive(3, 1, b"c") == []
+    assert receiver.receive(2, 1, b"b") == []
+    assert receiver.receive(1, 1, b"a") == [b"a", b"b", b"c"]
+    assert receiver.receive(4, 1, b"d") == [b"d"]
+
+
+def test_duplicates_are_dropped():
+    counts, count = counter()
+    receiver = ReliableReceiver(count=count)
+    assert receiver.receive(1, 1, b"a") == [b"a"]
+    assert receiver.receive(3, 1, b"c") == []
+    # 取り出し済みの連番と、並べ替え待ちの連番の重複
+    assert receiver.receive(1, 1, b"a") == []
+    assert receiver.receive(3, 1, b"c") == []
+    assert counts["duplicate_datagrams"] == 2
+    assert receiver.receive(2, 1, b"b") == [b"b", b"c"]
+
+
+def test_ack_reports_received_sequences():
+    receiver = ReliableReceiver()
+    for seq in (1, 3, 5, 40):
+        receiver.receive(seq, 1, b"x")
+    _, cumulative, bitmap = ACK_PACKET.unpack(receiver.ack())
+    # 2 を待っていて、3 と 5 は受信済み (40 はビットマップの範囲外)
+    assert cumulative == 2
+    assert bitmap == 0b101
+
+
+def test_selective_ack_stops_retransmits():
+    sender = ReliableSender()
+    packets = [sender.wrap(bytes([seq]), 0.0) for seq in range(1, 6)]
+    assert [sequence(packet) for packet in packets] == [1, 2, 3, 4, 5]
+    # 1 は受信済み、2 を待っていて 4 は受信済み
+    sender.on_ack(2, 0b10)
+    assert list(sender.unacked) == [2, 3, 5]
+    due = sender.due(RETRANSMIT_TIMEOUT)
+    assert [sequence(packet) for packet in due] == [2, 3, 5]
+    sender.on_ack(6, 0)
+    assert not sender.unacked
+
+
+def test_retransmit_backoff_and_give_up():
+    counts, count = counter()
+    sender = ReliableSender(count=count)
+    sender.wrap(b"a", 0.0)
+    assert sender.due(RETRANSMIT_TIMEOUT / 2) == []
+
+    for _ in range(MAX_RETRANSMITS):
+        now = sender.unacked[1][1]
+        assert len(sender.due(now)) == 1
+        # 次の再送まで待つ時間は倍になる (上限あり)
+        assert sender.due(now) == []
+    assert counts["retransmits"] == MAX_RETRANSMITS
+
+    assert sender.due(sender.unacked[1][1]) == []
+    assert not sender.unacked
+    assert counts["retransmit_giveups"] == 1
+
+
+def test_receiver_skips_sequences_the_sender_gave_up():
+    counts, count = counter()
+    sender = ReliableSender(window=2, count=count)
+    receiver = ReliableReceiver(count=count)
+    lost = [sender.wrap(b"a", 0.0), sender.wrap(b"b", 0.0)]
+    assert [sequence(packet) for packet in lost] == [1, 2]
+    # 窓が溢れて 1 を諦めたので、3 の base は 2
+    packet = sender.wrap(b"c", 0.0)
+    assert counts["retransmit_giveups"] == 1
+    seq, base = DATA_HEADER.unpack_from(packet)[1:]
+    assert (seq, base) == (3, 2)
+    assert receiver.receive(seq, base, b"c") == []
+    assert counts["sequence_gaps"] == 1
+    assert receiver.receive(2, 2, b"b") == [b"b", b"c"]
+
+
+def test_lossy_network_round_trip():
+    """欠落・重複・並べ替えのあるネットワークでも全てのメッセージが順番どおりに届く"""
+    rng = random.Random(0)
+    counts, count = counter()
+    sender = ReliableChannel(count=count)
+    receiver = ReliableChannel(count=count)
+    in_flight = []  # (届く時刻, 宛先, パケット)
+
+    def transmit(now, destination, packet):
+        if rng.random() < 0.2:
+            return
+        copies = 2 if rng.random() < 0.1 else 1
+        for _ in range(copies):
+            in_flight.append((now + rng.uniform(0, 0.3), destination, packet))
+
+    messages = [f"message {i}".encode() for i in range(200)]
+    delivered = []
+    now = 0.0
+    for tick in range(5000):
+        now = tick * RETRANSMIT_INTERVAL
+        if tick < len(messages):
+            transmit(now, receiver, sender.wrap(messages[tick], now))
+        for packet in sender.due(now):
+            transmit(now, receiver, packet)
+
+        arrived = [item for item in in_flight if item[0] <= now]
+        in_flight[:] = [item for item in in_flight if item[0] > now]
+        for _, destination, packet in arrived:
+            received, ack = destination.receive(packet)
+            if destination is receiver:
+                delivered.extend(received)
+                transmit(now, sender, ack)
+            else:
+                assert packet[0] == RELIABLE_ACK
+        if len(delivered) == len(messages) and not sender.pending():
+            break
+
+    assert delivered == messages
+    assert not sender.pending()
+    assert counts["retransmits"] > 0
+    assert counts["duplicate_datagrams"] > 0
+    assert counts["retransmit_giveups"] == 0
@@ -0,0 +1,186 @@
+"""状態の記録と復元 (state_log.py) のテスト
+
+記録したディレクトリから新しい RoomRegistry に復元し、ルームと参加者
+(セッションID・アドレス・配信方法) が元どおりになることを確認する。
+"""
+
+import os
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from reliable import ReliableChannel  # noqa: E402
+from room_registry import Member, RoomRegistry, session_id  # noqa: E402
+from state_log import SNAPSHOT_FILE, StateLog, encode_member_joined  # noqa: E402
+
+
+def open_log(directory):
+    """directory の状態を復元した RoomRegistry と、変更の記録を始めた StateLog"""
+    registry = RoomRegistry()
+    log = StateLog(directory, commit_interval=0.001, snapshot_interval=3600)
+    log.restore(registry, ReliableChannel)
+    log.start(registry)
+    registry.journal = log
+    return registry, log
+
+
+def restore(directory):
+    """directory の状態を復元した RoomRegistry と (ルーム数, 参加者数)"""
+    registry = RoomRegistry()
+    counts = StateLog(directory).restore(registry, ReliableChannel)
+    return registry, counts
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.startswith("wal."))
+
+
+def create_room(registry, name, username="host"):
+    host = Member(f"{name}-{username}", username, ("127.0.0.1", 5000))
+    return registry.create(name, host.token, "hashed", host), host
+
+
+def join(registry, room, username, address=("127.0.0.1", 6000)):
+    member = Member(f"{room.name}-{username}", username, address)
+    assert registry.add_member(room, member)
+    return member
+
+
+def register_address(registry, room, member, address, reliable=False):
+    with room.lock:
+        registry.set_address(room, member, address)
+        room.enable_envelope(member)
+        if reliable:
+            room.enable_reliable(member, ReliableChannel())
+        registry.address_changed(room, member)
+
+
+def test_wal_replay(tmp_path):
+    registry, log = open_log(tmp_path)
+    room, host = create_room(registry, "lobby")
+    bob = join(registry, room, "bob")
+    carol = join(registry, room, "carol")
+    register_address(registry, room, bob, ("10.0.0.2", 7000), reliable=True)
+    with room.lock:
+        registry.remove_member(room, carol)
+    closed, _ = create_room(registry, "closed")
+    registry.remove(closed)
+    log.close()
+
+    restored, counts = restore(tmp_path)
+    assert counts == (1, 2)
+    assert restored.get("closed") is None
+    room = restored.get("lobby")
+    assert room.password == "hashed"
+    assert room.host_token == host.token
+    restored_bob = restored.get_session(session_id(bob))[1]
+    assert restored_bob.token == bob.token
+    assert restored_bob.username == "bob"
+    assert restored_bob.address == ("10.0.0.2", 7000)
+    assert restored_bob.envelope
+    assert restored_bob.reliable is not None
+    assert restored.get_address(("10.0.0.2", 7000))[1] is restored_bob
+    assert restored.get_token(carol.token) is None
+
+
+def test_truncated_tail_record_is_ignored(tmp_path):
+    registry, log = open_log(tmp_path)
+    room, _ = create_room(registry, "lobby")
+    bob = join(registry, room, "bob")
+    log.close()
+
+    # 書き込み途中で停止した参加の記録
+    dave = Member("lobby-dave", "dave", ("127.0.0.1", 6001))
+    dave.member_id = 1
+    record = encode_member_joined(room, dave)
+    with open(tmp_path / segments(tmp_path)[-1], "ab") as f:
+        f.write(record[:-3])
+
+    restored, counts = restore(tmp_path)
+    assert counts == (1, 2)
+    assert restored.get_token(bob.token) is not None
+    assert restored.get_token(dave.token) is None
+
+    # 復元した後の記録は壊れた記録の後ろではなく新しいセグメントに書くので読める
+    registry, log = open_log(tmp_path)
+    join(registry, registry.get("lobby"), "erin")
+    log.close()
+    assert restore(tmp_path)[1] == (1, 3)
+
+
+def test_corrupted_record_stops_replay(tmp_path):
+    registry, log = open_log(tmp_path)
+    create_room(registry, "lobby")
+    log.close()
+
+    registry, log = open_log(tmp_path)
+    room = registry.get("lobby")
+    bob = join(registry, room, "bob")
+    join(registry, room, "carol")
+    log.close()
+    # 再起動後のセグメントは bob と carol の参加の記録だけ
+    path = tmp_path / segments(tmp_path)[-1]
+    data = bytearray(path.read_bytes())
+    # bob の記録の CRC が合わなくなると、その後の carol の記録も読まない
+    data[len(encode_member_joined(room, bob)) - 1] ^= 0xFF
+    path.write_bytes(bytes(data))
+    assert restore(tmp_path)[1] == (1, 1)
+
+
+def test_room_without_host_record_is_dropped(tmp_path):
+    registry, log = open_log(tmp_path)
+    create_room(registry, "lobby")
+    log.close()
+    # ルーム作成とホストの参加は続けて記録されるので、ホストの記録の途中で切る
+    path = tmp_path / segments(tmp_path)[-1]
+    path.write_bytes(path.read_bytes()[:-5])
+
+    restored, counts = restore(tmp_path)
+    assert counts == (0, 0)
+    assert restored.get("lobby") is None
+
+
+def test_snapshot_and_wal_recovery(tmp_path):
+    registry, log = open_log(tmp_path)
+    room, host = create_room(registry, "lobby")
+    bob = join(registry, room, "bob")
+    register_address(registry, room, bob, ("10.0.0.2", 7000))
+    log.close()
+    first_segments = segments(tmp_path)
+
+    # 再起動時にスナップショットを作り、古いセグメントを消す
+    registry, log = open_log(tmp_path)
+    assert (tmp_path / SNAPSHOT_FILE).exists()
+    assert set(segments(tmp_path)).isdisjoint(first_segments)
+    room = registry.get("lobby")
+    with room.lock:
+        registry.remove_member(room, registry.get_token(bob.token)[1])
+    carol = join(registry, room, "carol")
+    other, _ = create_room(registry, "other")
+    log.close()
+
+    restored, counts = restore(tmp_path)
+    assert counts == (2, 3)
+    assert restored.get_token(bob.token) is None
+    assert restored.get_token(host.token) is not None
+    assert restored.get_session(session_id(carol))[1].token == carol.token
+    # 復元したルームより後のルームIDから割り当てる
+    new_room, _ = create_room(restored, "new")
+    assert new_room.room_id > other.room_id
+
+
+def test_snapshot_keeps_addresses(tmp_path):
+    registry, log = open_log(tmp_path)
+    room, _ = create_room(registry, "lobby")
+    bob = join(registry, room, "bob")
+    register_address(registry, room, bob, ("10.0.0.2", 7000), reliable=True)
+    log.close()
+    # 2回再起動して、スナップショットだけから復元する
+    for _ in range(2):
+        open_log(tmp_path)[1].close()
+
+    restored_bob = restore(tmp_path)[0].get_token(bob.token)[1]
+    assert restored_bob.address == ("10.0.0.2", 7000)
+    assert restored_bob.envelope
+    assert restored_bob.reliable is not None